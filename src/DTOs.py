@@ -2,22 +2,87 @@ from enum import Enum, auto
 from socket import socket
 from threading import Thread
 from typing import Optional, Tuple
+from rtt import RttEstimator
+
+MAX_ADDRESS_LENGTH = 256 # bytes of a shipping address, its SHP must fit in the datagrams read by the drones.
 
 class ShippingRequestDTO:
-    drone_id: int
+    drone_id: Optional[int] # None lets the gateway choose the drone.
     shipping_address: str
 
-    def __init__(self, drone_id: int, shipping_address: str):
+    def __init__(self, drone_id: Optional[int], shipping_address: str):
         self.drone_id = drone_id
         self.shipping_address = shipping_address
 
     def encode(self) -> bytes: 
-        return (str(self.drone_id) + ":::" + self.shipping_address).encode()
+        return (("" if self.drone_id is None else str(self.drone_id)) + ":::" + self.shipping_address).encode()
 
     @staticmethod
     def decode(bytes: bytes) -> 'ShippingRequestDTO':
-        drone_id, shipping_address = bytes.decode().split(":::")
-        return ShippingRequestDTO(int(drone_id), shipping_address)
+        drone_id, shipping_address = bytes.decode().split(":::", 1)
+        return ShippingRequestDTO(int(drone_id) if drone_id else None, shipping_address)
+
+    @staticmethod
+    def is_valid_address(shipping_address: str) -> bool:
+        ''' Addresses are sent to the clients as they are, inside the fields and lines of DronesUpdateDTO,
+            so they can't hold the separators of those '''
+        return (shipping_address != "" and ":::" not in shipping_address and "\n" not in shipping_address
+            and len(shipping_address.encode()) <= MAX_ADDRESS_LENGTH)
+
+
+class ShippingBatchDTO:
+    ''' Many shipping requests sent in a single message, answered by a single ShippingBatchResultDTO with the same batch_id '''
+    TAG = "BATCH"
+
+    batch_id: int
+    requests: list[ShippingRequestDTO]
+
+    def __init__(self, batch_id: int, requests: list[ShippingRequestDTO]):
+        self.batch_id = batch_id
+        self.requests = requests
+
+    def encode(self) -> bytes:
+        return b"\n".join([(ShippingBatchDTO.TAG + ":::" + str(self.batch_id)).encode()] + [r.encode() for r in self.requests])
+
+    @staticmethod
+    def is_shipping_batch(bytes: bytes) -> bool:
+        return bytes.startswith((ShippingBatchDTO.TAG + ":::").encode())
+
+    @staticmethod
+    def decode(bytes: bytes) -> 'ShippingBatchDTO':
+        header, *requests = bytes.split(b"\n")
+        _, batch_id = header.decode().split(":::")
+        return ShippingBatchDTO(int(batch_id), [ShippingRequestDTO.decode(r) for r in requests])
+
+
+class ShippingBatchResultDTO:
+    ''' The outcome of every request of a ShippingBatchDTO, in the same order: None if it was accepted, otherwise the error
+        message '''
+    TAG = "BATCHRESULT"
+
+    batch_id: int
+    errors: list[Optional[str]]
+
+    def __init__(self, batch_id: int, errors: list[Optional[str]]):
+        self.batch_id = batch_id
+        self.errors = errors
+
+    @property
+    def accepted(self) -> int:
+        return sum(1 for e in self.errors if e is None)
+
+    def encode(self) -> bytes:
+        return "\n".join([ShippingBatchResultDTO.TAG + ":::" + str(self.batch_id)] + [e or "" for e in self.errors]).encode()
+
+    @staticmethod
+    def is_shipping_batch_result(bytes: bytes) -> bool:
+        return bytes.startswith((ShippingBatchResultDTO.TAG + ":::").encode())
+
+    @staticmethod
+    def decode(bytes: bytes) -> 'ShippingBatchResultDTO':
+        header, *errors = bytes.decode().split("\n")
+        _, batch_id = header.split(":::")
+        return ShippingBatchResultDTO(int(batch_id), [e or None for e in errors])
 
 
 class GatewayInterfaceDTO:
@@ -33,10 +98,22 @@ class GatewayInterfaceDTO:
 
     @staticmethod
     def decode(bytes: bytes) -> 'GatewayInterfaceDTO':
-        is_error_str, message = bytes.decode().split(":::")
+        is_error_str, message = bytes.decode().split(":::", 1)
         return GatewayInterfaceDTO(message, is_error_str == "True")
 
 
+class ResyncRequestDTO:
+    ''' Sent by the client to ask the gateway for a full snapshot of the drones '''
+    TAG = b"RESYNC"
+
+    def encode(self) -> bytes:
+        return ResyncRequestDTO.TAG
+
+    @staticmethod
+    def is_resync_request(bytes: bytes) -> bool:
+        return bytes == ResyncRequestDTO.TAG
+
+
 class DroneState(Enum):
     NOT_AVAILABLE = auto()
     CURRENTLY_SHIPPING = auto()
@@ -52,25 +129,112 @@ class DroneState(Enum):
         print("Errore")
         exit(1)
 
+class DroneStatusDTO:
+    ''' What the client shows about a drone '''
+    drone_id: int
+    state: DroneState
+    shipping_address: Optional[str] # the stops of the route separated by " -> " if it has many.
+
+    def __init__(self, drone_id: int, state: DroneState, shipping_address: Optional[str] = None):
+        self.drone_id = drone_id
+        self.state = state
+        self.shipping_address = shipping_address
+
+    @staticmethod
+    def of(drone: 'Drone') -> 'DroneStatusDTO':
+        shipping_address = " -> ".join(r.shipping_address for r in drone.pending_shipping_requests)
+        return DroneStatusDTO(drone.id, drone.state, shipping_address or None)
+
+    def encode(self) -> str:
+        return str(self.drone_id) + ":::" + self.state.name + ":::" + (self.shipping_address or "")
+
+    @staticmethod
+    def decode(string: str) -> 'DroneStatusDTO':
+        drone_id, state, shipping_address = string.split(":::")
+        return DroneStatusDTO(int(drone_id), DroneState[state], shipping_address or None)
+
+    def __str__(self) -> str:
+        s = "DRONE " + str(self.drone_id) + "\t--->   " + self.state.__str__()
+        if self.shipping_address:
+            s += " a \"%s\"" % self.shipping_address
+        return s
+
+
+class DronesUpdateDTO:
+    ''' Changes to the drones shown by the client.
+        A snapshot lists every drone and replaces what the client knows
+        (it's sent on connection or when the client asks for a resync), otherwise only the drones which changed are listed.
+        Updates are numbered so that the client can detect a missing one. '''
+    SNAPSHOT = "SNAPSHOT"
+    DELTA = "DELTA"
+
+    version: int
+    is_snapshot: bool
+    drones: list[DroneStatusDTO]
+    removed_drone_ids: list[int]
+
+    def __init__(self, version: int, is_snapshot: bool, drones: list[DroneStatusDTO],
+                 removed_drone_ids: Optional[list[int]] = None):
+        self.version = version
+        self.is_snapshot = is_snapshot
+        self.drones = drones
+        self.removed_drone_ids = removed_drone_ids if removed_drone_ids else []
+
+    def encode(self) -> bytes:
+        header = ":::".join([
+            DronesUpdateDTO.SNAPSHOT if self.is_snapshot else DronesUpdateDTO.DELTA,
+            str(self.version),
+            ",".join(str(id) for id in self.removed_drone_ids)
+        ])
+        return "\n".join([header] + [d.encode() for d in self.drones]).encode()
+
+    @staticmethod
+    def is_drones_update(bytes: bytes) -> bool:
+        return bytes.startswith(DronesUpdateDTO.SNAPSHOT.encode()) or bytes.startswith(DronesUpdateDTO.DELTA.encode())
+
+    @staticmethod
+    def decode(bytes: bytes) -> 'DronesUpdateDTO':
+        header, *drones = bytes.decode().split("\n")
+        kind, version, removed_drone_ids = header.split(":::")
+        return DronesUpdateDTO(
+            int(version),
+            kind == DronesUpdateDTO.SNAPSHOT,
+            [DroneStatusDTO.decode(d) for d in drones],
+            [int(id) for id in removed_drone_ids.split(",") if id]
+        )
+
+
 class Drone:
+    # thousands of drones are kept for the whole run, slots save the instance __dict__ of each one.
+    __slots__ = ("id", "address", "state", "sock", "send_sequence_number", "expected_recv_sequence_number",
+                 "pending_shipping_requests", "window", "thread", "rtt", "last_heard", "resumption_token")
     id: int
     address: Tuple[str, int]
     state: DroneState
     sock: socket
     send_sequence_number: int
     expected_recv_sequence_number: int
-    pending_shipping_request: Optional[ShippingRequestDTO]
+    pending_shipping_requests: list[ShippingRequestDTO] # the route assigned to the drone, each request is a stop.
+    window: int # SHPs which can be sent without waiting for their ACKs, negotiated in the handshake. 1 is stop-and-wait.
     thread: Optional[Thread]
+    rtt: RttEstimator # RTT of the link with the drone, its RTO and how many retransmissions it took.
+    last_heard: float # when the last packet of the drone arrived, see LivenessTable.
+    resumption_token: Optional[int] # lets the drone resume the connection from another address, None if it can't.
 
-    def __init__(self, id: int, address: Tuple[str, int], state: DroneState, sock: socket, send_sequence_number: int = 0, expected_recv_sequence_number: int = 0):
+    def __init__(self, id: int, address: Tuple[str, int], state: DroneState, sock: socket, send_sequence_number: int = 0,
+                 expected_recv_sequence_number: int = 0):
         self.id = id
         self.address = address
         self.state = state
         self.sock = sock
         self.send_sequence_number = send_sequence_number
         self.expected_recv_sequence_number = expected_recv_sequence_number
-        self.pending_shipping_request = None
+        self.pending_shipping_requests = []
+        self.window = 1
         self.thread = None
+        self.rtt = RttEstimator()
+        self.last_heard = 0
+        self.resumption_token = None
 
     def increment_send_sequence_number(self):
         self.send_sequence_number += 1
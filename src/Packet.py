@@ -1,11 +1,56 @@
-from typing import Optional, Tuple
+import struct
+from typing import Optional, Sequence, Tuple, Union
 
 Address = Tuple[str, int]
 
 # Note that a SYNACK is not a combination of is_SYN=True and is_ACK=True but it has it's own attribute.
 # It is not the most nice and safe way but it is simpler to manage.
 
+# Binary wire format (version 2):
+#   version (1 byte) | type/flags (2 bytes) | seq_num (4 bytes) | ACK_num (4 bytes) | new_port (2 bytes)
+#   | addr length (2 bytes) | shp_addr (UTF-8)
+#   followed by the optional extensions of the windowed mode, each present only if its flag is set:
+#   window (2 bytes, FLAG_WINDOW) | SACK blocks count (1 byte) and, for each block, start and end (4 bytes each) (FLAG_SACK)
+#   | the resumption token (8 bytes, FLAG_TOKEN)
+# All integers are big-endian. Missing optional fields are encoded with sentinel values.
+# Peers which don't know the extensions ignore their flags and the trailing bytes, so they just never negotiate a window.
+# Version 1 had a single flags byte, in which the token shared the bit of SACK and a resumed SYNACK reused FLAG_MORE_STOPS:
+# packets which need none of the flags above it are still encoded as version 1, and version 1 packets are still decoded.
+WIRE_VERSION = 2
+ACCEPT_LEGACY_FORMAT = True # set to False once every peer speaks the binary format.
+ENCODE_LEGACY_FORMAT = False # set to True to keep talking to peers which only understand the old ":::" format.
+
+FLAG_SYN = 0x01
+FLAG_SYNACK = 0x02
+FLAG_ACK = 0x04
+FLAG_AVB = 0x08
+FLAG_SHP = 0x10
+FLAG_WINDOW = 0x20 # SYN/SYNACK: the window follows
+FLAG_SACK = 0x40 # ACK: the selective ACK blocks follow
+FLAG_MORE_STOPS = 0x80 # SHP: other SHPs of the same route follow
+FLAG_TOKEN = 0x100 # SYN/SYNACK: the resumption token follows
+FLAG_ROUTE_FOLLOWS = 0x200 # SYNACK of a resumed connection: the drone is AVAILABLE, the SHPs of its route follow
+
+_HEADER = struct.Struct('!BHIIHH')
+_HEADER_V1 = struct.Struct('!BBIIHH')
+_V1_FLAG_TOKEN = 0x40
+_V1_FLAG_ROUTE_FOLLOWS = 0x80
+_NO_NUMBER = 0xFFFFFFFF # sentinel for seq_num/ACK_num == None
+_NO_PORT = 0 # port 0 can't be a destination, so it stands for new_port == None
+_NO_ADDRESS = 0xFFFF # sentinel for shp_addr == None
+_WINDOW = struct.Struct('!H')
+_SACK_COUNT = struct.Struct('!B')
+_SACK_BLOCK = struct.Struct('!II')
+_TOKEN = struct.Struct('!Q')
+NO_TOKEN = 0 # in a SYN: the drone can resume its connections but it has no token yet.
+
+SackBlock = Tuple[int, int] # sequence numbers from start (included) to end (excluded) received beyond the cumulative ACK.
+_NO_SACK_BLOCKS: tuple[SackBlock, ...] = () # shared by every packet without SACK blocks, i.e. almost all of them.
+
 class Packet:
+    # a packet is allocated for every datagram sent and received: without an instance __dict__ it is a single, smaller allocation.
+    __slots__ = ("seq_num", "is_SYN", "is_SYNACK", "new_port", "is_ACK", "ACK_num", "is_AVB", "is_SHP", "shp_addr", "window",
+                 "SACK_blocks", "has_more_stops", "token", "route_follows")
     seq_num: Optional[int]
     is_SYN: bool
     is_SYNACK: bool
@@ -15,26 +60,37 @@ class Packet:
     is_AVB: bool
     is_SHP: bool
     shp_addr: Optional[str]
+    # SYN: packets the drone can receive before acknowledging them, SYNACK: the window granted. None is stop-and-wait.
+    window: Optional[int]
+    SACK_blocks: Sequence[SackBlock]
+    has_more_stops: bool
+    # SYN: the token of the connection to resume, SYNACK: the token to resume this connection with. None if the peer can't resume.
+    token: Optional[int]
+    route_follows: bool # SYNACK of a resumed connection: the drone is AVAILABLE and the SHPs of its route are being sent.
 
     @staticmethod
-    def SYN() -> 'Packet':
-        return Packet(sequence_number=0, is_SYN=True)
+    def SYN(window: Optional[int] = None, token: Optional[int] = None) -> 'Packet':
+        return Packet(sequence_number=0, is_SYN=True, window=window, token=token)
 
     @staticmethod
-    def SYNACK(ACK_number: int, new_port: int) -> 'Packet':
-        return Packet(sequence_number=0, ACK_number=ACK_number, new_port=new_port, is_SYNACK=True)
+    def SYNACK(ACK_number: int, new_port: int, window: Optional[int] = None, token: Optional[int] = None,
+               sequence_number: int = 0, route_follows: bool = False) -> 'Packet':
+        return Packet(sequence_number=sequence_number, ACK_number=ACK_number, new_port=new_port, is_SYNACK=True,
+            window=window, token=token,
+            route_follows=route_follows)
 
     @staticmethod
-    def ACK(ACK_number: int) -> 'Packet':
-        return Packet(is_ACK=True, ACK_number=ACK_number)
+    def ACK(ACK_number: int, SACK_blocks: Optional[Sequence[SackBlock]] = None) -> 'Packet':
+        return Packet(is_ACK=True, ACK_number=ACK_number, SACK_blocks=SACK_blocks)
 
     @staticmethod
     def AVB(sequence_number: int) -> 'Packet':
         return Packet(sequence_number=sequence_number, is_AVB=True)
 
     @staticmethod
-    def SHP(sequence_number: int, shipping_address: str) -> 'Packet':
-        return Packet(sequence_number=sequence_number, is_SHP=True, shipping_address=shipping_address)
+    def SHP(sequence_number: int, shipping_address: str, has_more_stops: bool = False) -> 'Packet':
+        return Packet(sequence_number=sequence_number, is_SHP=True, shipping_address=shipping_address,
+            has_more_stops=has_more_stops)
 
     def __init__(self,
                 sequence_number: Optional[int] = None,
@@ -45,7 +101,12 @@ class Packet:
                 ACK_number: Optional[int] = None,
                 is_AVB: bool = False,
                 is_SHP: bool = False,
-                shipping_address: Optional[str] = None,) -> None:
+                shipping_address: Optional[str] = None,
+                window: Optional[int] = None,
+                SACK_blocks: Optional[Sequence[SackBlock]] = None,
+                has_more_stops: bool = False,
+                token: Optional[int] = None,
+                route_follows: bool = False) -> None:
         self.seq_num = sequence_number
         self.is_SYN = is_SYN
         self.is_SYNACK = is_SYNACK
@@ -55,8 +116,53 @@ class Packet:
         self.is_AVB = is_AVB
         self.is_SHP = is_SHP
         self.shp_addr = shipping_address
+        self.window = window
+        self.SACK_blocks = SACK_blocks if SACK_blocks else _NO_SACK_BLOCKS
+        self.has_more_stops = has_more_stops
+        self.token = token
+        self.route_follows = route_follows
+
+    def encode(self) -> bytes:
+        if ENCODE_LEGACY_FORMAT:
+            return self.encode_legacy()
+        flags = 0
+        if self.is_SYN: flags |= FLAG_SYN
+        if self.is_SYNACK: flags |= FLAG_SYNACK
+        if self.is_ACK: flags |= FLAG_ACK
+        if self.is_AVB: flags |= FLAG_AVB
+        if self.is_SHP: flags |= FLAG_SHP
+        if self.has_more_stops: flags |= FLAG_MORE_STOPS
+        if self.route_follows: flags |= FLAG_ROUTE_FOLLOWS
+        extensions = b''
+        if self.window is not None:
+            flags |= FLAG_WINDOW
+            extensions += _WINDOW.pack(self.window)
+        if self.SACK_blocks:
+            flags |= FLAG_SACK
+            extensions += _SACK_COUNT.pack(len(self.SACK_blocks))
+            extensions += b''.join(_SACK_BLOCK.pack(*block) for block in self.SACK_blocks)
+        if self.token is not None:
+            flags |= FLAG_TOKEN
+            extensions += _TOKEN.pack(self.token)
+        if self.shp_addr is None:
+            addr = b''
+            addr_len = _NO_ADDRESS
+        else:
+            addr = self.shp_addr.encode()
+            addr_len = len(addr)
+            if addr_len >= _NO_ADDRESS:
+                raise ValueError("shipping address is too long to be encoded")
+        header, version = (_HEADER, WIRE_VERSION) if flags > 0xFF else (_HEADER_V1, 1)
+        return header.pack(
+            version,
+            flags,
+            _NO_NUMBER if self.seq_num is None else self.seq_num,
+            _NO_NUMBER if self.ACK_num is None else self.ACK_num,
+            _NO_PORT if self.new_port is None else self.new_port,
+            addr_len
+        ) + addr + extensions
 
-    def encode(self) -> bytes: 
+    def encode_legacy(self) -> bytes:
         return ":::".join([
             self.seq_num.__str__(),
             self.is_SYN.__str__(),
@@ -70,8 +176,76 @@ class Packet:
         ]).encode()
 
     @staticmethod
-    def decode(bytes: bytes) -> 'Packet':
-        seq_num_str, is_SYN_str, is_SYNACK_str, new_port_str, is_ACK_str, ACK_num_str, is_AVB_str, is_SHP_str, shp_addr_str = bytes.decode().split(":::")
+    def decode(data: Union[bytes, bytearray, memoryview]) -> 'Packet':
+        view = memoryview(data)
+        if len(view) and view[0] in (1, WIRE_VERSION):
+            header = _HEADER if view[0] == WIRE_VERSION else _HEADER_V1
+            if len(view) < header.size:
+                raise ValueError("truncated packet")
+            version, flags, seq_num, ACK_num, new_port, addr_len = header.unpack_from(view)
+            if version == 1:
+                flags = Packet.flags_v1(flags)
+            if addr_len == _NO_ADDRESS:
+                shp_addr = None
+                end = header.size
+            else:
+                end = header.size + addr_len
+                if len(view) < end:
+                    raise ValueError("truncated packet")
+                shp_addr = str(view[header.size:end], 'utf-8')
+            window = None
+            SACK_blocks = None
+            token = None
+            try:
+                if flags & FLAG_WINDOW:
+                    window, = _WINDOW.unpack_from(view, end)
+                    end += _WINDOW.size
+                if flags & FLAG_SACK:
+                    count, = _SACK_COUNT.unpack_from(view, end)
+                    end += _SACK_COUNT.size
+                    SACK_blocks = []
+                    for _ in range(count):
+                        SACK_blocks.append(_SACK_BLOCK.unpack_from(view, end))
+                        end += _SACK_BLOCK.size
+                if flags & FLAG_TOKEN:
+                    token, = _TOKEN.unpack_from(view, end)
+                    end += _TOKEN.size
+            except struct.error:
+                raise ValueError("truncated packet")
+            return Packet(
+                sequence_number=None if seq_num == _NO_NUMBER else seq_num,
+                is_SYN=bool(flags & FLAG_SYN),
+                is_SYNACK=bool(flags & FLAG_SYNACK),
+                new_port=None if new_port == _NO_PORT else new_port,
+                is_ACK=bool(flags & FLAG_ACK),
+                ACK_number=None if ACK_num == _NO_NUMBER else ACK_num,
+                is_AVB=bool(flags & FLAG_AVB),
+                is_SHP=bool(flags & FLAG_SHP),
+                shipping_address=shp_addr,
+                window=window,
+                SACK_blocks=SACK_blocks,
+                has_more_stops=bool(flags & FLAG_MORE_STOPS),
+                token=token,
+                route_follows=bool(flags & FLAG_ROUTE_FOLLOWS)
+            )
+        if not ACCEPT_LEGACY_FORMAT:
+            raise ValueError("unsupported packet format")
+        return Packet.decode_legacy(bytes(view))
+
+    @staticmethod
+    def flags_v1(flags: int) -> int:
+        ''' The flags of a version 1 packet as version 2 flags: on a SYN/SYNACK its shared bits mean the token and the route '''
+        if flags & (FLAG_SYN | FLAG_SYNACK):
+            if flags & _V1_FLAG_TOKEN:
+                flags = flags & ~_V1_FLAG_TOKEN | FLAG_TOKEN
+            if flags & FLAG_SYNACK and flags & _V1_FLAG_ROUTE_FOLLOWS:
+                flags = flags & ~_V1_FLAG_ROUTE_FOLLOWS | FLAG_ROUTE_FOLLOWS
+        return flags
+
+    @staticmethod
+    def decode_legacy(bytes: bytes) -> 'Packet':
+        (seq_num_str, is_SYN_str, is_SYNACK_str, new_port_str, is_ACK_str, ACK_num_str, is_AVB_str, is_SHP_str,
+            shp_addr_str) = bytes.decode().split(":::")
         seq_num = None if seq_num_str == "None" else int(seq_num_str)
         is_SYN = is_SYN_str == "True"
         is_SYNACK = is_SYNACK_str == "True"
@@ -116,6 +290,16 @@ class Packet:
             s += "\nACK_number: " + str(self.ACK_num)
         elif self.is_SHP:
             s += "\nshipping_address: " + self.shp_addr
+            if self.has_more_stops:
+                s += " (more stops follow)"
+        if self.window is not None:
+            s += "\nwindow: " + str(self.window)
+        if self.SACK_blocks:
+            s += "\nSACK: " + ", ".join("%d-%d" % (start, end - 1) for start, end in self.SACK_blocks)
+        if self.token:
+            s += "\ntoken: %016x" % self.token
+        if self.route_follows:
+            s += "\nroute follows"
         
         s += "\n"
         return s
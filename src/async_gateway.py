@@ -0,0 +1,457 @@
+import asyncio
+from concurrent.futures import Future
+from enum import Enum, auto
+import logging
+from socket import socket
+from threading import Thread
+from typing import Any, Callable, Hashable, Optional
+from batch_io import BatchDatagramTransport
+from DTOs import *
+from handshake import HalfOpenTable
+from impairment import Impairment, ImpairedTransport, ImpairmentConfig
+from liveness import HEARTBEAT_INTERVAL, LivenessTable
+from log import DroneLog
+import metrics
+from metrics import DUPLICATES, HANDSHAKE_LATENCY, PACKETS_RECEIVED, ROUTE_LATENCY, packet_type
+from Packet import *
+from registry import DroneRegistry, new_resumption_token
+from timer_wheel import EventLoopDriver, RetransmissionScheduler, TimerWheel
+from window import MAX_WINDOW, SendWindow, negotiate
+
+# An alternative gateway engine which serves every drone from a single UDP socket on an asyncio event loop.
+# Datagrams are dispatched by source address to a per-drone state machine (DroneSession) so no thread and no socket
+# is needed for each drone. The SYNACK tells the drone to keep using the listening port instead of a new one.
+# A drone which shows up from another address with the resumption token of its connection is moved there, with its session.
+
+RETRANSMISSION_TIMEOUT: float = 1 # seconds
+LOG = logging.getLogger("gateway.asyncio")
+
+
+class SessionState(Enum):
+    SYN_RECEIVED = auto()           # SYNACK sent, waiting for the last ACK of the handshake
+    WAITING_AVB = auto()            # connected, waiting for the drone to notify that it is AVAILABLE
+    IDLE = auto()                   # drone is AVAILABLE and there's no shipping request for it
+    SHP_SENT = auto()               # the SHPs of a route sent, waiting for their ACKs
+
+
+class DroneSession:
+    ''' State machine implementing the gateway side of the drone protocol for a single drone '''
+    __slots__ = ("drone", "state", "protocol", "inbound", "in_flight", "route", "route_sent_at", "log")
+    drone: Drone
+    state: SessionState
+    protocol: 'GatewayProtocol'
+    inbound: Optional[Impairment] # drops some of the drone's datagrams, if simulated: each drone has its own link.
+    in_flight: Optional[Hashable] # key of the SYNACK waiting for an ACK in the RetransmissionScheduler
+    route: SendWindow # the SHPs waiting for an ACK
+    route_sent_at: float # when the first SHP of the route was sent.
+    log: DroneLog
+
+    def __init__(self, drone: Drone, protocol: 'GatewayProtocol'):
+        self.drone = drone
+        self.state = SessionState.SYN_RECEIVED
+        self.protocol = protocol
+        self.inbound = protocol.impairment.inbound_link()
+        self.in_flight = None
+        self.route = SendWindow()
+        self.route_sent_at = 0
+        self.log = DroneLog(LOG, drone.id)
+
+    def syn_received(self, packet: Packet):
+        self.log.info("[GATEWAY]\t<--\tSYN\t<--\t[DRONE %d]", self.drone.id)
+        self.drone.increment_expected_recv_sequence_number()
+        self.drone.window = negotiate(packet.window, self.protocol.max_window)
+        if packet.token is not None:
+            self.drone.resumption_token = self.protocol.new_token()
+        SYNACK = Packet.SYNACK(ACK_number=packet.seq_num+1, new_port=self.protocol.port,
+            window=None if packet.window is None else self.drone.window,
+            token=self.drone.resumption_token)
+        self.drone.increment_send_sequence_number()
+        self.send_reliably(SYNACK, "SYNACK", self.protocol.listener)
+        self.protocol.handshakes.add(self.drone, self.in_flight)
+
+    def packet_received(self, packet: Packet):
+        if self.state != SessionState.SYN_RECEIVED:
+            self.protocol.liveness.heard(self.drone)
+        if self.state == SessionState.SYN_RECEIVED:
+            if packet.is_SYN: # SYNACK was lost
+                self.log.debug("DroneSession %d: Received duplicate SYN. SYNACK was lost.", self.drone.id)
+                DUPLICATES.inc("SYN")
+                self.protocol.retransmissions.retransmit_now(self.in_flight)
+            elif packet.is_ACK:
+                self.log.info("[GATEWAY]\t<--\tACK\t<--\t[DRONE %d]", self.drone.id)
+                self.connection_established()
+            elif packet.is_AVB:
+                # the last ACK of the handshake was lost but the drone already started talking on this address.
+                self.log.debug("DroneSession %d: Interpreting AVB as the lost ACK of the handshake", self.drone.id)
+                self.connection_established(rtt_sample=False)
+                self.avb_received(packet)
+            else:
+                self.log.debug("DroneSession %d: Unexpected Packet while waiting for ACK:\n%s", self.drone.id, packet)
+        elif packet.is_AVB:
+            self.avb_received(packet)
+        elif packet.is_ACK and self.state == SessionState.SHP_SENT:
+            self.route_ACK_received(packet)
+        elif packet.is_SYN:
+            self.log.debug("DroneSession %d: Ignored SYN as the drone is already connected.", self.drone.id)
+        elif packet.is_ACK:
+            pass # a heartbeat, or a duplicated ACK
+        else:
+            self.log.debug("DroneSession %d: Ignored unexpected Packet:\n%s", self.drone.id, packet)
+
+    def connection_established(self, rtt_sample: bool = True):
+        self.stop_retransmitting(rtt_sample)
+        connection = self.protocol.handshakes.remove(self.drone.address)
+        if connection:
+            self.protocol.on_handshake(self.protocol.handshakes.clock() - connection.started_at)
+        self.state = SessionState.WAITING_AVB
+        self.protocol.connected_drones.add(self.drone)
+        self.protocol.liveness.heard(self.drone)
+        self.log.info("Connessione stabilita con il Drone %d all'indirizzo: %s", self.drone.id, self.drone.address)
+        self.protocol.on_state_change(self.drone)
+
+    def avb_received(self, packet: Packet):
+        if packet.seq_num < self.drone.expected_recv_sequence_number:
+            self.log.debug("DroneSession %d: ignoring duplicate AVB", self.drone.id)
+            DUPLICATES.inc("AVB")
+            return
+        if self.state == SessionState.SHP_SENT:
+            # ACK from drone was lost, this AVB means that the drone already shipped and it is available again.
+            # a drone doesn't leave until it has every stop of its route, so the AVB acknowledges all of them.
+            self.log.debug("DroneSession %d: Interpreting AVB as the lost ACK of the SHP", self.drone.id)
+            self.shipping_request_acknowledged(rtt_sample=False)
+        self.log.info("[GATEWAY]\t<--\tAVB\t<--\t[DRONE %d]", self.drone.id)
+        self.drone.increment_expected_recv_sequence_number()
+        self.send(Packet.ACK(packet.seq_num + 1), "ACK")
+        self.drone.pending_shipping_requests = []
+        self.drone.state = DroneState.AVAILABLE
+        self.state = SessionState.IDLE
+        self.protocol.on_state_change(self.drone)
+
+    def shipping_request_added(self):
+        ''' Sends the drone's route if the drone is ready to receive it, a SHP for each stop without waiting for their ACKs '''
+        if self.state != SessionState.IDLE or not self.drone.pending_shipping_requests:
+            return
+        self.state = SessionState.SHP_SENT
+        self.route_sent_at = self.protocol.loop.time()
+        first_seq_num = self.drone.send_sequence_number
+        self.drone.send_sequence_number += len(self.drone.pending_shipping_requests)
+        self.transmit_route(first_seq_num)
+
+    def transmit_route(self, first_seq_num: int):
+        ''' (Re)sends every SHP of the drone's route, numbered from first_seq_num,
+            forgetting the ones still waiting for an ACK '''
+        for seq_num in self.route.clear():
+            self.protocol.retransmissions.acknowledged((self.drone.id, seq_num), rtt_sample=False)
+        route = self.drone.pending_shipping_requests
+        for i, request in enumerate(route):
+            SHP = Packet.SHP(sequence_number=first_seq_num + i, shipping_address=request.shipping_address,
+                has_more_stops=i < len(route) - 1)
+            self.route.sent(SHP.seq_num)
+            self.transmit_reliably(SHP, "SHP")
+
+    def resumed(self, SYN: Packet) -> Packet:
+        ''' The drone resumed its connection, maybe from a new process which lost the SHPs it had already received: the route
+            being sent starts again from its first SHP. Returns the SYNACK telling the drone where the sequence numbers are '''
+        next_seq_num = self.drone.send_sequence_number
+        if self.state == SessionState.SHP_SENT:
+            next_seq_num -= len(self.drone.pending_shipping_requests)
+            self.transmit_route(next_seq_num)
+        return Packet.SYNACK(ACK_number=self.drone.expected_recv_sequence_number, new_port=self.protocol.port,
+            window=None if SYN.window is None else self.drone.window, token=self.drone.resumption_token,
+            sequence_number=next_seq_num - 1, route_follows=self.state in (SessionState.IDLE, SessionState.SHP_SENT))
+
+    def route_ACK_received(self, packet: Packet):
+        acknowledged, lost = self.route.acknowledged(packet.ACK_num, packet.SACK_blocks)
+        if acknowledged:
+            self.log.info("[GATEWAY]\t<--\tACK\t<--\t[DRONE %d]", self.drone.id)
+        else:
+            self.log.debug("DroneSession %d: Ignored ACK %d, no SHP acknowledged", self.drone.id, packet.ACK_num)
+            DUPLICATES.inc("ACK")
+        for seq_num in acknowledged:
+            self.protocol.retransmissions.acknowledged((self.drone.id, seq_num))
+        for seq_num in lost:
+            self.log.debug("DroneSession %d: SHP %d is missing, retransmitting it", self.drone.id, seq_num)
+            self.protocol.retransmissions.retransmit_now((self.drone.id, seq_num))
+        if acknowledged and not self.route:
+            ROUTE_LATENCY.observe(self.protocol.loop.time() - self.route_sent_at)
+            self.shipping_request_acknowledged()
+
+    def shipping_request_acknowledged(self, rtt_sample: bool = True):
+        for seq_num in self.route.clear():
+            self.protocol.retransmissions.acknowledged((self.drone.id, seq_num), rtt_sample)
+        self.log.debug("DroneSession %d: %s", self.drone.id, self.drone.rtt)
+        self.drone.state = DroneState.CURRENTLY_SHIPPING
+        self.state = SessionState.WAITING_AVB
+        self.protocol.on_state_change(self.drone)
+
+    # ----- SENDING -----
+    def send(self, packet: Packet, name: str, transport: Optional[ImpairedTransport] = None):
+        self.send_bytes(packet.encode(), name, transport)
+
+    def send_bytes(self, data: bytes, name: str, transport: Optional[ImpairedTransport] = None):
+        ''' Sends from transport, by default the protocol's one '''
+        delivered = (transport or self.protocol.transport).sendto(data, self.drone.address)
+        metrics.sent(name, delivered)
+        if delivered:
+            self.log.info("[GATEWAY]\t-->\t%s\t-->\t[DRONE %d]", name, self.drone.id)
+        else:
+            self.log.debug("[GATEWAY]\t-->\t%s\t--X\t[DRONE %d] (LOST)", name, self.drone.id)
+
+    def send_reliably(self, packet: Packet, name: str, transport: Optional[ImpairedTransport] = None):
+        ''' Sends the packet and keeps retransmitting it until stop_retransmitting is called '''
+        self.in_flight = self.transmit_reliably(packet, name, transport)
+
+    def transmit_reliably(self, packet: Packet, name: str, transport: Optional[ImpairedTransport] = None) -> Hashable:
+        ''' Sends the packet and keeps retransmitting it until its key is acknowledged in the RetransmissionScheduler '''
+        data = packet.encode()
+        key = (self.drone.id, packet.seq_num)
+        self.protocol.retransmissions.send(key, lambda: self.send_bytes(data, name, transport), self.drone.rtt)
+        self.protocol.arm_timer_wheel()
+        return key
+
+    def stop_retransmitting(self, rtt_sample: bool = True):
+        if self.in_flight is not None:
+            self.protocol.retransmissions.acknowledged(self.in_flight, rtt_sample)
+            self.in_flight = None
+
+    def close(self):
+        ''' Stops every retransmission to the drone, which is gone '''
+        self.stop_retransmitting(rtt_sample=False)
+        for seq_num in self.route.clear():
+            self.protocol.retransmissions.acknowledged((self.drone.id, seq_num), rtt_sample=False)
+
+
+class SendOnlyTransport:
+    ''' The part of a DatagramTransport that sends, on a socket which is read by another process '''
+    def __init__(self, sock: socket):
+        self.sock = sock
+        sock.setblocking(False)
+
+    def sendto(self, data: bytes, address: Address):
+        try:
+            self.sock.sendto(data, address)
+        except (BlockingIOError, InterruptedError):
+            pass # dropped as by a full network queue, it's retransmitted
+
+    def is_closing(self) -> bool:
+        return self.sock.fileno() == -1
+
+    def close(self):
+        self.sock.close()
+
+
+class GatewayProtocol(asyncio.DatagramProtocol):
+    ''' Receives every drone datagram on a single socket and dispatches it to the DroneSession of its sender '''
+    connected_drones: DroneRegistry
+    sessions: dict[Address, DroneSession]
+    handshakes: HalfOpenTable
+    transport: ImpairedTransport
+    listener: ImpairedTransport # where the SYNACKs are sent from, the same as transport unless the gateway is sharded.
+    # drops some of the datagrams of unknown senders, if simulated; those of a drone go through its session's.
+    inbound: Optional[Impairment]
+    loop: asyncio.AbstractEventLoop
+    port: int
+    timer_wheel: TimerWheel
+    timer_wheel_driver: EventLoopDriver
+    retransmissions: RetransmissionScheduler
+    max_window: int # the largest window granted to a drone.
+    liveness: LivenessTable
+    reaper: Optional[asyncio.TimerHandle]
+
+    def __init__(self,
+                connected_drones: DroneRegistry,
+                handshakes: Optional[HalfOpenTable] = None,
+                on_state_change: Callable[[Drone], None] = lambda drone: None,
+                impairment: Optional[ImpairmentConfig] = None,
+                max_window: int = MAX_WINDOW,
+                liveness: Optional[LivenessTable] = None,
+                on_drone_removed: Callable[[Drone], None] = lambda drone: None,
+                on_drone_moved: Callable[[Drone], None] = lambda drone: None,
+                listener: Optional[socket] = None,
+                new_token: Callable[[], int] = new_resumption_token,
+                on_handshake: Callable[[float], None] = HANDSHAKE_LATENCY.observe):
+        ''' on_state_change is called when a drone connects or changes state, on_drone_removed after a dead drone is unregistered,
+            on_drone_moved when a drone resumes its connection from another address,
+            on_handshake with the seconds each handshake took.
+            Drones already in connected_drones when the protocol starts are served as they are, e.g. recovered from the journal.
+            In a worker of a sharded gateway, listener is the socket the drones connect to: the SYNACKs are sent from it,
+            telling the drones to go on with the protocol's own socket,
+            and the datagrams it receives are passed to datagram_received '''
+        self.connected_drones = connected_drones
+        self.sessions = {}
+        self.handshakes = handshakes if handshakes is not None else HalfOpenTable()
+        self.on_state_change = on_state_change
+        self.impairment = impairment if impairment else ImpairmentConfig()
+        self.max_window = max_window
+        self.liveness = liveness if liveness is not None else LivenessTable()
+        self.on_drone_removed = on_drone_removed
+        self.on_drone_moved = on_drone_moved
+        self.listener_socket = listener
+        self.new_token = new_token
+        self.on_handshake = on_handshake
+        self.reaper = None
+        self.timer_wheel = TimerWheel()
+        self.retransmissions = RetransmissionScheduler(self.timer_wheel, RETRANSMISSION_TIMEOUT)
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        self.loop = asyncio.get_running_loop()
+        outbound, self.inbound = self.impairment.link()
+        self.transport = ImpairedTransport(transport, outbound, self.loop)
+        if self.listener_socket:
+            self.listener = ImpairedTransport(SendOnlyTransport(self.listener_socket), outbound, self.loop)
+        else:
+            self.listener = self.transport
+        self.port = transport.get_extra_info('sockname')[1]
+        self.timer_wheel_driver = EventLoopDriver(self.timer_wheel, self.loop)
+        self.reaper = self.loop.call_later(HEARTBEAT_INTERVAL, self.reap_dead_drones)
+        self.restore_sessions()
+
+    def restore_sessions(self):
+        ''' A session for each drone which was already connected, it resends the route the drone was assigned '''
+        for drone in self.connected_drones.values():
+            session = DroneSession(drone, self)
+            session.state = SessionState.IDLE if drone.state == DroneState.AVAILABLE else SessionState.WAITING_AVB
+            self.sessions[drone.address] = session
+            self.liveness.heard(drone)
+            session.shipping_request_added()
+
+    def datagram_received(self, data: bytes, address: Address):
+        session = self.sessions.get(address)
+        inbound = session.inbound if session else self.inbound
+        if inbound and inbound.is_lost():
+            return
+        try:
+            packet = Packet.decode(data)
+        except ValueError:
+            LOG.debug("GatewayProtocol: Ignored malformed datagram from %s", address, extra={"address": address})
+            return
+        PACKETS_RECEIVED.inc(packet_type(packet))
+
+        if packet.is_SYN and packet.token and self.resume(packet, address):
+            return
+        if session:
+            session.packet_received(packet)
+        elif packet.is_SYN:
+            self.evict_stale_handshakes()
+            if self.handshakes.is_full():
+                LOG.debug("GatewayProtocol: Dropped SYN from %s, too many handshakes in progress.", address,
+                    extra={"address": address})
+                return
+            drone = Drone(self.connected_drones.allocate_id(), address, DroneState.NOT_AVAILABLE, None)
+            session = DroneSession(drone, self)
+            self.sessions[address] = session
+            session.syn_received(packet)
+            # makes sure the handshake is evicted even if no other SYN arrives.
+            self.timer_wheel.schedule(self.handshakes.timeout, self.evict_stale_handshakes)
+            self.arm_timer_wheel()
+        else:
+            LOG.debug("GatewayProtocol: Ignored message from %s because it's not a SYN", address, extra={"address": address})
+
+    def resume(self, packet: Packet, address: Address) -> bool:
+        ''' Moves the connection of the drone owning the token to the address the SYN comes from, and confirms it with a SYNACK
+            carrying the sequence numbers of the connection.
+            Returns False if the token is unknown, the drone must connect again '''
+        drone = self.connected_drones.get_by_token(packet.token)
+        if not drone:
+            LOG.debug("GatewayProtocol: Unknown resumption token from %s, starting a new connection.", address,
+                extra={"address": address})
+            return False
+        if drone.address != address:
+            LOG.info("Il Drone %d ha ripreso la connessione dall'indirizzo: %s", drone.id, address,
+                extra={"drone": drone.id, "address": address})
+            self.sessions[address] = self.sessions.pop(drone.address)
+            self.connected_drones.move(drone, address)
+            self.on_drone_moved(drone)
+        self.liveness.heard(drone)
+        session = self.sessions[address]
+        # it's sent once, the drone retransmits its SYN until it gets one.
+        session.send(session.resumed(packet), "SYNACK", self.listener)
+        return True
+
+    def evict_stale_handshakes(self):
+        for connection in self.handshakes.evict_stale():
+            LOG.debug("GatewayProtocol: Handshake with %s timed out.", connection.drone.address,
+                extra={"drone": connection.drone.id})
+            self.sessions.pop(connection.drone.address).stop_retransmitting(rtt_sample=False)
+
+    def reap_dead_drones(self):
+        ''' Forgets the drones which stopped talking, then checks again after HEARTBEAT_INTERVAL '''
+        for drone in self.liveness.evict_dead():
+            LOG.info("Il Drone %d non risponde da %.0f secondi, disconnesso", drone.id, self.liveness.timeout,
+                extra={"drone": drone.id})
+            session = self.sessions.pop(drone.address, None)
+            if session:
+                session.close()
+            self.connected_drones.remove(drone)
+            self.on_drone_removed(drone)
+        self.reaper = self.loop.call_later(HEARTBEAT_INTERVAL, self.reap_dead_drones)
+
+    def shipping_request_added(self, drone: Drone):
+        session = self.sessions.get(drone.address)
+        if session:
+            session.shipping_request_added()
+
+    def arm_timer_wheel(self):
+        self.timer_wheel_driver.arm()
+
+    def close(self):
+        if self.reaper:
+            self.reaper.cancel()
+        self.retransmissions.cancel_all()
+        self.timer_wheel_driver.cancel()
+        self.transport.close()
+        if self.listener is not self.transport:
+            self.listener.close()
+
+
+class AsyncGateway:
+    ''' Runs a GatewayProtocol on its own event loop in a background thread '''
+    address: Address
+    protocol: GatewayProtocol
+    batch_io: bool # reads and writes the datagrams in batches, with recvmmsg/sendmmsg where available.
+    loop: Optional[asyncio.AbstractEventLoop]
+    thread: Optional[Thread]
+
+    def __init__(self, address: Address, protocol: GatewayProtocol, batch_io: bool = False):
+        self.address = address
+        self.protocol = protocol
+        self.batch_io = batch_io
+        self.loop = None
+        self.thread = None
+        self._stopped: Optional[asyncio.Event] = None
+
+    def start(self):
+        self.thread = Thread(target=asyncio.run, args=[self.serve()])
+        self.thread.start()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+        if self.batch_io:
+            await BatchDatagramTransport.create(lambda: self.protocol, self.address)
+        else:
+            await self.loop.create_datagram_endpoint(lambda: self.protocol, local_addr=self.address)
+        await self._stopped.wait()
+        self.protocol.close()
+
+    def shipping_request_added(self, drone: Drone):
+        ''' Thread-safe: notifies the engine that drone.pending_shipping_requests has been set '''
+        self.loop.call_soon_threadsafe(self.protocol.shipping_request_added, drone)
+
+    def call(self, function: Callable[..., Any], *args) -> Any:
+        ''' Thread-safe: runs function on the event loop, where the drones change state, and waits for its result.
+            It must not be called from the event loop itself '''
+        result: Future = Future()
+        def run():
+            try:
+                result.set_result(function(*args))
+            except BaseException as e:
+                result.set_exception(e)
+        self.loop.call_soon_threadsafe(run)
+        return result.result()
+
+    def stop(self):
+        if self.loop:
+            self.loop.call_soon_threadsafe(self._stopped.set)
+        if self.thread:
+            self.thread.join()
@@ -0,0 +1,275 @@
+import asyncio
+import ctypes
+import ctypes.util
+import errno
+from socket import socket, AF_INET, SOCK_DGRAM, inet_aton, inet_ntoa
+import struct
+from typing import Optional, Union
+from Packet import Address
+
+# Batched datagram I/O: recvmmsg/sendmmsg through ctypes, or a recvfrom/sendto per datagram where they're missing.
+
+BATCH_SIZE: int = 64 # datagrams read or written by a single system call.
+BUFFER_SIZE: int = 2048 # bytes, a drone datagram is much smaller.
+MSG_DONTWAIT = 0x40
+MAX_CACHED_ADDRESSES: int = 65536
+
+Datagram = tuple[Union[bytes, memoryview], Address]
+
+class _iovec(ctypes.Structure):
+    _fields_ = [("iov_base", ctypes.c_void_p), ("iov_len", ctypes.c_size_t)]
+
+class _sockaddr_in(ctypes.Structure):
+    _fields_ = [("sin_family", ctypes.c_ushort), ("sin_port", ctypes.c_uint16), ("sin_addr", ctypes.c_uint8 * 4),
+                ("sin_zero", ctypes.c_uint8 * 8)]
+
+class _msghdr(ctypes.Structure):
+    _fields_ = [("msg_name", ctypes.c_void_p), ("msg_namelen", ctypes.c_uint32), ("msg_iov", ctypes.POINTER(_iovec)),
+                ("msg_iovlen", ctypes.c_size_t), ("msg_control", ctypes.c_void_p), ("msg_controllen", ctypes.c_size_t),
+                ("msg_flags", ctypes.c_int)]
+
+class _mmsghdr(ctypes.Structure):
+    _fields_ = [("msg_hdr", _msghdr), ("msg_len", ctypes.c_uint)]
+
+# the arrays are read and written through struct on their raw memory, as an access to a field of a ctypes structure
+# costs more than the system call saved for each datagram.
+_SOCKADDR_SIZE = ctypes.sizeof(_sockaddr_in)
+_SOCKADDR = struct.Struct('=H') # sin_family, followed by port and address in network order
+_PORT_AND_ADDRESS = struct.Struct('!H4s')
+_MSG_LEN = struct.Struct('=I')
+_MSG_LEN_OFFSET = _mmsghdr.msg_len.offset
+_MMSGHDR_SIZE = ctypes.sizeof(_mmsghdr)
+_IOV_LEN = struct.Struct('N')
+_IOV_LEN_OFFSET = _iovec.iov_len.offset
+_IOVEC_SIZE = ctypes.sizeof(_iovec)
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or None, use_errno=True)
+        libc.recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int, ctypes.c_void_p]
+        libc.sendmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(_mmsghdr), ctypes.c_uint, ctypes.c_int]
+        return libc
+    except (OSError, AttributeError):
+        return None
+
+_libc = _load_libc()
+
+def is_supported(sock: socket) -> bool:
+    ''' True if the socket can use recvmmsg/sendmmsg, otherwise BatchSocket falls back to a system call for each datagram '''
+    return _libc is not None and sock.family == AF_INET
+
+
+class _Messages:
+    ''' The mmsghdr array of a direction, each message with its own buffer and source/destination address '''
+    def __init__(self, size: int, buffer_size: int):
+        self.buffers = (ctypes.c_char * (size * buffer_size))()
+        self.view = memoryview(self.buffers).cast('B')
+        self.names = (_sockaddr_in * size)()
+        self.iovecs = (_iovec * size)()
+        self.headers = (_mmsghdr * size)()
+        self.names_view = memoryview(self.names).cast('B')
+        self.iovecs_view = memoryview(self.iovecs).cast('B')
+        self.headers_view = memoryview(self.headers).cast('B')
+        base = ctypes.addressof(self.buffers)
+        for i in range(size):
+            self.iovecs[i].iov_base = base + i * buffer_size
+            self.iovecs[i].iov_len = buffer_size
+            header = self.headers[i].msg_hdr
+            header.msg_name = ctypes.addressof(self.names[i])
+            header.msg_namelen = ctypes.sizeof(_sockaddr_in)
+            header.msg_iov = ctypes.pointer(self.iovecs[i])
+            header.msg_iovlen = 1
+
+
+class BatchSocket:
+    ''' Reads and writes batches of datagrams on a non-blocking UDP socket.
+        The datagrams returned by recv_many are views on a buffer reused by the next call, so they must be consumed before it '''
+    sock: socket
+    batch_size: int
+    buffer_size: int
+    syscalls: int # system calls made, to compare the batched I/O with the fallback.
+
+    def __init__(self, sock: socket, batch_size: int = BATCH_SIZE, buffer_size: int = BUFFER_SIZE,
+                 batched: Optional[bool] = None):
+        ''' batched forces the fallback when False, by default recvmmsg/sendmmsg are used if supported '''
+        self.sock = sock
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.batched = is_supported(sock) if batched is None else batched and is_supported(sock)
+        self.syscalls = 0
+        self.addresses: dict[bytes, Address] = {} # sockaddr_in read by recvmmsg -> address
+        self.sockaddrs: dict[Address, bytes] = {} # address -> sockaddr_in written for sendmmsg
+        sock.setblocking(False)
+        if self.batched:
+            self.received = _Messages(batch_size, buffer_size)
+            self.sending = _Messages(batch_size, buffer_size)
+
+    def recv_many(self) -> list[Datagram]:
+        ''' Every datagram waiting in the socket, up to batch_size. Empty if there is none '''
+        if not self.batched:
+            return self._recv_one_by_one()
+        messages = self.received
+        # recvmmsg sets msg_namelen to the length of the source address, which is always a sockaddr_in on an AF_INET socket.
+        self.syscalls += 1
+        count = _libc.recvmmsg(self.sock.fileno(), messages.headers, self.batch_size, MSG_DONTWAIT, None)
+        if count < 0:
+            error = ctypes.get_errno()
+            if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return []
+            raise OSError(error, "recvmmsg failed")
+        datagrams = []
+        view, names, headers, addresses = messages.view, messages.names_view, messages.headers_view, self.addresses
+        for i in range(count):
+            name = bytes(names[i * _SOCKADDR_SIZE + 2:i * _SOCKADDR_SIZE + 8])
+            address = addresses.get(name)
+            if address is None:
+                address = self._address(name)
+            start = i * self.buffer_size
+            datagrams.append((view[start:start + _MSG_LEN.unpack_from(headers, i * _MMSGHDR_SIZE + _MSG_LEN_OFFSET)[0]], address))
+        return datagrams
+
+    def _address(self, name: bytes) -> Address:
+        if len(self.addresses) >= MAX_CACHED_ADDRESSES:
+            self.addresses.clear()
+        port, host = _PORT_AND_ADDRESS.unpack(name)
+        address = self.addresses[name] = (inet_ntoa(host), port)
+        return address
+
+    def _sockaddr(self, address: Address) -> bytes:
+        if len(self.sockaddrs) >= MAX_CACHED_ADDRESSES:
+            self.sockaddrs.clear()
+        host, port = address
+        sockaddr = self.sockaddrs[address] = _SOCKADDR.pack(AF_INET) + _PORT_AND_ADDRESS.pack(port, inet_aton(host)) + bytes(8)
+        return sockaddr
+
+    def _recv_one_by_one(self) -> list[Datagram]:
+        datagrams = []
+        while len(datagrams) < self.batch_size:
+            self.syscalls += 1
+            try:
+                datagrams.append(self.sock.recvfrom(self.buffer_size))
+            except (BlockingIOError, InterruptedError):
+                break
+        return datagrams
+
+    def send_many(self, datagrams: list[tuple[bytes, Address]]) -> int:
+        ''' Sends every datagram, returns how many of them the socket took. As with any UDP send, a datagram which doesn't
+            fit the socket's buffer is dropped '''
+        if not self.batched:
+            return self._send_one_by_one(datagrams)
+        sent = 0
+        messages = self.sending
+        view, names, iovecs, sockaddrs = messages.view, messages.names_view, messages.iovecs_view, self.sockaddrs
+        for first in range(0, len(datagrams), self.batch_size):
+            count = 0
+            oversized = []
+            for data, address in datagrams[first:first + self.batch_size]:
+                length = len(data)
+                if length > self.buffer_size:
+                    oversized.append((data, address))
+                    continue
+                start = count * self.buffer_size
+                view[start:start + length] = data
+                _IOV_LEN.pack_into(iovecs, count * _IOVEC_SIZE + _IOV_LEN_OFFSET, length)
+                sockaddr = sockaddrs.get(address)
+                if sockaddr is None:
+                    sockaddr = self._sockaddr(address)
+                names[count * _SOCKADDR_SIZE:(count + 1) * _SOCKADDR_SIZE] = sockaddr
+                count += 1
+            sent += self._sendmmsg(count)
+            sent += self._send_one_by_one(oversized)
+        return sent
+
+    def _sendmmsg(self, count: int) -> int:
+        ''' Sends the first count messages of the sending array. sendmmsg may take only some of them, e.g. when it's interrupted,
+            so it's called again from the first one not sent until the socket's buffer is full '''
+        sent = 0
+        headers = self.sending.headers
+        while sent < count:
+            self.syscalls += 1
+            result = _libc.sendmmsg(self.sock.fileno(), headers, count - sent, 0)
+            if result < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+                    break # the rest is dropped
+                raise OSError(error, "sendmmsg failed")
+            sent += result
+            if sent < count:
+                headers = ctypes.cast(ctypes.addressof(self.sending.headers) + sent * _MMSGHDR_SIZE, ctypes.POINTER(_mmsghdr))
+        return sent
+
+    def _send_one_by_one(self, datagrams: list[tuple[bytes, Address]]) -> int:
+        sent = 0
+        for data, address in datagrams:
+            self.syscalls += 1
+            try:
+                self.sock.sendto(data, address)
+                sent += 1
+            except (BlockingIOError, InterruptedError):
+                pass
+        return sent
+
+
+class BatchDatagramTransport:
+    ''' Serves a DatagramProtocol from a BatchSocket on an event loop, in place of the loop's own datagram transport.
+        Every datagram waiting when the socket becomes readable is read with a single system call, and the datagrams sent
+        during an iteration of the loop are written together at its end '''
+    def __init__(self, loop: asyncio.AbstractEventLoop, sock: socket, protocol: asyncio.DatagramProtocol,
+                 batched: Optional[bool] = None):
+        self.loop = loop
+        self.io = BatchSocket(sock, batched=batched)
+        self.protocol = protocol
+        self.pending: list[tuple[bytes, Address]] = []
+        self.flush_scheduled = False
+        self.closing = False
+        loop.add_reader(sock.fileno(), self._read_ready)
+        protocol.connection_made(self)
+
+    @staticmethod
+    async def create(protocol_factory, local_addr: Address,
+                     batched: Optional[bool] = None) -> tuple['BatchDatagramTransport', asyncio.DatagramProtocol]:
+        ''' The same as loop.create_datagram_endpoint(protocol_factory, local_addr=local_addr) '''
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.bind(local_addr)
+        protocol = protocol_factory()
+        transport = BatchDatagramTransport(asyncio.get_running_loop(), sock, protocol, batched)
+        return transport, protocol
+
+    def _read_ready(self):
+        for data, address in self.io.recv_many():
+            self.protocol.datagram_received(data, address)
+
+    def sendto(self, data: bytes, address: Address):
+        self.pending.append((data, address))
+        if len(self.pending) >= self.io.batch_size:
+            self._flush()
+        elif not self.flush_scheduled:
+            self.flush_scheduled = True
+            self.loop.call_soon(self._flush)
+
+    def _flush(self):
+        self.flush_scheduled = False
+        if self.pending:
+            pending, self.pending = self.pending, []
+            self.io.send_many(pending)
+
+    def get_extra_info(self, name: str, default=None):
+        if name == "sockname":
+            return self.io.sock.getsockname()
+        if name == "socket":
+            return self.io.sock
+        return default
+
+    def is_closing(self) -> bool:
+        return self.closing
+
+    def close(self):
+        if self.closing:
+            return
+        self._flush()
+        self.closing = True
+        self.loop.remove_reader(self.io.sock.fileno())
+        self.io.sock.close()
+        self.loop.call_soon(self.protocol.connection_lost, None)
@@ -0,0 +1,508 @@
+import asyncio
+import os
+import selectors
+import signal
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+from contextlib import redirect_stdout
+import logging
+from socket import *
+from threading import Thread
+from time import perf_counter, sleep
+from typing import Callable, Iterator
+from async_gateway import GatewayProtocol
+from batch_io import BatchSocket, is_supported
+from DTOs import *
+from impairment import ImpairmentConfig, ImpairmentProfile
+from journal import FleetState, Journal, replay
+from load_generator import generate_load
+from Packet import *
+from registry import DroneRegistry
+import log
+from metrics import MetricsRegistry
+import utils
+
+# Micro-benchmarks for the gateway.
+# Usage: python benchmark.py [benchmark name...]   (runs every benchmark if no name is given)
+
+GATEWAY_UDP_ADDRESS: Address = ('127.0.0.1', 8081)
+
+def ops_per_sec(function: Callable[[], object], iterations: int) -> float:
+    start = perf_counter()
+    for _ in range(iterations):
+        function()
+    return iterations / (perf_counter() - start)
+
+def print_row(*columns):
+    print("".join(str(c).ljust(22) for c in columns))
+
+def percentile(values: list[float], p: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def start_gateway(*args: str) -> subprocess.Popen:
+    ''' Runs gateway.py without packet loss and without logging every packet in a new process '''
+    gateway = subprocess.Popen([sys.executable, "gateway.py", "--no-packet-loss", "--log-level", "warning", *args],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+    sleep(1)
+    return gateway
+
+def stop_gateway(gateway: subprocess.Popen):
+    gateway.send_signal(signal.SIGINT)
+    try:
+        gateway.wait(timeout=5)
+    except subprocess.TimeoutExpired: # SIGINT was handled by a thread other than the one blocked in accept()
+        gateway.kill()
+        gateway.wait()
+
+
+def bench_packet(iterations: int = 100_000):
+    ''' Compares the legacy ":::" text format with the binary wire format '''
+    packets = {
+        "SYN": Packet.SYN(),
+        "SYNACK": Packet.SYNACK(ACK_number=1, new_port=54321),
+        "ACK": Packet.ACK(ACK_number=42),
+        "AVB": Packet.AVB(41),
+        "SHP": Packet.SHP(41, "Via dell'Università 50, Cesena"),
+    }
+    print_row("packet", "format", "bytes", "encode ops/s", "decode ops/s")
+    for name, packet in packets.items():
+        legacy = packet.encode_legacy()
+        binary = packet.encode()
+        print_row(name, "legacy", len(legacy),
+            "%.0f" % ops_per_sec(packet.encode_legacy, iterations),
+            "%.0f" % ops_per_sec(lambda: Packet.decode(legacy), iterations))
+        print_row(name, "binary", len(binary),
+            "%.0f" % ops_per_sec(packet.encode, iterations),
+            "%.0f" % ops_per_sec(lambda: Packet.decode(binary), iterations))
+
+
+def allocated_bytes(create: Callable[[int], object], count: int) -> float:
+    ''' Bytes per object of count objects made by create, kept alive together '''
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    objects = [create(i) for i in range(count)]
+    memory = tracemalloc.get_traced_memory()[0] - baseline
+    tracemalloc.stop()
+    del objects
+    return memory / count
+
+def bench_records(count: int = 100_000):
+    ''' Memory of the records the gateway keeps for each packet and drone, and how fast the packets are made.
+        bytes/object don't count the list holding them, per-drone objects (RttEstimator) are included in the drone '''
+    SHP = Packet.SHP(41, "Via Rossi 1").encode()
+    ACK = Packet.ACK(42, [(44, 46)]).encode()
+    print_row("record", "bytes/object", "ops/s")
+    print_row("Packet (decoded SHP)", "%.0f" % allocated_bytes(lambda i: Packet.decode(SHP), count),
+        "%.0f" % ops_per_sec(lambda: Packet.decode(SHP), count))
+    print_row("Packet (decoded ACK)", "%.0f" % allocated_bytes(lambda i: Packet.decode(ACK), count),
+        "%.0f" % ops_per_sec(lambda: Packet.decode(ACK), count))
+    print_row("Packet.AVB", "%.0f" % allocated_bytes(Packet.AVB, count), "%.0f" % ops_per_sec(lambda: Packet.AVB(41), count))
+    print_row("Drone",
+        "%.0f" % allocated_bytes(lambda i: Drone(i, simulated_drone_address(i), DroneState.AVAILABLE, None), count),
+        "%.0f" % ops_per_sec(lambda: Drone(1, GATEWAY_UDP_ADDRESS, DroneState.AVAILABLE, None), count))
+
+
+class FakeDatagramTransport:
+    ''' Stands in for an asyncio.DatagramTransport, keeping the last datagram sent to each address '''
+    def __init__(self):
+        self.sent: dict[Address, bytes] = {}
+
+    def sendto(self, data: bytes, address: Address):
+        self.sent[address] = data
+
+    def get_extra_info(self, name: str):
+        return ('127.0.0.1', 8081)
+
+    def close(self):
+        pass
+
+def simulated_drone_address(i: int) -> Address:
+    return ('10.%d.%d.%d' % (i >> 16 & 255, i >> 8 & 255, i & 255), 40000 + i % 20000)
+
+async def asyncio_load(drones: int, step: int):
+    connected_drones = DroneRegistry()
+    protocol = GatewayProtocol(connected_drones)
+    transport = FakeDatagramTransport()
+    protocol.connection_made(transport)
+    print_row("drones", "bytes/drone", "handshakes/s", "AVB+SHP+ACK/s")
+
+    SYN = Packet.SYN().encode()
+    ACK = Packet.ACK(1).encode()
+    AVB = Packet.AVB(1).encode()
+    tracemalloc.start()
+    baseline = tracemalloc.get_traced_memory()[0]
+    for first in range(0, drones, step):
+        addresses = [simulated_drone_address(i) for i in range(first, first + step)]
+        start = perf_counter()
+        for address in addresses:
+            protocol.datagram_received(SYN, address)
+            protocol.datagram_received(ACK, address)
+        handshakes = step / (perf_counter() - start)
+        start = perf_counter()
+        for address in addresses:
+            drone = connected_drones.get_by_address(address)
+            protocol.datagram_received(AVB, address)
+            drone.pending_shipping_requests = [ShippingRequestDTO(drone.id, "Via Rossi 1")]
+            protocol.shipping_request_added(drone)
+            protocol.datagram_received(Packet.ACK(drone.send_sequence_number).encode(), address)
+        exchanges = step / (perf_counter() - start)
+        transport.sent.clear()
+        memory = tracemalloc.get_traced_memory()[0] - baseline
+        print_row(len(connected_drones), memory // len(connected_drones), "%.0f" % handshakes, "%.0f" % exchanges)
+    tracemalloc.stop()
+    protocol.close()
+
+def bench_asyncio_load(drones: int = 10_000, step: int = 2_000):
+    ''' Drives the asyncio engine with simulated drones, showing memory per drone as the fleet grows '''
+    asyncio.run(asyncio_load(drones, step))
+
+
+def connect_simultaneously(drones: int, timeout: float = 30) -> list[float]:
+    ''' Starts the handshake of every drone at once, returns the time each drone took to receive its SYNACK '''
+    selector = selectors.DefaultSelector()
+    SYN = Packet.SYN().encode()
+    waiting: set[socket] = set()
+    for _ in range(drones):
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.setblocking(False)
+        selector.register(sock, selectors.EVENT_READ)
+        waiting.add(sock)
+    start = last_SYN = perf_counter()
+    for sock in waiting:
+        sock.sendto(SYN, GATEWAY_UDP_ADDRESS)
+    latencies: list[float] = []
+    while waiting and perf_counter() - start < timeout:
+        for key, _ in selector.select(timeout=0.1):
+            sock = key.fileobj
+            data, address = sock.recvfrom(4096)
+            packet = Packet.decode(data)
+            if packet.is_SYNACK:
+                sock.sendto(Packet.ACK(packet.seq_num + 1).encode(), address)
+                if sock in waiting:
+                    waiting.remove(sock)
+                    latencies.append(perf_counter() - start)
+        if perf_counter() - last_SYN > 1: # SYNs dropped because the backlog was full
+            last_SYN = perf_counter()
+            for sock in waiting:
+                sock.sendto(SYN, GATEWAY_UDP_ADDRESS)
+    for key in list(selector.get_map().values()):
+        key.fileobj.close()
+    selector.close()
+    return latencies
+
+def bench_connect(fleet_sizes: tuple[int, ...] = (10, 100, 500), backlogs: tuple[int, ...] = (128, 1024)):
+    ''' Time-to-connect of N drones powering on at the same time, for both gateway engines '''
+    print_row("engine", "backlog", "drones", "connected", "p50 ms", "p90 ms", "max ms")
+    for engine in ("threads", "asyncio"):
+        for backlog in backlogs:
+            for drones in fleet_sizes:
+                gateway = start_gateway("--engine", engine, "--backlog", str(backlog))
+                latencies = connect_simultaneously(drones)
+                stop_gateway(gateway)
+                print_row(engine, backlog, drones, len(latencies),
+                    "%.1f" % (percentile(latencies, 0.5) * 1000),
+                    "%.1f" % (percentile(latencies, 0.9) * 1000),
+                    "%.1f" % (max(latencies) * 1000))
+
+def bench_listeners(fleet_sizes: tuple[int, ...] = (500, 2_000), listeners: tuple[int, ...] = (1, 4), workers: int = 4):
+    ''' Time-to-connect of N drones powering on at the same time,
+        with one listener socket and with many bound with SO_REUSEPORT '''
+    print_row("engine", "listeners", "drones", "connected", "p50 ms", "p90 ms", "max ms")
+    for engine in ("threads", "sharded"):
+        for count in listeners:
+            for drones in fleet_sizes:
+                gateway = start_gateway("--engine", engine, "--workers", str(workers), "--listeners", str(count), "--backlog",
+                    str(drones))
+                latencies = connect_simultaneously(drones)
+                stop_gateway(gateway)
+                print_row(engine, count, drones, len(latencies), *("%.1f" % (value * 1000)
+                    for value in (percentile(latencies, 0.5), percentile(latencies, 0.9), max(latencies))))
+
+
+def bench_lookup(fleet_sizes: tuple[int, ...] = (10, 1_000, 10_000), iterations: int = 2_000):
+    ''' Cost of finding a drone by id: linear scan of the connected drones vs DroneRegistry '''
+    print_row("drones", "scan ops/s", "registry ops/s")
+    for drones in fleet_sizes:
+        registry = DroneRegistry()
+        for i in range(drones):
+            registry.add(Drone(registry.allocate_id(), simulated_drone_address(i), DroneState.AVAILABLE, None))
+        by_address = dict(registry.by_address)
+        last_id = drones
+        def scan():
+            for d in by_address.values():
+                if d.id == last_id:
+                    return d
+        print_row(drones,
+            "%.0f" % ops_per_sec(scan, iterations),
+            "%.0f" % ops_per_sec(lambda: registry.get_by_id(last_id), iterations))
+
+
+def submit_one_by_one(sock: socket, messages: Iterator[bytes], requests: list[ShippingRequestDTO]):
+    for request in requests:
+        utils.send_message(sock, request.encode())
+        next(messages) # the drones aren't connected, so the gateway replies to every request with an error
+
+def submit_batch(sock: socket, messages: Iterator[bytes], requests: list[ShippingRequestDTO]):
+    utils.send_message(sock, ShippingBatchDTO(1, requests).encode())
+    ShippingBatchResultDTO.decode(next(messages))
+
+def bench_batch(sizes: tuple[int, ...] = (10, 100, 1_000), repetitions: int = 5):
+    ''' Shipping requests submitted per second: one message per request vs a single ShippingBatchDTO '''
+    gateway = start_gateway()
+    sock = create_connection(('127.0.0.1', 8080))
+    messages = iter(utils.FramedReader(sock))
+    next(messages) # snapshot
+    print_row("requests", "one by one req/s", "batch req/s")
+    for size in sizes:
+        requests = [ShippingRequestDTO(1_000_000 + i, "Via Rossi %d" % i) for i in range(size)]
+        print_row(size,
+            "%.0f" % (size * ops_per_sec(lambda: submit_one_by_one(sock, messages, requests), repetitions)),
+            "%.0f" % (size * ops_per_sec(lambda: submit_batch(sock, messages, requests), repetitions)))
+    sock.close()
+    stop_gateway(gateway)
+
+
+def bench_framing(sizes: tuple[int, ...] = (100, 10_000, 1_000_000), total_bytes: int = 20_000_000):
+    ''' Messages read per second from a stream:
+        recv_one_message (two reads per message) vs FramedReader (many messages per read) '''
+    print_row("message bytes", "recv_one_message/s", "FramedReader/s")
+    for size in sizes:
+        count = max(1, total_bytes // size)
+        message = bytes(size)
+        def read(receive: Callable[[socket], None]) -> float:
+            writer, reader = socketpair()
+            def write():
+                for _ in range(count):
+                    utils.send_message(writer, message)
+                writer.close()
+            thread = Thread(target=write)
+            start = perf_counter()
+            thread.start()
+            receive(reader)
+            elapsed = perf_counter() - start
+            thread.join()
+            reader.close()
+            return count / elapsed
+        def one_at_a_time(sock: socket):
+            while utils.recv_one_message(sock) is not None:
+                pass
+        def streaming(sock: socket):
+            for _ in utils.FramedReader(sock):
+                pass
+        print_row(size, "%.0f" % read(one_at_a_time), "%.0f" % read(streaming))
+
+
+def bench_fleet(fleet_sizes: tuple[int, ...] = (100, 1_000), flight_time: tuple[float, float] = (0.5, 1)):
+    ''' A simulated fleet shipping two jobs per drone, for both gateway engines. Latencies are p50/p99 in ms '''
+    print_row("engine", "drones", "connected", "shipments/s", "SYN->SYNACK", "AVB->ACK", "job->SHP")
+    for engine in ("threads", "asyncio"):
+        for drones in fleet_sizes:
+            gateway = start_gateway("--engine", engine, "--backlog", str(drones))
+            report = asyncio.run(generate_load(drones, 2 * drones, flight_time, seed=drones))
+            stop_gateway(gateway)
+            print_row(engine, drones, report.connected, "%.1f" % report.throughput,
+                *("%.1f/%.1f" % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000) if latencies else "-"
+                    for latencies in (report.connect_latencies, report.AVB_latencies, report.dispatch_latencies)))
+
+def bench_shards(drones: int = 2_000, workers: tuple[int, ...] = (1, 2, 4, 8), flight_time: tuple[float, float] = (0.1, 0.2)):
+    ''' The sharded engine with more and more worker processes, against the asyncio engine.
+        Only as many workers as cores can help, and the simulated fleet runs on a single core too. Latencies are p50/p99 in ms '''
+    print("%d cores" % (os.cpu_count() or 1))
+    print_row("engine", "workers", "connected", "shipments/s", "SYN->SYNACK", "AVB->ACK")
+    for count in (0,) + workers:
+        gateway = start_gateway("--engine", "sharded", "--workers", str(count), "--backlog", str(drones)) if count else \
+            start_gateway("--engine", "asyncio", "--backlog", str(drones))
+        report = asyncio.run(generate_load(drones, 2 * drones, flight_time, seed=drones))
+        stop_gateway(gateway)
+        print_row("sharded" if count else "asyncio", count or "-", report.connected, "%.1f" % report.throughput,
+            *("%.1f/%.1f" % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000) if latencies else "-"
+                for latencies in (report.connect_latencies, report.AVB_latencies)))
+
+def bench_recovery(drones: int = 100, flight_time: tuple[float, float] = (0.5, 1), seed: int = 1):
+    ''' The same seeded fleet over increasingly impaired links, for both gateway engines.
+        Only the drones' side of the links is impaired.
+        Latencies are p50/p99 in ms, sent counts the datagrams of the drones including retransmissions '''
+    profiles = {
+        "none": "none",
+        "loss 5%": "loss=0.05",
+        "loss 20%": "loss=0.2",
+        "bursts": "loss=0.01,burst=0.02:0.3:0.9",
+        "delay+reorder": "delay=0.02,jitter=0.01,reorder=0.05",
+        "mixed": "loss=0.05,delay=0.02,jitter=0.01,duplicate=0.05,reorder=0.05",
+    }
+    print_row("engine", "profile", "shipments/s", "sent", "lost", "AVB->ACK", "job->SHP")
+    for engine in ("threads", "asyncio"):
+        for name, spec in profiles.items():
+            profile = ImpairmentProfile.parse(spec)
+            gateway = start_gateway("--engine", engine, "--backlog", str(drones))
+            report = asyncio.run(generate_load(drones, 2 * drones, flight_time, ImpairmentConfig(profile, profile, seed), seed))
+            stop_gateway(gateway)
+            print_row(engine, name, "%.1f" % report.throughput, report.datagrams_sent, report.datagrams_lost,
+                *("%.1f/%.1f" % (percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000) if latencies else "-"
+                    for latencies in (report.AVB_latencies, report.dispatch_latencies)))
+
+def bench_window(drones: int = 100, windows: tuple[int, ...] = (1, 4, 8), flight_time: tuple[float, float] = (0.2, 0.4),
+                 seed: int = 1):
+    ''' Stop-and-wait against windowed routes, with eight queued jobs per drone over a lossy link.
+        Latencies are p50/p99 in ms, sent counts the datagrams of the drones including retransmissions '''
+    profile = ImpairmentProfile(loss=0.05, reorder=0.05, delay=0.005)
+    print_row("engine", "window", "shipments/s", "sent", "lost", "job->SHP")
+    for engine in ("threads", "asyncio"):
+        for window in windows:
+            gateway = start_gateway("--engine", engine, "--backlog", str(drones), "--window", str(window))
+            impairment = ImpairmentConfig(profile, profile, seed)
+            report = asyncio.run(generate_load(drones, 8 * drones, flight_time, impairment, seed, window=window))
+            stop_gateway(gateway)
+            print_row(engine, window, "%.1f" % report.throughput, report.datagrams_sent, report.datagrams_lost,
+                "%.1f/%.1f" % (percentile(report.dispatch_latencies, 0.5) * 1000,
+                               percentile(report.dispatch_latencies, 0.99) * 1000))
+
+def bench_logging(iterations: int = 100_000):
+    ''' Cost of the log line of a packet: printed as the gateway used to, disabled, and written through the queue '''
+    LOG = logging.getLogger("benchmark")
+    drone_id, name = 42, "SHP"
+    with open(os.devnull, "w") as devnull:
+        with redirect_stdout(devnull):
+            printed = ops_per_sec(lambda: print("[GATEWAY]\t-->\t%s\t-->\t[DRONE %d]\n" % (name, drone_id)), iterations)
+        print_row("format", "print/s", "disabled/s", "queued/s")
+        for format in ("text", "json"):
+            log.setup("warning", format)
+            disabled = ops_per_sec(lambda: LOG.info("[GATEWAY]\t-->\t%s\t-->\t[DRONE %d]", name, drone_id,
+                                                    extra={"drone": drone_id}), iterations)
+            log.setup("info", format, os.devnull)
+            queued = ops_per_sec(lambda: LOG.info("[GATEWAY]\t-->\t%s\t-->\t[DRONE %d]", name, drone_id,
+                                                  extra={"drone": drone_id}), iterations)
+            log.stop()
+            print_row(format, "%.0f" % printed, "%.0f" % disabled, "%.0f" % queued)
+
+def bench_metrics(iterations: int = 1_000_000):
+    ''' Cost of updating the metrics on a packet path, and of rendering them for a scrape '''
+    registry = MetricsRegistry()
+    counter = registry.counter("packets_total", "Packets.", ("type",))
+    histogram = registry.histogram("latency_seconds", "Latency.")
+    print_row("counter.inc/s", "histogram.observe/s", "render/s")
+    print_row("%.0f" % ops_per_sec(lambda: counter.inc("SHP"), iterations),
+        "%.0f" % ops_per_sec(lambda: histogram.observe(0.012), iterations),
+        "%.0f" % ops_per_sec(registry.render, iterations // 100))
+
+def exchange(sender: BatchSocket, receiver: BatchSocket, datagrams: list[tuple[bytes, Address]], rounds: int):
+    for _ in range(rounds):
+        sender.send_many(datagrams)
+        received = 0
+        while received < len(datagrams):
+            received += len(receiver.recv_many())
+
+def bench_udp_io(datagrams: int = 200_000, batch_size: int = 64):
+    ''' Datagrams per second between two UDP sockets, a system call for each datagram against recvmmsg/sendmmsg '''
+    SHP = Packet.SHP(sequence_number=1, shipping_address="Via Zamboni 33, Bologna", has_more_stops=False).encode()
+    print_row("I/O", "datagrams/s", "syscalls/datagram")
+    for batched in (False, True):
+        if batched and not is_supported(socket(AF_INET, SOCK_DGRAM)):
+            print_row("recvmmsg/sendmmsg", "not supported")
+            continue
+        receiving, sending = socket(AF_INET, SOCK_DGRAM), socket(AF_INET, SOCK_DGRAM)
+        receiving.bind(('127.0.0.1', 0))
+        receiver, sender = BatchSocket(receiving, batch_size, batched=batched), BatchSocket(sending, batch_size, batched=batched)
+        batch = [(SHP, receiving.getsockname())] * batch_size
+        start = perf_counter()
+        exchange(sender, receiver, batch, datagrams // batch_size)
+        elapsed = perf_counter() - start
+        total = datagrams // batch_size * batch_size
+        print_row("recvmmsg/sendmmsg" if batched else "recvfrom/sendto", "%.0f" % (total / elapsed),
+            "%.2f" % ((sender.syscalls + receiver.syscalls) / total))
+        receiving.close()
+        sending.close()
+
+def bench_journal(fleet_sizes: tuple[int, ...] = (1_000, 10_000), transitions_per_drone: int = 5):
+    ''' Cost of journaling a transition on the packet path, and time to replay on start what a crash left (the last snapshot
+        and the records after it) and what a clean stop left (only a snapshot) '''
+    print_row("drones", "journal/s", "fsyncs", "replay ms", "snapshot replay ms")
+    for drones in fleet_sizes:
+        with tempfile.TemporaryDirectory() as directory:
+            journal = Journal(directory)
+            journal.start(FleetState())
+            fleet = [Drone(i, simulated_drone_address(i), DroneState.AVAILABLE, None) for i in range(1, drones + 1)]
+            for drone in fleet:
+                drone.pending_shipping_requests = [ShippingRequestDTO(drone.id, "Via Zamboni 33, Bologna")]
+            transitions = iter(fleet * transitions_per_drone)
+            enqueued = ops_per_sec(lambda: journal.drone(next(transitions)), drones * transitions_per_drone)
+            journal.records.put(None) # stops the writer after the records enqueued, as a crash would, without the last snapshot
+            journal.thread.join()
+            start = perf_counter()
+            state = replay(directory)
+            replayed = (perf_counter() - start) * 1000
+            assert len(state.drones) == drones
+            journal.compact()
+            start = perf_counter()
+            replay(directory)
+            print_row(drones, "%.0f" % enqueued, journal.syncs, "%.1f" % replayed, "%.1f" % ((perf_counter() - start) * 1000))
+            journal.file.close()
+
+
+def process_usage(pid: int) -> tuple[float, int]:
+    ''' CPU seconds used by a process and times its threads went to sleep waiting for something, from /proc (Linux only) '''
+    with open("/proc/%d/stat" % pid) as f:
+        fields = f.read().rsplit(")", 1)[1].split()
+    cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK") # utime + stime
+    wakeups = 0
+    for thread in os.listdir("/proc/%d/task" % pid):
+        with open("/proc/%d/task/%s/status" % (pid, thread)) as f:
+            for line in f:
+                if line.startswith("voluntary_ctxt_switches"):
+                    wakeups += int(line.split()[1])
+    return cpu, wakeups
+
+def bench_drone_idle(seconds: float = 5):
+    ''' A real drone process, first waiting for a route and then flying it: how often it wakes up and how much CPU it takes '''
+    gateway = start_gateway()
+    drone = subprocess.Popen([sys.executable, "drone.py", "--no-packet-loss", "--log-level", "warning"],
+        cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.DEVNULL)
+    sleep(1) # connected and AVAILABLE
+    print_row("phase", "seconds", "wakeups/s", "CPU ms/s")
+    def measure(phase: str):
+        cpu, wakeups = process_usage(drone.pid)
+        sleep(seconds)
+        cpu_after, wakeups_after = process_usage(drone.pid)
+        print_row(phase, seconds, "%.1f" % ((wakeups_after - wakeups) / seconds), "%.2f" % ((cpu_after - cpu) * 1000 / seconds))
+    measure("waiting for a route")
+    sock = create_connection(('127.0.0.1', 8080))
+    utils.send_message(sock, ShippingBatchDTO(1, [ShippingRequestDTO(None, "Via Rossi 1")]).encode())
+    sleep(0.5)
+    measure("flying") # a flight takes at least 7 seconds
+    sock.close()
+    drone.send_signal(signal.SIGINT)
+    drone.wait()
+    stop_gateway(gateway)
+
+
+BENCHMARKS: dict[str, Callable[[], None]] = {
+    "packet": bench_packet,
+    "records": bench_records,
+    "asyncio_load": bench_asyncio_load,
+    "connect": bench_connect,
+    "listeners": bench_listeners,
+    "lookup": bench_lookup,
+    "batch": bench_batch,
+    "framing": bench_framing,
+    "fleet": bench_fleet,
+    "shards": bench_shards,
+    "recovery": bench_recovery,
+    "window": bench_window,
+    "logging": bench_logging,
+    "metrics": bench_metrics,
+    "udp_io": bench_udp_io,
+    "journal": bench_journal,
+    "drone_idle": bench_drone_idle,
+}
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        if name not in BENCHMARKS:
+            print("Benchmark sconosciuto: %s. Disponibili: %s" % (name, ", ".join(BENCHMARKS)))
+            exit(1)
+        print("\n----- %s -----" % name)
+        BENCHMARKS[name]()
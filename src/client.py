@@ -1,11 +1,11 @@
 from queue import Queue
 import signal
 from socket import *
-from threading import Thread
+from threading import Lock, Thread
 from time import sleep
 import tkinter as tkt
 from tkinter import messagebox
-from typing import Callable
+from typing import Callable, Optional
 from DTOs import *
 import utils
 
@@ -18,6 +18,9 @@ main_window: tkt.Tk
 gateway_interface_drones_state_text: tkt.StringVar
 selected_drone_id: tkt.StringVar
 selected_shipping_address: tkt.StringVar
+gateway_send_lock = Lock() # both the GUI and the background thread send messages to the gateway.
+drone_lines: dict[int, str] = {} # local model of the drones shown on the interface: drone id -> its line of text.
+last_update_version: Optional[int] = None # None while waiting for a snapshot.
 
 dispatch_queue: Queue[Callable] = Queue(maxsize=-1)
 
@@ -65,48 +68,88 @@ def establish_connection():
             
         except error:
             gateway.close()
-            dispatch_to_main_queue(lambda: gateway_interface_drones_state_text.set("Tentativo di connessione fallito.\nSto riprovando ogni due secondi..."))
+            dispatch_to_main_queue(lambda: gateway_interface_drones_state_text.set("Tentativo di connessione fallito.\nSto "
+                "riprovando ogni due secondi..."))
             sleep(2)
 
 
+def send_to_gateway(message: bytes):
+    with gateway_send_lock:
+        utils.send_message(gateway, message)
+
+def apply_drones_update(update: DronesUpdateDTO):
+    ''' Applies the changes to the local model of the drones and shows it '''
+    global last_update_version
+
+    if update.is_snapshot:
+        drone_lines.clear()
+    elif last_update_version is None:
+        return # the snapshot requested will replace everything.
+    elif update.version != last_update_version + 1:
+        # an update went missing, the local model can't be trusted until a new snapshot arrives.
+        last_update_version = None
+        send_to_gateway(ResyncRequestDTO().encode())
+        return
+    last_update_version = update.version
+
+    for drone in update.drones:
+        drone_lines[drone.drone_id] = drone.__str__()
+    for drone_id in update.removed_drone_ids:
+        drone_lines.pop(drone_id, None)
+
+    text = "".join(line + "\n" for line in drone_lines.values())
+    dispatch_to_main_queue(lambda: gateway_interface_drones_state_text.set(text))
+
+
 def update_interface():
     global gateway, connected, gateway_interface_drones_state_text
 
     if not connected:
         establish_connection()
-    while running and connected:
-        data = utils.recv_one_message(gateway)
-        if not data:
-            def alert_and_quit():
-                global connected
-
-                messagebox.showerror("Errore", "Il Gateway si è disconnesso, termino il programma..")
-                connected = False
-                graceful_exit()
-            dispatch_to_main_queue(alert_and_quit)
-            break
+    if not running:
+        return
+    for data in utils.FramedReader(gateway):
+        if not running or not connected:
+            return
+        if DronesUpdateDTO.is_drones_update(data):
+            apply_drones_update(DronesUpdateDTO.decode(data))
+            continue
         gateway_interface_DTO = GatewayInterfaceDTO.decode(data)
         if not gateway_interface_DTO.is_error:
             dispatch_to_main_queue(lambda: gateway_interface_drones_state_text.set(gateway_interface_DTO.message))
         else:
             show_error(message=gateway_interface_DTO.message)
 
+    if running and connected:
+        def alert_and_quit():
+            global connected
+
+            messagebox.showerror("Errore", "Il Gateway si è disconnesso, termino il programma..")
+            connected = False
+            graceful_exit()
+        dispatch_to_main_queue(alert_and_quit)
+
 
 def send(event=None):
     global gateway, selected_drone_id, selected_shipping_address
     
     if entries_are_valid():
-        drone_id = int(selected_drone_id.get().strip())
+        # without an id the gateway chooses the drone
+        drone_id = int(selected_drone_id.get().strip()) if selected_drone_id.get().strip() else None
         request = ShippingRequestDTO(drone_id, selected_shipping_address.get().strip())
-        utils.send_message(gateway, request.encode())
+        send_to_gateway(request.encode())
         selected_drone_id.set("")
         selected_shipping_address.set("")
     else:
-        messagebox.showerror("Errore", "Devi scegliere un drone presente nella lista e l'indirizzo non può essere vuoto o contenere la sequenza di caratteri \":::\"")
+        messagebox.showerror("Errore",
+            "L'ID del drone deve essere un numero (o vuoto per lasciar scegliere il gateway) "
+            "e l'indirizzo non può essere vuoto, contenere la sequenza di caratteri \":::\" "
+            "o superare %d byte" % MAX_ADDRESS_LENGTH)
 
 
 def entries_are_valid() -> bool:
-    return selected_drone_id.get().isdigit() and not selected_shipping_address.get() == "" and not selected_shipping_address.get().__contains__(":::")
+    return ((selected_drone_id.get().strip() == "" or selected_drone_id.get().strip().isdigit())
+            and ShippingRequestDTO.is_valid_address(selected_shipping_address.get().strip()))
 
 
 if __name__ == "__main__":
@@ -121,7 +164,8 @@ if __name__ == "__main__":
     gateway_interface_frame.pack(fill=tkt.BOTH)
 
     gateway_interface_drones_state_text = tkt.StringVar()
-    gateway_interface_drones_state_label = tkt.Label(gateway_interface_frame, textvariable=gateway_interface_drones_state_text, justify=tkt.LEFT)
+    gateway_interface_drones_state_label = tkt.Label(gateway_interface_frame,
+        textvariable=gateway_interface_drones_state_text, justify=tkt.LEFT)
     gateway_interface_drones_state_label.pack(side=tkt.LEFT, fill=tkt.BOTH, padx=10, pady=10)
 
     input_frame = tkt.Frame(main_window)
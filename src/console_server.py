@@ -0,0 +1,190 @@
+from collections import deque
+import selectors
+from socket import *
+from threading import Lock
+from typing import Callable
+from Packet import Address
+import utils
+
+MAX_QUEUED_MESSAGES: int = 256 # messages waiting to be sent to a client before it is considered too slow.
+
+class SlowClientPolicy:
+    DROP = "drop" # the broadcasts which don't fit are dropped, the client notices the version gap and asks for a resync.
+    DISCONNECT = "disconnect"
+
+class ConsoleConnection:
+    ''' A client connected to the gateway.
+        Outgoing messages are already framed and wait in a bounded queue until the socket can accept them '''
+    sock: socket
+    address: Address
+    reader: utils.FramedReader
+    outbound: deque[memoryview]
+    dropped_messages: int
+
+    def __init__(self, sock: socket, address: Address):
+        self.sock = sock
+        self.address = address
+        self.reader = utils.FramedReader(sock)
+        self.outbound = deque()
+        self.dropped_messages = 0
+        self.closed = False
+
+
+class ConsoleServer:
+    ''' Serves every client console from a single thread with a selector.
+        Messages can be sent from any thread: they are framed once and queued on every addressed connection,
+        then the selector thread writes them as soon as each socket is writable, so a slow client never stalls the others.
+        A client whose queue already holds max_queued messages is handled according to slow_client_policy.
+        Only broadcasts can be dropped: a message sent to a single client (a snapshot, a reply) is the one the client is
+        waiting for, so it is queued anyway, and a client that lets twice max_queued messages pile up is disconnected. '''
+    max_queued: int
+    slow_client_policy: str
+    connections: dict[socket, ConsoleConnection]
+
+    def __init__(self, address: Address, on_message: Callable[[ConsoleConnection, bytes], None],
+                 on_connect: Callable[[ConsoleConnection], None] = lambda c: None,
+                 on_disconnect: Callable[[ConsoleConnection], None] = lambda c: None,
+                 max_queued: int = MAX_QUEUED_MESSAGES, slow_client_policy: str = SlowClientPolicy.DROP):
+        self.on_message = on_message
+        self.on_connect = on_connect
+        self.on_disconnect = on_disconnect
+        self.max_queued = max_queued
+        self.slow_client_policy = slow_client_policy
+        self.connections = {}
+        self.lock = Lock() # protects the outbound queues, shared with the threads which send messages.
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket(AF_INET, SOCK_STREAM)
+        self.listener.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+        self.listener.bind(address)
+        self.listener.listen()
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        # written by the other threads to wake the selector up when they queue a message
+        self.wakeup_reader, self.wakeup_writer = socketpair()
+        self.wakeup_reader.setblocking(False)
+        self.wakeup_writer.setblocking(False)
+        self.selector.register(self.wakeup_reader, selectors.EVENT_READ)
+
+    def getsockname(self) -> Address:
+        return self.listener.getsockname()
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def broadcast(self, message: bytes):
+        ''' Thread-safe: sends the message to every connected client, a too slow one may miss it '''
+        self._enqueue(list(self.connections.values()), message, droppable=True)
+
+    def send(self, connection: ConsoleConnection, message: bytes):
+        ''' Thread-safe: the message is never dropped, at worst the client is disconnected '''
+        self._enqueue([connection], message, droppable=False)
+
+    def serve(self, should_run: Callable[[], bool], poll_interval: float = 0.5):
+        while should_run():
+            for key, events in self.selector.select(poll_interval):
+                if key.fileobj is self.listener:
+                    self._accept()
+                elif key.fileobj is self.wakeup_reader:
+                    self._drain_wakeups()
+                else:
+                    connection = self.connections.get(key.fileobj)
+                    if connection and events & selectors.EVENT_READ:
+                        self._read(connection)
+                    if connection and not connection.closed and events & selectors.EVENT_WRITE:
+                        self._write(connection)
+            self._update_interests()
+
+    def close(self):
+        for connection in list(self.connections.values()):
+            self._close(connection, notify=False)
+        self.selector.close()
+        self.listener.close()
+        self.wakeup_reader.close()
+        self.wakeup_writer.close()
+
+    def _enqueue(self, connections: list[ConsoleConnection], message: bytes, droppable: bool):
+        frame = memoryview(utils.frame(message)) # encoded once, shared by every connection
+        with self.lock:
+            for connection in connections:
+                if connection.closed:
+                    continue
+                if len(connection.outbound) >= self.max_queued:
+                    if droppable and self.slow_client_policy == SlowClientPolicy.DROP:
+                        connection.dropped_messages += 1
+                        continue
+                    if self.slow_client_policy == SlowClientPolicy.DISCONNECT or len(connection.outbound) >= 2 * self.max_queued:
+                        connection.dropped_messages += 1
+                        connection.closed = True # closed by the selector thread
+                        continue
+                connection.outbound.append(frame)
+        try:
+            self.wakeup_writer.send(b'\0')
+        except (BlockingIOError, OSError):
+            pass # the selector is already going to wake up
+
+    def _drain_wakeups(self):
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+
+    def _accept(self):
+        try:
+            sock, address = self.listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        connection = ConsoleConnection(sock, address)
+        self.connections[sock] = connection
+        self.selector.register(sock, selectors.EVENT_READ)
+        self.on_connect(connection)
+
+    def _read(self, connection: ConsoleConnection):
+        try:
+            messages = connection.reader.read_messages()
+        except BlockingIOError:
+            return
+        except OSError:
+            messages = None
+        if messages is None:
+            self._close(connection)
+            return
+        for message in messages:
+            self.on_message(connection, message)
+
+    def _write(self, connection: ConsoleConnection):
+        with self.lock:
+            while connection.outbound:
+                frame = connection.outbound[0]
+                try:
+                    sent = connection.sock.send(frame)
+                except BlockingIOError:
+                    return
+                except OSError:
+                    connection.closed = True
+                    return
+                if sent < len(frame):
+                    connection.outbound[0] = frame[sent:]
+                    return
+                connection.outbound.popleft()
+
+    def _update_interests(self):
+        ''' Closes the connections marked as closed and watches for writability only the sockets which have something to send '''
+        for connection in list(self.connections.values()):
+            if connection.closed:
+                self._close(connection)
+                continue
+            events = selectors.EVENT_READ | (selectors.EVENT_WRITE if connection.outbound else 0)
+            if self.selector.get_key(connection.sock).events != events:
+                self.selector.modify(connection.sock, events)
+
+    def _close(self, connection: ConsoleConnection, notify: bool = True):
+        if connection.sock not in self.connections:
+            return
+        connection.closed = True
+        del self.connections[connection.sock]
+        self.selector.unregister(connection.sock)
+        connection.sock.close()
+        if notify:
+            self.on_disconnect(connection)
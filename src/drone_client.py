@@ -0,0 +1,334 @@
+import asyncio
+from enum import Enum, auto
+import logging
+import random
+from time import monotonic
+from typing import Callable, Hashable, Optional, Sequence
+from impairment import Impairment, ImpairedTransport, ImpairmentConfig
+from liveness import HEARTBEAT_INTERVAL
+from Packet import *
+from rtt import RttEstimator
+from timer_wheel import EventLoopDriver, RetransmissionScheduler, TimerWheel
+from window import ReceiveWindow
+
+# The drone side of the protocol as a state machine driven by datagrams and timers, so that a whole fleet of
+# simulated drones can run on a single event loop. Every drone has its own socket, the gateway tells drones apart by address.
+# A drone whose address changes (e.g. it moves to a new socket) resumes its connection with the token it got in the SYNACK,
+# and so does a restarted drone which kept its token (see drone.py).
+
+LOG = logging.getLogger("drone_client")
+
+# A leg of a flight: the seconds it lasts, then the message logged when it starts and its arguments.
+Leg = tuple[float, str, tuple]
+
+class DroneClientState(Enum):
+    CONNECTING = auto()     # SYN sent, waiting for the SYNACK
+    AVB_SENT = auto()       # AVB sent, waiting for its ACK
+    WAITING_SHP = auto()    # available, waiting for the SHPs of a route
+    SHIPPING = auto()       # flying to every stop of the route and back
+
+
+class DroneClient(asyncio.DatagramProtocol):
+    number: int # position in the fleet, only used to tell drones apart.
+    fleet: 'DroneFleet'
+    state: DroneClientState
+    transport: ImpairedTransport
+    inbound: Optional[Impairment]
+    connection_address: Optional[Address]
+    send_sequence_number: int
+    received: ReceiveWindow # SHPs received out of order, and the sequence number expected next.
+    rtt: RttEstimator
+    in_flight: Optional[Hashable] # key of the packet waiting for an ACK in the RetransmissionScheduler
+    sent_at: float # when the packet in flight was sent the first time.
+    next_heartbeat: Optional[asyncio.TimerHandle] # due HEARTBEAT_INTERVAL seconds after the last packet sent.
+    route: list[str] # the stops of the route being received or flown.
+    flight: Optional[asyncio.TimerHandle] # the end of the current leg of the route.
+    token: int # to resume the connection, NO_TOKEN until the first SYNACK unless the drone kept it from a previous run.
+    resuming: bool # a SYN with the token is waiting for the SYNACK
+
+    def __init__(self, number: int, fleet: 'DroneFleet'):
+        self.number = number
+        self.fleet = fleet
+        self.state = DroneClientState.CONNECTING
+        self.connection_address = None
+        self.send_sequence_number = 0
+        self.received = ReceiveWindow(0)
+        self.rtt = RttEstimator()
+        self.in_flight = None
+        self.sent_at = 0
+        self.next_heartbeat = None
+        self.route = []
+        self.flight = None
+        self.token = NO_TOKEN
+        self.resuming = False
+
+    def connection_made(self, transport: asyncio.DatagramTransport):
+        outbound, self.inbound = self.fleet.impairment.link()
+        self.transport = ImpairedTransport(transport, outbound, asyncio.get_running_loop())
+
+    def connect(self):
+        ''' Establishes a connection with the gateway, or resumes the one of the token if the gateway still knows it '''
+        SYN = Packet.SYN(window=self.fleet.window if self.fleet.window > 1 else None, token=self.token)
+        self.send_sequence_number += 1
+        self.send_reliably(SYN, "SYN", self.fleet.gateway_address)
+
+    async def change_port(self):
+        ''' Moves the drone to a new socket, as after a NAT rebinding or a restart of its network,
+            and resumes the connection from there.
+            The packet in flight keeps being retransmitted, the gateway accepts it once the connection has moved '''
+        outbound, inbound = self.transport.outbound, self.inbound # the impairments are the network's, not the socket's.
+        self.transport.close()
+        await self.fleet.loop.create_datagram_endpoint(lambda: self, local_addr=(self.fleet.gateway_address[0], 0))
+        self.transport.outbound, self.inbound = outbound, inbound
+        SYN = Packet.SYN(window=self.fleet.window if self.fleet.window > 1 else None, token=self.token)
+        data = SYN.encode()
+        self.resuming = True
+        self.fleet.retransmissions.send((self.number, "resume"),
+            lambda: self.send_bytes(data, "SYN", self.fleet.gateway_address), self.rtt)
+        self.fleet.timer_wheel_driver.arm()
+
+    def datagram_received(self, data: bytes, address: Address):
+        if self.inbound and self.inbound.is_lost():
+            return
+        try:
+            packet = Packet.decode(data)
+        except ValueError:
+            LOG.debug("DroneClient %d: Ignored malformed datagram", self.number)
+            return
+        if address == self.fleet.gateway_address and packet.is_SYNACK:
+            self.SYNACK_received(packet)
+        elif address == self.connection_address and packet.is_ACK:
+            self.ACK_received(packet)
+        elif address == self.connection_address and packet.is_SHP:
+            self.SHP_received(packet)
+        else:
+            LOG.debug("DroneClient %d: Ignored message from %s:\n%s", self.number, address, packet)
+
+    def SYNACK_received(self, packet: Packet):
+        if self.resuming:
+            self.resumed(packet)
+            return
+        if self.state != DroneClientState.CONNECTING:
+            # duplicate SYNACK, the ACK of the handshake was lost.
+            LOG.info("[GATEWAY]\t-->\tSYNACK\t-->\t[DRONE %d]", self.number)
+            self.send(Packet.ACK(packet.seq_num + 1), "ACK", self.fleet.gateway_address)
+            return
+        LOG.info("[GATEWAY]\t-->\tSYNACK\t-->\t[DRONE %d]", self.number)
+        self.fleet.connect_latencies.append(self.fleet.clock() - self.sent_at)
+        self.stop_retransmitting()
+        if self.token != NO_TOKEN and packet.token == self.token:
+            self.restored(packet)
+        else:
+            self.connected(packet)
+
+    def connected(self, packet: Packet):
+        self.token = packet.token or NO_TOKEN
+        self.received = ReceiveWindow(packet.seq_num + 1, packet.window or 1)
+        self.send(Packet.ACK(packet.seq_num + 1), "ACK", self.fleet.gateway_address)
+        self.connection_address = (self.fleet.gateway_address[0], packet.new_port)
+        LOG.info("connesso")
+        self.fleet.connected(self)
+        self.available()
+
+    def restored(self, packet: Packet):
+        ''' The gateway resumed the connection of a restarted drone: it goes on from the sequence numbers in the SYNACK,
+            whatever the drone was doing before restarting is lost. If the gateway already knows the drone is AVAILABLE
+            it says so, and resends the route it was sending from its first SHP,
+            so the drone waits for it instead of sending an AVB '''
+        self.received = ReceiveWindow(packet.seq_num + 1, packet.window or 1)
+        self.send_sequence_number = packet.ACK_num
+        self.connection_address = (self.fleet.gateway_address[0], packet.new_port)
+        LOG.info("Connessione ripresa")
+        if packet.route_follows:
+            self.route = []
+            self.state = DroneClientState.WAITING_SHP
+        else:
+            self.available()
+
+    def resumed(self, packet: Packet):
+        self.fleet.retransmissions.acknowledged((self.number, "resume"))
+        self.resuming = False
+        if packet.token == self.token:
+            self.fleet.resumptions += 1
+            self.connection_address = (self.fleet.gateway_address[0], packet.new_port)
+            return
+        # the gateway forgot the drone, e.g. it was silent for too long: the SYN started a new connection, as a new drone.
+        LOG.debug("DroneClient %d: Resumption refused, connected as a new drone", self.number)
+        self.stop_retransmitting(rtt_sample=False)
+        if self.flight:
+            self.flight.cancel()
+        self.send_sequence_number = 1
+        self.connected(packet)
+
+    def available(self):
+        ''' Notifies the gateway that the drone is AVAILABLE for new shipments '''
+        self.route = []
+        AVB = Packet.AVB(self.send_sequence_number)
+        self.send_sequence_number += 1
+        self.state = DroneClientState.AVB_SENT
+        self.send_reliably(AVB, "AVB", self.connection_address)
+
+    def ACK_received(self, packet: Packet):
+        if self.state != DroneClientState.AVB_SENT or packet.ACK_num != self.in_flight[1] + 1:
+            return
+        LOG.info("[GATEWAY]\t-->\tACK\t-->\t[DRONE %d]", self.number)
+        self.fleet.AVB_latencies.append(self.fleet.clock() - self.sent_at)
+        self.stop_retransmitting()
+        LOG.debug("DroneClient %d: %s", self.number, self.rtt)
+        self.state = DroneClientState.WAITING_SHP
+
+    def SHP_received(self, packet: Packet):
+        if packet.seq_num < self.received.expected:
+            if self.state in (DroneClientState.WAITING_SHP, DroneClientState.SHIPPING): # duplicate SHP, the ACK was lost.
+                self.send(self.received.ACK(), "ACK", self.connection_address)
+            return
+        if self.state == DroneClientState.AVB_SENT:
+            # the ACK of the AVB was lost, the gateway wouldn't send a shipping request if it hadn't received the AVB.
+            LOG.debug("DroneClient %d: Received SHP while waiting for the ACK, interpreting it as the lost ACK", self.number)
+            self.stop_retransmitting(rtt_sample=False)
+            self.state = DroneClientState.WAITING_SHP
+        if self.state != DroneClientState.WAITING_SHP:
+            return
+        LOG.info("[GATEWAY]\t-->\tSHP\t-->\t[DRONE %d]", self.number)
+        self.received.receive(packet)
+        route_complete = False
+        for SHP in self.received.pop_in_order():
+            self.route.append(SHP.shp_addr)
+            route_complete = not SHP.has_more_stops
+        # every SHP is acknowledged, telling the gateway which ones arrived beyond a missing one.
+        self.send(self.received.ACK(), "ACK", self.connection_address)
+        if route_complete:
+            self.state = DroneClientState.SHIPPING
+            self.fleet.shipping_started(self)
+            self.fly(self.fleet.flight_plan(self.route))
+
+    def fly(self, legs: list[Leg]):
+        ''' Simulates the flight of the route, each leg starts the next one when it ends '''
+        if not legs:
+            LOG.info("Sono tornato alla stazione")
+            self.flight = None
+            self.available()
+            return
+        seconds, message, args = legs[0]
+        LOG.info(message, *args)
+        self.flight = self.fleet.loop.call_later(seconds, self.fly, legs[1:])
+
+    # ----- SENDING -----
+    def send(self, packet: Packet, name: str, address: Address):
+        self.send_bytes(packet.encode(), name, address)
+
+    def heartbeat(self):
+        ''' Repeats the last ACK after HEARTBEAT_INTERVAL seconds of silence, so that the gateway knows the drone is alive.
+            It's also due while an AVB waits for its ACK, as its backed off retransmissions can be further apart than the
+            gateway's liveness timeout '''
+        self.next_heartbeat = None
+        if self.state != DroneClientState.CONNECTING:
+            self.send(self.received.ACK(), "HEARTBEAT", self.connection_address)
+
+    def send_bytes(self, data: bytes, name: str, address: Address):
+        # every packet postpones the heartbeat, so a drone with nothing to say only wakes up to send it.
+        if self.next_heartbeat:
+            self.next_heartbeat.cancel()
+        self.next_heartbeat = self.fleet.loop.call_later(HEARTBEAT_INTERVAL, self.heartbeat)
+        if self.transport.sendto(data, address):
+            LOG.info("[GATEWAY]\t<--\t%s\t<--\t[DRONE %d]", name, self.number)
+        else:
+            LOG.debug("[GATEWAY]\tX--\t%s\t<--\t[DRONE %d] (LOST)", name, self.number)
+
+    def send_reliably(self, packet: Packet, name: str, address: Address):
+        ''' Sends the packet and keeps retransmitting it until stop_retransmitting is called '''
+        data = packet.encode()
+        self.in_flight = (self.number, packet.seq_num)
+        self.sent_at = self.fleet.clock()
+        self.fleet.retransmissions.send(self.in_flight, lambda: self.send_bytes(data, name, address), self.rtt)
+        self.fleet.timer_wheel_driver.arm()
+
+    def stop_retransmitting(self, rtt_sample: bool = True):
+        if self.in_flight is not None:
+            self.fleet.retransmissions.acknowledged(self.in_flight, rtt_sample)
+            self.in_flight = None
+
+
+class DroneFleet:
+    ''' Many DroneClients on the same event loop, sharing the timer wheel of their retransmissions.
+        It also collects the latencies seen by the drones '''
+    gateway_address: Address
+    drones: list[DroneClient]
+    connect_latencies: list[float] # from the first SYN to the SYNACK.
+    AVB_latencies: list[float] # from the first AVB to its ACK.
+    shipments: int
+    port_changes: int
+    resumptions: int # port changes after which the gateway resumed the connection.
+
+    def __init__(self, gateway_address: Address, flight_time: tuple[float, float] = (6, 40),
+                 impairment: Optional[ImpairmentConfig] = None, seed: Optional[int] = None,
+                 on_shipping_started: Callable[[DroneClient], None] = lambda drone: None,
+                 clock: Callable[[], float] = monotonic, window: int = 1,
+                 flight_plan: Optional[Callable[[list[str]], list[Leg]]] = None,
+                 on_connected: Callable[[DroneClient], None] = lambda drone: None):
+        ''' flight_time is the range of seconds a stop takes, impairment the simulated network conditions of every drone's link,
+            window the SHPs a drone asks to receive without acknowledging each one (1 is stop-and-wait).
+            flight_plan gives the legs of the flight of a route, by default one of flight_time seconds for each stop.
+            on_connected is called when a drone gets a new connection, and so a new token '''
+        self.gateway_address = gateway_address
+        self.window = window
+        self.flight_time_range = flight_time
+        self.flight_plan = flight_plan if flight_plan else self.flight_to_every_stop
+        self.on_connected = on_connected
+        self.impairment = impairment if impairment else ImpairmentConfig()
+        self.random = random.Random(seed)
+        self.on_shipping_started = on_shipping_started
+        self.clock = clock
+        self.drones = []
+        self.connect_latencies = []
+        self.AVB_latencies = []
+        self.shipments = 0
+        self.port_changes = 0
+        self.resumptions = 0
+        self.timer_wheel = TimerWheel()
+        self.retransmissions = RetransmissionScheduler(self.timer_wheel)
+
+    async def launch(self, count: int, tokens: Sequence[int] = ()):
+        ''' Creates count drones and starts connecting them all at once. The first ones resume the connections of tokens '''
+        self.loop = asyncio.get_running_loop()
+        self.timer_wheel_driver = EventLoopDriver(self.timer_wheel, self.loop)
+        for _ in range(count):
+            _, drone = await self.loop.create_datagram_endpoint(lambda: DroneClient(len(self.drones), self),
+                local_addr=(self.gateway_address[0], 0))
+            self.drones.append(drone)
+        for drone, token in zip(self.drones, tokens):
+            drone.token = token
+        for drone in self.drones:
+            drone.connect()
+
+    def count(self, state: DroneClientState) -> int:
+        return sum(1 for d in self.drones if d.state == state)
+
+    def flight_time(self) -> float:
+        return self.random.uniform(*self.flight_time_range)
+
+    def flight_to_every_stop(self, route: list[str]) -> list[Leg]:
+        return [(self.flight_time(), "Parto per %s...", (stop,)) for stop in route]
+
+    def connected(self, drone: DroneClient):
+        self.on_connected(drone)
+
+    def shipping_started(self, drone: DroneClient):
+        ''' The drone leaves for its route, drone.route holds every stop '''
+        self.shipments += len(drone.route)
+        self.on_shipping_started(drone)
+
+    async def change_port(self):
+        ''' Moves a random connected drone to a new socket '''
+        connected = [d for d in self.drones if d.state != DroneClientState.CONNECTING and not d.resuming]
+        if connected:
+            self.port_changes += 1
+            await self.random.choice(connected).change_port()
+
+    def close(self):
+        self.retransmissions.cancel_all()
+        self.timer_wheel_driver.cancel()
+        for drone in self.drones:
+            if drone.next_heartbeat:
+                drone.next_heartbeat.cancel()
+            drone.transport.close()
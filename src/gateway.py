@@ -1,285 +1,699 @@
+import argparse
+from functools import partial
+import logging
+import os
 import signal
+from async_gateway import AsyncGateway, GatewayProtocol
+from console_server import ConsoleConnection, ConsoleServer, SlowClientPolicy, MAX_QUEUED_MESSAGES
 from DTOs import *
+from handshake import HalfOpenConnection, HalfOpenTable
+from impairment import ImpairmentConfig, ImpairmentProfile
+from jobs import ASSIGNMENT_POLICIES, JobScheduler, ShippingJob
+from journal import FSYNC_INTERVAL, FleetState, Journal, replay
+from liveness import LivenessTable
+import log
+from log import DroneLog
+import metrics
+from metrics import DUPLICATES, HANDSHAKE_LATENCY, METRICS, PACKETS_RECEIVED, ROUTE_LATENCY, packet_type
+from publisher import ConsolePublisher
+from registry import DroneRegistry, new_resumption_token
+from sharding import ShardedGateway, WorkerConfig
 from socket import *
-from threading import Thread
-from time import sleep, time
+from threading import Lock, Thread
+from time import monotonic
+from typing import Any, Callable
 from Packet import *
-import utils
-import random
+from timer_wheel import RetransmissionScheduler, TimerWheel
+from window import MAX_WINDOW, SendWindow, negotiate
 
-PRINT_DEBUG = True # set to True to print debugging infos
-SIMULATE_PACKET_LOSS = True # set to True to simulate packet loss
+LOG = logging.getLogger("gateway")
 
 TCP_ADDRESS: Address = ('127.0.0.1', 8080)
 UDP_ADDRESS: Address = ('127.0.0.1', 8081)
-ACCEPTING_DRONES_THREAD: Thread
+ACCEPTING_DRONES_THREADS: list[Thread] = [] # one for each listener socket, see --listeners.
+ASYNC_GATEWAY: Optional[AsyncGateway] = None # set when the gateway runs with the asyncio engine.
+SHARDED_GATEWAY: Optional[ShardedGateway] = None # set when the gateway runs with the sharded engine.
+TIMER_WHEEL = TimerWheel()
+# every packet waiting for an ACK, retransmitted by RETRANSMISSION_THREAD.
+RETRANSMISSIONS = RetransmissionScheduler(TIMER_WHEEL, timeout=1)
+RETRANSMISSION_THREAD: Thread
+HANDSHAKES = HalfOpenTable() # handshakes in progress, used by accept_drones.
+LIVENESS = LivenessTable() # when each connected drone was last heard of, dead drones are reaped by accept_drones.
+# simulated network conditions of the packets sent and received by the gateway.
+IMPAIRMENT = ImpairmentConfig(ImpairmentProfile(loss=0.25))
+WINDOW: int = MAX_WINDOW # the largest window granted to a drone which asks for the windowed mode, 1 disables it.
+# a route is delivered when the drone acknowledges its last stop: send_route marks it by setting CURRENTLY_SHIPPING and
+# drone_removed decides which stops go back to the jobs' queue, both holding this lock so that a route is never shipped twice.
+ROUTES_LOCK = Lock()
+# the routes being sent by send_route, by drone id: the sequence number of their first SHP and the SHPs waiting for an ACK.
+# resume_connection sends them again from the start when a drone resumes its connection. Protected by ROUTES_LOCK.
+ROUTES_IN_FLIGHT: dict[int, tuple[int, SendWindow]] = {}
 running: bool = True
-client_is_connected: bool = False
-client_socket: socket
-should_update_client_console: bool = False # used to notify the main thread that client's console needs an update.
+CONSOLE_SERVER: ConsoleServer # every connected client, served by the main thread.
 
-connected_drones: dict[Address, Drone] = {}
-
-def print_debug(string: str):
-    if PRINT_DEBUG or SIMULATE_PACKET_LOSS: print(string + "\n")
-
-def should_be_lost() -> bool:
-    return SIMULATE_PACKET_LOSS and random.randint(0, 3) < 1 # 25% probability of losing a sent packet.
+connected_drones = DroneRegistry()
+PUBLISHER = ConsolePublisher(connected_drones) # keeps client's console up to date.
+JOBS: JobScheduler # shipping requests waiting for any available drone.
+JOURNAL: Optional[Journal] = None # set with --journal, the transitions of drones and jobs to recover them after a restart.
 
 def SIGINT_handler(sig, frame):
     global running
 
     running = False
 
-    SERVER.close()
+    if ASYNC_GATEWAY:
+        ASYNC_GATEWAY.stop()
+    elif SHARDED_GATEWAY:
+        SHARDED_GATEWAY.stop()
+    else:
+        for thread in ACCEPTING_DRONES_THREADS:
+            thread.join()
+        RETRANSMISSION_THREAD.join()
+
+        for d in connected_drones.values():
+            d.thread.join()
 
-    ACCEPTING_DRONES_THREAD.join()
+    PUBLISHER.stop()
 
-    for d in connected_drones.values():
-        d.thread.join()
-        d.sock.close()
+    if JOURNAL:
+        JOURNAL.stop()
 
-    if client_is_connected:
-        client_socket.shutdown(SHUT_RDWR)
-        client_socket.close()
+    CONSOLE_SERVER.close()
 
     exit(0)
 
 signal.signal(signal.SIGINT, SIGINT_handler)
+signal.signal(signal.SIGUSR1, lambda sig, frame: log.toggle_debug())
 
 
 # ----- FUNCTIONS IMPLEMENTING DRONE PROTOCOL -----
-def drone_loop(drone: Drone):
-    ''' A loop which manages a drone workflow by checking when it's available and sending it shipping requests '''
-    global should_update_client_console
+def transmit(sock: socket, data: bytes, name: str, drone: Drone):
+    ''' Sends a packet to the drone, used by RETRANSMISSIONS to (re)transmit packets waiting for an ACK '''
+    delivered = sock.sendto(data, drone.address)
+    metrics.sent(name, delivered)
+    if delivered:
+        LOG.info("[GATEWAY]\t-->\t%s\t-->\t[DRONE %d]", name, drone.id, extra={"drone": drone.id})
+    else:
+        LOG.debug("[GATEWAY]\t-->\t%s\t--X\t[DRONE %d] (LOST)", name, drone.id, extra={"drone": drone.id})
 
-    while running:
+def decode(data: bytes, address: Address) -> Optional[Packet]:
+    ''' The packet carried by a datagram, None if it's malformed and must be dropped '''
+    try:
+        return Packet.decode(data)
+    except ValueError:
+        LOG.debug("Ignored malformed datagram from %s", address, extra={"address": address})
+        return None
+
+def drone_loop(drone: Drone):
+    ''' A loop which manages a drone workflow by checking when it's available and sending it shipping requests.
+        It ends when the app is being closed or the drone has been reaped, closing the drone's socket '''
+    while is_connected(drone):
         if drone.state != DroneState.AVAILABLE:
             check_when_drone_gets_available(drone)
-            drone.pending_shipping_request = None
+            if not is_connected(drone):
+                break
+            drone.pending_shipping_requests = []
             drone.state = DroneState.AVAILABLE
-            should_update_client_console = True
-        if drone.pending_shipping_request:
-            send_shipping_request(drone.pending_shipping_request, drone)
-            drone.state = DroneState.CURRENTLY_SHIPPING
-            should_update_client_console = True
+            drone_changed(drone)
+        if drone.pending_shipping_requests:
+            send_route(drone.pending_shipping_requests, drone)
+            if not is_connected(drone) or drone.state != DroneState.CURRENTLY_SHIPPING:
+                break
+            drone_changed(drone)
         else:
-            sleep(0.2) # just to not waste all CPU time.
-
-    print_debug("drone_loop %d:\tApp is being closed, exiting drone_loop." % drone.id)
-
-
-def accept_drones():
-    ''' Accepts new connections from drones and then starts a new thread for each drone '''
-    global connected_drones, should_update_client_console
-
-    drones_socket = socket(AF_INET, SOCK_DGRAM)
-    drones_socket.bind(UDP_ADDRESS)
+            listen_while_idle(drone)
+
+    drone.sock.close()
+    DroneLog(LOG, drone.id).debug("drone_loop %d:\tApp is being closed or the drone is dead, exiting drone_loop.", drone.id)
+
+def is_connected(drone: Drone) -> bool:
+    return running and connected_drones.get_by_id(drone.id) is drone
+
+def listen_while_idle(drone: Drone):
+    ''' Waits a bit for a shipping request, consuming the heartbeats that the drone sends meanwhile '''
+    try:
+        data, address = drone.sock.recvfrom(4096)
+    except timeout:
+        return
+    packet = decode(data, address)
+    if packet and drone.address == address:
+        LIVENESS.touch(drone)
+        PACKETS_RECEIVED.inc(packet_type(packet))
+        # a heartbeat or a duplicate, unless a restarted drone didn't know it was already AVAILABLE
+        if packet.is_AVB and packet.seq_num >= drone.expected_recv_sequence_number:
+            AVB_received(packet, drone)
+            drone_changed(drone) # the sequence number it expects has moved on
+
+
+def listener_socket(reuse_port: bool = False) -> socket:
+    ''' A socket bound to UDP_ADDRESS. With reuse_port many of them can be bound, and the kernel spreads the drones across them
+        by hashing their addresses, so a drone's datagrams always arrive at the same socket '''
+    sock = IMPAIRMENT.wrap(socket(AF_INET, SOCK_DGRAM))
+    if reuse_port:
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    sock.bind(UDP_ADDRESS)
+    sock.settimeout(0.5) # every half second check if app is being closed.
+    return sock
+
+def accept_drones(drones_socket: socket, reaper: bool = True):
+    ''' Accepts new connections from drones arriving at drones_socket and then starts a new thread for each drone.
+        Many handshakes can be in progress at the same time, they are kept in HANDSHAKES until the drone's ACK arrives.
+        With many listener sockets each one has its thread, sharing HANDSHAKES and connected_drones; only the reaper evicts
+        stale handshakes and dead drones. '''
+    global connected_drones
 
     while running:
-        drones_socket.settimeout(0.5) # every half second check if app is being closed.
+        if reaper:
+            for connection in HANDSHAKES.evict_stale():
+                LOG.debug("accept_drones: Handshake with %s timed out.", connection.drone.address,
+                    extra={"address": connection.drone.address})
+                abort_handshake(connection)
+            for drone in LIVENESS.evict_dead():
+                LOG.info("Il Drone %d non risponde da %.0f secondi, disconnesso", drone.id, LIVENESS.timeout,
+                    extra={"drone": drone.id})
+                connected_drones.remove(drone) # its drone_loop closes the socket within half a second.
+                drone_removed(drone)
+
         try:
             data, address = drones_socket.recvfrom(4096)
         except timeout:
             continue
-        
-        packet = Packet.decode(data)
-        if not packet.is_SYN:
-            print_debug("accept_drones: Ignored message from %s because it's not a SYN" % str(address))
-            break
-        
-        if address in connected_drones:
-            print_debug("accept_drones: Ignored message from %s as the drone is already connected." % str(address))
+
+        packet = decode(data, address)
+        if not packet:
+            continue
+        PACKETS_RECEIVED.inc(packet_type(packet))
+        if packet.is_SYN and packet.token and resume_connection(packet, address, drones_socket):
+            continue
+        connection = HANDSHAKES.get(address)
+        if connection:
+            drone = connection.drone
+            if packet.is_SYN: #SYNACK was lost
+                LOG.debug("accept_drones: Received duplicate SYN from %s. SYNACK was lost.", address, extra={"drone": drone.id})
+                DUPLICATES.inc("SYN")
+                RETRANSMISSIONS.retransmit_now(connection.SYNACK_key)
+            elif packet.is_ACK and HANDSHAKES.remove(address): # otherwise the reaper has just evicted it
+                # even if last handshake ACK was lost, drones_socket can't recv an AVB
+                # as it would be sent to the drone.sock, not this one.
+                # so this packet must be an ACK
+                RETRANSMISSIONS.acknowledged(connection.SYNACK_key)
+                HANDSHAKE_LATENCY.observe(HANDSHAKES.clock() - connection.started_at)
+                LOG.info("[GATEWAY]\t<--\tACK\t<--\t[DRONE %d]", drone.id, extra={"drone": drone.id})
+                connected_drones.add(drone)
+                LIVENESS.heard(drone)
+                LOG.info("Connessione stabilita con il Drone %d all'indirizzo: %s", drone.id, address,
+                    extra={"drone": drone.id, "address": address})
+                drone.thread = Thread(target=drone_loop, args=[drone])
+                drone.thread.start()
+                drone_changed(drone)
+            else:
+                LOG.debug("accept_drones: Ignored unexpected Packet from %s while waiting for ACK:\n%s", address, packet,
+                    extra={"drone": drone.id})
+        elif address in connected_drones:
+            # e.g. a duplicate ACK sent after a SYNACK retransmitted too early
+            LOG.debug("accept_drones: Ignored message from %s as the drone is already connected.", address,
+                extra={"address": address})
+        elif not packet.is_SYN:
+            LOG.debug("accept_drones: Ignored message from %s because it's not a SYN", address, extra={"address": address})
         else:
-            drone_sock = socket(AF_INET, SOCK_DGRAM)
-            drone_sock.bind(('127.0.0.1', 0))
-            drone = Drone(len(connected_drones)+1, address, DroneState.NOT_AVAILABLE, drone_sock)
-            drone.increment_expected_recv_sequence_number()
-            print("[GATEWAY]\t<--\tSYN\t<--\t[DRONE %d]\n" % drone.id)
-
-            new_port = drone_sock.getsockname()[1]
-            
-            SYNACK = Packet.SYNACK(ACK_number=packet.seq_num+1, new_port=new_port)
-            drone.increment_send_sequence_number()
-
-            while running and not address in connected_drones:
-                if not should_be_lost():
-                    drones_socket.sendto(SYNACK.encode(), address)
-                    print("[GATEWAY]\t-->\tSYNACK\t-->\t[DRONE %d]\n" % drone.id)
-                else:
-                    print_debug("[GATEWAY]\t-->\tSYNACK\t--X\t[DRONE %d] (LOST)" % drone.id)
-                start = time()
-                while running and not address in connected_drones:
-                    drones_socket.settimeout(1 - abs(time() - start))
-                    try:
-                        data, new_address = drones_socket.recvfrom(4096)
-                    except timeout:
-                        break
-                    if address != new_address:
-                        print_debug("accept_drones: Ignored message from %s while connecting with %s" % (str(new_address), str(address)))
-                    else:
-                        packet = Packet.decode(data)
-                        if packet.is_SYN: #SYNACK was lost
-                            print_debug("accept_drones: Received duplicate SYN. SYNACK was lost.")
-                            break
-                        elif packet.is_ACK:
-                            # even if last handshake ACK was lost, drones_socket can't recv an AVB as it would be sent to the drone.sock, not this one.
-                            # so this packet must be an ACK
-                            print("[GATEWAY]\t<--\tACK\t<--\t[DRONE %d]\n" % drone.id)
-                            connected_drones[address] = drone
-                            print("Connessione stabilita con il Drone %d all'indirizzo: %s\n" % (drone.id, str(address)))
-                            drone.thread = Thread(target=drone_loop, args=[drone])
-                            drone.thread.start()
-                            should_update_client_console = True
-                        else:
-                            print("ERROR while sending an AVB.\nUnexpected Packet while waiting for ACK:\n" + packet.__str__())
-                            exit(1)
+            # the threads of the other listeners add handshakes too: the backlog is checked and taken at once.
+            with HANDSHAKES.lock:
+                if HANDSHAKES.is_full():
+                    LOG.debug("accept_drones: Dropped SYN from %s, too many handshakes in progress.", address,
+                        extra={"address": address})
+                elif address not in HANDSHAKES:
+                    start_handshake(packet, address, drones_socket)
+
+    for connection in HANDSHAKES.clear(): # app is being closed
+        abort_handshake(connection)
     drones_socket.close()
 
-def send_shipping_request(request: ShippingRequestDTO, drone: Drone):
-    SHP = Packet.SHP(sequence_number=drone.send_sequence_number, shipping_address=request.shipping_address)
+def start_handshake(SYN: Packet, address: Address, drones_socket: socket):
+    ''' Answers the SYN of a new drone with a SYNACK, retransmitted until the drone's ACK, from a socket of its own '''
+    drone_sock = drone_socket()
+    drone = Drone(connected_drones.allocate_id(), address, DroneState.NOT_AVAILABLE, drone_sock)
+    drone.increment_expected_recv_sequence_number()
+    LOG.info("[GATEWAY]\t<--\tSYN\t<--\t[DRONE %d]", drone.id, extra={"drone": drone.id, "address": address})
+
+    new_port = drone_sock.getsockname()[1]
+
+    drone.window = negotiate(SYN.window, WINDOW)
+    if SYN.token is not None:
+        drone.resumption_token = new_resumption_token()
+    SYNACK = Packet.SYNACK(ACK_number=SYN.seq_num+1, new_port=new_port, window=None if SYN.window is None else drone.window,
+        token=drone.resumption_token)
     drone.increment_send_sequence_number()
-    while running:
-        if not should_be_lost():
-            drone.sock.sendto(SHP.encode(), drone.address)
-            print("[GATEWAY]\t-->\tSHP\t-->\t[DRONE %d]\n" % drone.id)
-        else:
-            print_debug("[GATEWAY]\t-->\tSHP\t--X\t[DRONE %d] (LOST)" % drone.id)
-        start = time()
-        while running:
+    SYNACK_bytes = SYNACK.encode()
+    connection = HANDSHAKES.add(drone, (address, SYNACK.seq_num))
+    RETRANSMISSIONS.send(connection.SYNACK_key, partial(transmit, drones_socket, SYNACK_bytes, "SYNACK", drone), drone.rtt)
+
+def drone_socket(port: int = 0) -> socket:
+    ''' The socket on which a drone_loop talks to its drone '''
+    sock = IMPAIRMENT.wrap(socket(AF_INET, SOCK_DGRAM))
+    sock.bind(('127.0.0.1', port))
+    sock.settimeout(0.2) # every 0.2 seconds check if app is being closed or a shipping request arrived.
+    return sock
+
+def resume_connection(packet: Packet, address: Address, drones_socket: socket) -> bool:
+    ''' Moves the connection of the drone owning the token to the address the SYN comes from,
+        its drone_loop goes on talking to the drone there. The SYNACK carries the sequence numbers of the connection.
+        Returns False if the token is unknown, the drone must connect again '''
+    drone = connected_drones.get_by_token(packet.token)
+    if not drone:
+        LOG.debug("accept_drones: Unknown resumption token from %s, starting a new connection.", address,
+            extra={"address": address})
+        return False
+    if drone.address != address:
+        LOG.info("Il Drone %d ha ripreso la connessione dall'indirizzo: %s", drone.id, address,
+            extra={"drone": drone.id, "address": address})
+        connected_drones.move(drone, address)
+        drone_moved(drone)
+    LIVENESS.touch(drone)
+    with ROUTES_LOCK:
+        # a drone resuming from a new process lost the SHPs it had already received, so the route being sent starts again.
+        next_seq_num = drone.send_sequence_number
+        if drone.id in ROUTES_IN_FLIGHT:
+            next_seq_num, window = ROUTES_IN_FLIGHT[drone.id]
+            transmit_route(drone.pending_shipping_requests, next_seq_num, window, drone)
+        # the drone is AVAILABLE until it has every stop of its route: then it waits for the SHPs instead of sending an AVB.
+        SYNACK = Packet.SYNACK(ACK_number=drone.expected_recv_sequence_number, new_port=drone.sock.getsockname()[1],
+            window=None if packet.window is None else drone.window,
+            token=drone.resumption_token, sequence_number=next_seq_num - 1, route_follows=drone.state == DroneState.AVAILABLE)
+    # it's sent once, the drone retransmits its SYN until it gets one.
+    transmit(drones_socket, SYNACK.encode(), "SYNACK", drone)
+    return True
+
+def abort_handshake(connection: HalfOpenConnection):
+    RETRANSMISSIONS.acknowledged(connection.SYNACK_key, rtt_sample=False)
+    connection.drone.sock.close()
+
+def send_route(route: list[ShippingRequestDTO], drone: Drone):
+    ''' Sends a SHP for each stop of the route without waiting for their ACKs and returns when the drone has all of them,
+        having set the drone CURRENTLY_SHIPPING '''
+    drone_log = DroneLog(LOG, drone.id)
+    window = SendWindow()
+    started_at = monotonic()
+    with ROUTES_LOCK:
+        first_seq_num = drone.send_sequence_number
+        drone.send_sequence_number += len(route)
+        transmit_route(route, first_seq_num, window, drone)
+        ROUTES_IN_FLIGHT[drone.id] = (first_seq_num, window)
+    try:
+        while is_connected(drone):
             try:
-                drone.sock.settimeout(1 - abs(time()-start))
                 data, address = drone.sock.recvfrom(4096)
             except timeout:
-                break
-            if drone.address == address:
-                packet = Packet.decode(data)
-                drone.sock.settimeout(None)
+                continue
+            packet = decode(data, address)
+            if packet and drone.address == address:
+                LIVENESS.touch(drone)
+                PACKETS_RECEIVED.inc(packet_type(packet))
                 if packet.is_ACK:
-                    print("[GATEWAY]\t<--\tACK\t<--\t[DRONE %d]\n" % drone.id)
-                    return
+                    with ROUTES_LOCK:
+                        acknowledged, lost = window.acknowledged(packet.ACK_num, packet.SACK_blocks)
+                    if not acknowledged: # duplicated ACK of a previous SHP
+                        DUPLICATES.inc("ACK")
+                        continue
+                    drone_log.info("[GATEWAY]\t<--\tACK\t<--\t[DRONE %d]", drone.id)
+                    for seq_num in acknowledged:
+                        RETRANSMISSIONS.acknowledged((drone.id, seq_num))
+                    for seq_num in lost:
+                        drone_log.debug("send_route: Drone %d: SHP %d is missing, retransmitting it", drone.id, seq_num)
+                        RETRANSMISSIONS.retransmit_now((drone.id, seq_num))
+                    if not window:
+                        ROUTE_LATENCY.observe(monotonic() - started_at)
+                        drone_log.debug("send_route: Drone %d: %s", drone.id, drone.rtt)
+                        route_delivered(route, drone)
+                        return
                 elif packet.is_AVB:
-                    if packet.seq_num < drone.expected_recv_sequence_number: # already received AVB which accumulated in the socket
-                        print_debug("send_shipping_request: ignoring accumulated AVB")
+                    # already received AVB which accumulated in the socket
+                    if packet.seq_num < drone.expected_recv_sequence_number:
+                        drone_log.debug("send_route: ignoring accumulated AVB")
+                        DUPLICATES.inc("AVB")
                         continue
                     else:
                         # ACK from drone was lost, this AVB means that the drone is available again.
+                        # a drone doesn't leave until it has every stop of its route, so the AVB acknowledges all of them.
                         # ignoring this AVB while interpreting it as the ACK
                         # drone will retransmit it and it will be catched in the appropriate function
-                        print("[GATEWAY]\t<--\tAVB\t<--\t[DRONE %d]\n" % drone.id)
-                        print_debug("send_shipping_request: Ignoring AVB and iterpreting as a lost ACK")
+                        drone_log.info("[GATEWAY]\t<--\tAVB\t<--\t[DRONE %d]", drone.id)
+                        drone_log.debug("send_route: Ignoring AVB and iterpreting as a lost ACK")
+                        route_delivered(route, drone)
                         return
                 else:
-                    print("ERROR while sending a shipping request.\nUnexpected Packet while waiting for ACK:\n" + packet.__str__())
+                    drone_log.error("ERROR while sending a shipping request.\nUnexpected Packet while waiting for ACK:\n%s",
+                        packet)
                     exit(1)
             else:
-                print_debug("send_shipping_request: Ignored message from %s while waiting for ACK from %s" % (str(address), str(drone.address)))
-    print_debug("send_shipping_request: App is being closed, exiting send_shipping_request")
+                drone_log.debug("send_route: Ignored message from %s while waiting for ACK from %s", address, drone.address)
+    finally:
+        with ROUTES_LOCK:
+            del ROUTES_IN_FLIGHT[drone.id]
+            for seq_num in window.clear():
+                RETRANSMISSIONS.acknowledged((drone.id, seq_num), rtt_sample=False)
+    drone_log.debug("send_route: App is being closed or the drone is dead, exiting send_route")
+
+def transmit_route(route: list[ShippingRequestDTO], first_seq_num: int, window: SendWindow, drone: Drone):
+    ''' (Re)sends a SHP for each stop of the route, numbered from first_seq_num,
+        forgetting the ones still waiting for an ACK in window '''
+    for seq_num in window.clear():
+        RETRANSMISSIONS.acknowledged((drone.id, seq_num), rtt_sample=False)
+    for i, request in enumerate(route):
+        SHP = Packet.SHP(sequence_number=first_seq_num + i, shipping_address=request.shipping_address,
+            has_more_stops=i < len(route) - 1)
+        window.sent(SHP.seq_num)
+        RETRANSMISSIONS.send((drone.id, SHP.seq_num), partial(transmit, drone.sock, SHP.encode(), "SHP", drone), drone.rtt)
+
+def route_delivered(route: list[ShippingRequestDTO], drone: Drone):
+    with ROUTES_LOCK:
+        if drone.pending_shipping_requests is route: # otherwise drone_removed has already queued it again
+            drone.state = DroneState.CURRENTLY_SHIPPING
 
 def check_when_drone_gets_available(drone: Drone):
-    while running:
-        drone.sock.settimeout(0.5) # every half second check if app is being closed.
+    drone_log = DroneLog(LOG, drone.id)
+    while is_connected(drone):
         try:
             data, address = drone.sock.recvfrom(4096)
         except timeout:
             continue
 
-        packet = Packet.decode(data)
+        packet = decode(data, address)
 
-        if drone.address == address:
-            # message can only be an AVB
+        if packet and drone.address == address:
+            LIVENESS.touch(drone)
+            PACKETS_RECEIVED.inc(packet_type(packet))
+            # message should be an AVB, a heartbeat or a duplicated ACK of the last SHP.
+            if not packet.is_AVB:
+                drone_log.debug("drone_loop %d:\tcheck_when_drone_gets_available: ignoring heartbeat or late packet while "
+                    "waiting for AVB", drone.id)
+                continue
             if packet.seq_num < drone.expected_recv_sequence_number:
-                print_debug("drone_loop %d:\tcheck_when_drone_gets_available: ignoring accumulated AVB")
+                drone_log.debug("drone_loop %d:\tcheck_when_drone_gets_available: ignoring accumulated AVB", drone.id)
+                DUPLICATES.inc("AVB")
                 continue
             else:
-                print("[GATEWAY]\t<--\tAVB\t<--\t[DRONE %d]\n" % drone.id)
-                drone.increment_expected_recv_sequence_number()
-                if not should_be_lost():
-                    drone.sock.sendto(Packet.ACK(packet.seq_num + 1).encode(), drone.address)
-                    print("[GATEWAY]\t-->\tACK\t-->\t[DRONE %d]" % drone.id)
-                else:
-                    print_debug("[GATEWAY]\t-->\tACK\t--X\t[DRONE %d] (LOST)\n" % drone.id)
-                drone.sock.settimeout(None)
+                AVB_received(packet, drone)
                 return
         else:
-            print_debug("drone_loop %d:\tcheck_when_drone_gets_available: Ignoring message from address: %s while waiting for AVB" % (drone.id, str(address)))
-
-    print_debug("drone_loop %d:\tcheck_when_drone_gets_available: App is being closed, exiting check_when_drone_gets_available" % drone.id)
+            drone_log.debug("drone_loop %d:\tcheck_when_drone_gets_available: Ignoring message from address: %s while waiting "
+                "for AVB", drone.id, address)
+
+    drone_log.debug("drone_loop %d:\tcheck_when_drone_gets_available: App is being closed or the drone is dead, "
+        "exiting check_when_drone_gets_available", drone.id)
+
+def AVB_received(packet: Packet, drone: Drone):
+    drone_log = DroneLog(LOG, drone.id)
+    drone_log.info("[GATEWAY]\t<--\tAVB\t<--\t[DRONE %d]", drone.id)
+    drone.increment_expected_recv_sequence_number()
+    delivered = drone.sock.sendto(Packet.ACK(packet.seq_num + 1).encode(), drone.address)
+    metrics.sent("ACK", delivered)
+    if delivered:
+        drone_log.info("[GATEWAY]\t-->\tACK\t-->\t[DRONE %d]", drone.id)
+    else:
+        drone_log.debug("[GATEWAY]\t-->\tACK\t--X\t[DRONE %d] (LOST)", drone.id)
 
 # ----- FUNCTIONS ABOUT SHIPPING REQUESTS ------
-def handle_shipping_request(request: ShippingRequestDTO):
-    drone: Drone = None
-    for d in connected_drones.values():
-        if d.id == request.drone_id:
-            drone = d
-            break
-    if drone:
-        if drone.state == DroneState.AVAILABLE:
-            drone.pending_shipping_request = request
-            print_debug("handle_shipping_request: Drone %d has new pending_shipping_request" % drone.id)
-        else:
-            send_error_message("Il Drone %d è NON DISPONIBILE." % request.drone_id)    
+def accept_shipping_request(request: ShippingRequestDTO) -> Optional[str]:
+    ''' Assigns the request to its drone, or queues it as a job if it doesn't name one.
+        Returns the error message if the drone can't take it '''
+    if not ShippingRequestDTO.is_valid_address(request.shipping_address):
+        return "L'indirizzo non può essere vuoto, contenere \":::\" o andare a capo, né superare %d byte." % MAX_ADDRESS_LENGTH
+    if request.drone_id is None:
+        job = on_engine(JOBS.submit, request.shipping_address)
+        LOG.debug("accept_shipping_request: job %d submitted, %d jobs waiting for a drone", job.job_id, len(JOBS))
+        return None
+    drone = connected_drones.get_by_id(request.drone_id)
+    if not drone:
+        return "Il Drone %d non è connesso." % request.drone_id
+    if not on_engine(JOBS.assign_to, drone, request):
+        return "Il Drone %d è NON DISPONIBILE." % request.drone_id
+    return None
+
+def on_engine(function: Callable[..., Any], *args) -> Any:
+    ''' Runs function where the engine changes the drones' state: on the event loop of the asyncio engine, that reads it
+        without locks, in the calling thread otherwise '''
+    if ASYNC_GATEWAY:
+        return ASYNC_GATEWAY.call(function, *args)
+    return function(*args)
+
+def assign_shipping_requests(drone: Drone, route: list[ShippingRequestDTO]):
+    # sets the route and sends it to the drone's worker, so that no report of the worker overwrites it meanwhile
+    if SHARDED_GATEWAY:
+        SHARDED_GATEWAY.assign_route(drone, route)
     else:
-        send_error_message("Il Drone %d non è connesso." % request.drone_id)
+        drone.pending_shipping_requests = route
+    if JOURNAL:
+        JOURNAL.drone(drone)
+    LOG.debug("assign_shipping_requests: Drone %d has a new route of %d stops", drone.id, len(route), extra={"drone": drone.id})
+    if ASYNC_GATEWAY:
+        ASYNC_GATEWAY.shipping_request_added(drone)
+
+def handle_shipping_request(request: ShippingRequestDTO, client: ConsoleConnection):
+    error = accept_shipping_request(request)
+    if error:
+        send_error_message(error, client)
+
+def handle_shipping_batch(batch: ShippingBatchDTO, client: ConsoleConnection):
+    ''' Accepts every request of the batch and replies with a single message holding the outcome of each one '''
+    result = ShippingBatchResultDTO(batch.batch_id, [accept_shipping_request(r) for r in batch.requests])
+    LOG.info("[GATEWAY]\t-->\tEsito spedizioni: %d accettate su %d\t-->\t[CLIENT %s:%s]", result.accepted, len(result.errors),
+        *client.address, extra={"client": client.address})
+    CONSOLE_SERVER.send(client, result.encode())
 
 # ----- FUNCTIONS RESPONSIBLE FOR UPDATING CLIENT'S CONSOLE ----- 
-def client_interface_text() -> str:
-    drones_state_description = ""
-    for drone_address in connected_drones:
-        drone = connected_drones[drone_address]
-        drones_state_description += "DRONE " + str(drone.id) + "\t--->   " + drone.state.__str__()
-        if drone.pending_shipping_request:
-            drones_state_description += " a \"%s\"\n" % drone.pending_shipping_request.shipping_address
-        else:
-            drones_state_description += "\n"
-    return drones_state_description
-
-def update_client_console():
-    if client_is_connected:
-        print("[GATEWAY]\t-->\tAggiornamento interfaccia\t-->\t[CLIENT]\n")
-        dto = GatewayInterfaceDTO(client_interface_text(), is_error=False)
-        utils.send_message(client_socket, dto.encode())
-
-def send_error_message(message: str):
-    if client_is_connected:
-        print("[GATEWAY]\t-->\t%s\t-->\t[CLIENT]\n" % message)
-        dto = GatewayInterfaceDTO(message, is_error=True)
-        utils.send_message(client_socket, dto.encode())
+def drone_changed(drone: Drone):
+    ''' The drone must be updated on client's console, and if it has become available it can take a queued job '''
+    if JOURNAL:
+        JOURNAL.drone(drone)
+    if drone.state == DroneState.AVAILABLE:
+        JOBS.drone_available(drone)
+    PUBLISHER.drone_changed(drone)
+
+def drone_moved(drone: Drone):
+    ''' The drone resumed its connection from another address '''
+    if JOURNAL:
+        JOURNAL.drone(drone)
+
+def drone_removed(drone: Drone):
+    ''' A dead drone has been unregistered: clients forget it and its route goes back to the jobs' queue, unless the drone
+        acknowledged every stop and left with it. A drone only leaves with a whole route, so the stops of a route it didn't
+        finish receiving go back too, even those it acknowledged '''
+    LIVENESS.remove(drone)
+    JOBS.drone_removed(drone)
+    if JOURNAL:
+        JOURNAL.drone_removed(drone)
+    with ROUTES_LOCK:
+        route = drone.pending_shipping_requests if drone.state != DroneState.CURRENTLY_SHIPPING else []
+        drone.pending_shipping_requests = []
+    for request in route:
+        JOBS.submit(request.shipping_address)
+    PUBLISHER.drone_removed(drone)
+
+def job_queued(job: ShippingJob):
+    if JOURNAL:
+        JOURNAL.job_queued(job)
+
+def jobs_dequeued(jobs: list[ShippingJob]):
+    if JOURNAL:
+        JOURNAL.jobs_dequeued(jobs)
+
+def recover(state: FleetState, engine: str):
+    ''' Registers again the drones which were connected when the gateway stopped, as the journal left them, and queues again
+        the jobs which were waiting. With the threads engine each drone gets back the port of its socket if it's still free '''
+    started = monotonic()
+    connected_drones.next_id = max(connected_drones.next_id, state.next_drone_id)
+    for record in state.drones.values():
+        sock = None
+        if engine == "threads":
+            try:
+                sock = drone_socket(record.port or 0)
+            except OSError:
+                LOG.warning("recover: port %s of Drone %d is taken, the drone won't reach its new one", record.port,
+                    record.id, extra={"drone": record.id})
+                sock = drone_socket()
+        drone = Drone(record.id, record.address, record.state, sock, record.send_sequence_number,
+            record.expected_recv_sequence_number)
+        drone.window = record.window
+        drone.resumption_token = record.resumption_token
+        drone.pending_shipping_requests = [ShippingRequestDTO(drone.id, address) for address in record.route]
+        connected_drones.add(drone)
+        LIVENESS.heard(drone)
+        if sock:
+            drone.thread = Thread(target=drone_loop, args=[drone])
+            drone.thread.start()
+    for job_id, address in state.jobs.items():
+        JOBS.restore(job_id, address)
+    for drone in connected_drones.values():
+        JOBS.drone_available(drone)
+    LOG.info("Stato ripristinato dal journal in %.1f ms: %d droni, %d spedizioni in coda", (monotonic() - started) * 1000,
+        len(state.drones), len(state.jobs))
+
+def register_metrics(retransmissions: Optional[RetransmissionScheduler]):
+    ''' The metrics read from the gateway's state when they are collected. Those of the drones' packets are only counted
+        by the threads and asyncio engines, the sharded one's are in its workers' processes '''
+    def drones_by_state() -> dict[str, float]:
+        counts = {state.name: 0 for state in DroneState}
+        for drone in connected_drones.values():
+            counts[drone.state.name] += 1
+        return counts
+    METRICS.collected("gateway_drones", "Connected drones by state.", "gauge", drones_by_state, "state")
+    if retransmissions:
+        METRICS.collected("gateway_retransmissions_total", "Packets retransmitted to the drones.", "counter",
+            lambda: {"": retransmissions.retransmitted})
+    METRICS.collected("gateway_handshakes_in_progress", "Handshakes waiting for the drone's ACK.", "gauge",
+        lambda: {"": len(HANDSHAKES)})
+    METRICS.collected("gateway_jobs_queued", "Shipping requests waiting for an available drone.", "gauge",
+        lambda: {"": len(JOBS)})
+    METRICS.collected("gateway_clients", "Connected clients.", "gauge", lambda: {"": len(CONSOLE_SERVER)})
+
+def send_error_message(message: str, client: ConsoleConnection):
+    LOG.info("[GATEWAY]\t-->\t%s\t-->\t[CLIENT %s:%s]", message, *client.address, extra={"client": client.address})
+    dto = GatewayInterfaceDTO(message, is_error=True)
+    CONSOLE_SERVER.send(client, dto.encode())
+
+def client_connected(client: ConsoleConnection):
+    LOG.info("[GATEWAY]\t<--\tConnesso\t<--\t[CLIENT %s:%s]", *client.address, extra={"client": client.address})
+    PUBLISHER.send_snapshot(client)
+
+def client_disconnected(client: ConsoleConnection):
+    LOG.info("[GATEWAY]\t<--\tDisconnesso\t<--\t[CLIENT %s:%s]", *client.address, extra={"client": client.address})
+    if client.dropped_messages:
+        LOG.debug("client_disconnected: %d messages for client %s:%s were dropped because it was too slow",
+            client.dropped_messages, *client.address, extra={"client": client.address})
+
+def client_message_received(client: ConsoleConnection, data: bytes):
+    if ResyncRequestDTO.is_resync_request(data):
+        LOG.info("[GATEWAY]\t<--\tRichiesta di risincronizzazione\t<--\t[CLIENT %s:%s]", *client.address,
+            extra={"client": client.address})
+        PUBLISHER.send_snapshot(client)
+    elif ShippingBatchDTO.is_shipping_batch(data):
+        try:
+            batch = ShippingBatchDTO.decode(data)
+        except ValueError:
+            malformed_message_received(client, data)
+            return
+        LOG.info("[GATEWAY]\t<--\t%d spedizioni\t<--\t[CLIENT %s:%s]", len(batch.requests), *client.address,
+            extra={"client": client.address})
+        handle_shipping_batch(batch, client)
+    else:
+        try:
+            shipping_request = ShippingRequestDTO.decode(data)
+        except ValueError:
+            malformed_message_received(client, data)
+            return
+        LOG.info("[GATEWAY]\t<--\tSpedizione per il Drone %s all'indirizzo: %s\t<--\t[CLIENT %s:%s]",
+            shipping_request.drone_id or "scelto dal gateway",
+            shipping_request.shipping_address, *client.address, extra={"client": client.address})
+        handle_shipping_request(shipping_request, client)
+
+def malformed_message_received(client: ConsoleConnection, data: bytes):
+    ''' Only the client which sent it gets an error, the others go on being served '''
+    LOG.debug("client_message_received: malformed message from client %s:%s: %r", *client.address, data[:100],
+        extra={"client": client.address})
+    send_error_message("Messaggio non valido, la richiesta è stata ignorata.", client)
 
 
 # ----- MAIN -----
 if __name__ == "__main__":
-    ACCEPTING_DRONES_THREAD = Thread(target=accept_drones)
-    ACCEPTING_DRONES_THREAD.start()
-
-    SERVER = socket(AF_INET, SOCK_STREAM)
-    SERVER.bind(TCP_ADDRESS)
-    
-    SERVER.listen(1)
-    print("\n\nGateway attivo su %s:%s\n" % SERVER.getsockname())
-
-    while True:
-        client_socket, client_address = SERVER.accept()
-        client_is_connected = True
-        should_update_client_console = True
-        print("[GATEWAY]\t<--\tConnesso\t<--\t[CLIENT]\n")
-
-        while True:
-            if should_update_client_console:
-                should_update_client_console = False
-                update_client_console()
-            client_socket.settimeout(0.5)
-            try:
-                data = utils.recv_one_message(client_socket)
-            except timeout:
-                continue
-            client_socket.settimeout(None)
-            if data:
-                shipping_request = ShippingRequestDTO.decode(data)
-                print("[GATEWAY]\t<--\tSpedizione per il Drone %d all'indirizzo: %s\t<--\t[CLIENT]\n" % (shipping_request.drone_id, shipping_request.shipping_address))
-                handle_shipping_request(shipping_request)
-            else:
-                print("[GATEWAY]\t<--\tDisconnesso\t<--\t[CLIENT]\n")
-                client_is_connected = False
-                client_socket.close()
-                break
+    parser = argparse.ArgumentParser(description="Gateway for the drones")
+    parser.add_argument("--engine", choices=["threads", "asyncio", "sharded"], default="threads",
+        help="threads: one thread and one socket for each drone. "
+            "asyncio: every drone is served by a single socket on an event loop. "
+            "sharded: the drones are partitioned across --workers processes, each one like the asyncio engine.")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1,
+        help="sharded engine only: number of worker processes. Default: one for each core.")
+    parser.add_argument("--listeners", type=int, default=1,
+        help="threads and sharded engines: sockets bound to the drones' address with SO_REUSEPORT, "
+            "the kernel spreads the handshakes across them. threads: each one is read by its own thread. "
+            "sharded: any value above 1 gives every worker its own socket, instead of the coordinator passing the handshakes.")
+    parser.add_argument("--batch-io", action="store_true",
+        help="asyncio and sharded engines only: reads and writes many datagrams with a single system call (recvmmsg/sendmmsg) "
+            "where available.")
+    parser.add_argument("--backlog", type=int, default=HANDSHAKES.backlog,
+        help="maximum number of handshakes in progress at the same time.")
+    parser.add_argument("--handshake-timeout", type=float, default=HANDSHAKES.timeout,
+        help="seconds after which an incomplete handshake is dropped.")
+    parser.add_argument("--liveness-timeout", type=float, default=LIVENESS.timeout,
+        help="seconds without hearing from a drone after which it is disconnected.")
+    parser.add_argument("--update-window", type=float, default=PUBLISHER.window,
+        help="seconds during which drone changes are collected into a single update of client's console.")
+    parser.add_argument("--assignment", choices=list(ASSIGNMENT_POLICIES), default="fifo",
+        help="which available drone gets a request that doesn't name one. fifo: the one available for the longest time. "
+            "lru: the one whose last shipping is the oldest. shortest-idle: the one which has just become available.")
+    parser.add_argument("--window", type=int, default=WINDOW,
+        help="the most SHPs sent to a drone without waiting for their ACKs, i.e. the most stops of a route. "
+            "Drones which don't ask for it, or 1, use stop-and-wait.")
+    parser.add_argument("--client-queue", type=int, default=MAX_QUEUED_MESSAGES,
+        help="messages queued for a client before it is considered too slow.")
+    parser.add_argument("--slow-clients", choices=[SlowClientPolicy.DROP, SlowClientPolicy.DISCONNECT],
+        default=SlowClientPolicy.DROP,
+        help="drop: updates for a too slow client are dropped and it will ask for a resync, "
+            "replies and snapshots are always sent. disconnect: a too slow client is disconnected.")
+    parser.add_argument("--impair-send", type=ImpairmentProfile.parse, default=IMPAIRMENT.outbound, metavar="PROFILE",
+        help="simulated impairment of the packets sent to the drones, e.g. "
+            "\"loss=0.05,burst=0.01:0.3:0.9,delay=0.02,jitter=0.005,duplicate=0.01,reorder=0.02\". Default: %(default)s.")
+    parser.add_argument("--impair-recv", type=ImpairmentProfile.parse, default=IMPAIRMENT.inbound, metavar="PROFILE",
+        help="simulated impairment of the packets received from the drones (losses only). Default: %(default)s.")
+    parser.add_argument("--seed", type=int, default=None, help="seed of the simulated impairments, to reproduce a run.")
+    parser.add_argument("--no-packet-loss", action="store_true", help="don't simulate any impairment.")
+    parser.add_argument("--journal", default=None, metavar="DIR",
+        help="journals drones and jobs in this directory, and on start recovers the ones journaled by the last run.")
+    parser.add_argument("--fsync-interval", type=float, default=FSYNC_INTERVAL,
+        help="seconds between two syncs of the journal to disk, the transitions a crash can lose.")
+    parser.add_argument("--metrics-port", type=int, default=None, metavar="PORT",
+        help="serves the metrics in the Prometheus text format at http://127.0.0.1:PORT/metrics.")
+    parser.add_argument("--metrics-file", default=None, metavar="PATH",
+        help="writes the metrics in the Prometheus text format to this file every --metrics-interval seconds.")
+    parser.add_argument("--metrics-interval", type=float, default=5, help="seconds between two writes of --metrics-file.")
+    log.add_arguments(parser)
+    args = parser.parse_args()
+    if args.engine == "sharded" and args.journal:
+        parser.error("--journal isn't supported by the sharded engine")
+    if args.engine == "asyncio" and args.listeners > 1:
+        parser.error("--listeners isn't supported by the asyncio engine, which reads every drone from a single socket")
+    log.setup(args.log_level, args.log_format, args.log_file)
+    HANDSHAKES.backlog = args.backlog
+    HANDSHAKES.timeout = args.handshake_timeout
+    LIVENESS.timeout = args.liveness_timeout
+    PUBLISHER.window = args.update_window
+    WINDOW = args.window
+    JOBS = JobScheduler(assign_shipping_requests, ASSIGNMENT_POLICIES[args.assignment], on_queued=job_queued,
+        on_dequeued=jobs_dequeued)
+    IMPAIRMENT = ImpairmentConfig(args.impair_send, args.impair_recv,
+        args.seed) if not args.no_packet_loss else ImpairmentConfig()
+    if args.journal:
+        JOURNAL = Journal(args.journal, args.fsync_interval)
+        state = replay(args.journal)
+        recover(state, args.engine)
+        JOURNAL.start(state)
+
+    if args.engine == "asyncio":
+        ASYNC_GATEWAY = AsyncGateway(UDP_ADDRESS, GatewayProtocol(connected_drones, HANDSHAKES, drone_changed, IMPAIRMENT, WINDOW,
+            LIVENESS, drone_removed, drone_moved), args.batch_io)
+        ASYNC_GATEWAY.start()
+    elif args.engine == "sharded":
+        SHARDED_GATEWAY = ShardedGateway(UDP_ADDRESS, args.workers, WorkerConfig(args.backlog, args.handshake_timeout,
+            args.liveness_timeout,
+            IMPAIRMENT, WINDOW, args.batch_io, args.listeners > 1, args.log_level, args.log_format, args.log_file),
+            connected_drones, drone_changed, drone_removed, drone_moved)
+        SHARDED_GATEWAY.start()
+    else:
+        RETRANSMISSION_THREAD = Thread(target=TIMER_WHEEL.run, args=[lambda: running])
+        RETRANSMISSION_THREAD.start()
+        for i in range(args.listeners):
+            ACCEPTING_DRONES_THREADS.append(Thread(target=accept_drones, args=[listener_socket(args.listeners > 1), i == 0]))
+        for thread in ACCEPTING_DRONES_THREADS:
+            thread.start()
+
+    PUBLISHER.start()
+
+    CONSOLE_SERVER = ConsoleServer(TCP_ADDRESS, client_message_received, client_connected, client_disconnected,
+        args.client_queue, args.slow_clients)
+    PUBLISHER.server = CONSOLE_SERVER
+    register_metrics(ASYNC_GATEWAY.protocol.retransmissions if ASYNC_GATEWAY else None if SHARDED_GATEWAY else RETRANSMISSIONS)
+    if args.metrics_port is not None:
+        metrics.serve((TCP_ADDRESS[0], args.metrics_port))
+    if args.metrics_file:
+        metrics.write_periodically(args.metrics_file, args.metrics_interval)
+    LOG.info("\n\nGateway attivo su %s:%s", *CONSOLE_SERVER.getsockname())
+    CONSOLE_SERVER.serve(lambda: running)
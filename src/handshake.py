@@ -0,0 +1,79 @@
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from typing import Callable, Hashable, Optional
+from DTOs import *
+from Packet import Address
+
+SYN_BACKLOG: int = 128 # maximum number of handshakes in progress at the same time.
+HANDSHAKE_TIMEOUT: float = 10 # seconds after which a handshake which didn't complete is evicted.
+
+class HalfOpenConnection:
+    ''' A handshake in progress: SYNACK sent, waiting for the drone's ACK '''
+    drone: Drone
+    SYNACK_key: Hashable # key of the SYNACK in the RetransmissionScheduler
+    started_at: float
+
+    def __init__(self, drone: Drone, SYNACK_key: Hashable, started_at: float):
+        self.drone = drone
+        self.SYNACK_key = SYNACK_key
+        self.started_at = started_at
+
+
+class HalfOpenTable:
+    ''' Every handshake in progress, like the SYN backlog of a TCP listener.
+        It holds at most backlog handshakes: a SYN received while it is full should be dropped, the drone will retransmit it.
+        Handshakes are kept in arrival order so the stale ones are always at the front.
+        It can be shared by the threads reading several listener sockets, so that a SYN is recognized as a duplicate by any of
+        them. '''
+    backlog: int
+    timeout: float
+    connections: OrderedDict[Address, HalfOpenConnection]
+
+    def __init__(self, backlog: int = SYN_BACKLOG, timeout: float = HANDSHAKE_TIMEOUT, clock: Callable[[], float] = monotonic):
+        self.backlog = backlog
+        self.timeout = timeout
+        self.clock = clock
+        self.connections = OrderedDict()
+        self.lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self.connections)
+
+    def __contains__(self, address: Address) -> bool:
+        return address in self.connections
+
+    def get(self, address: Address) -> Optional[HalfOpenConnection]:
+        return self.connections.get(address)
+
+    def is_full(self) -> bool:
+        return len(self.connections) >= self.backlog
+
+    def add(self, drone: Drone, SYNACK_key: Hashable) -> HalfOpenConnection:
+        connection = HalfOpenConnection(drone, SYNACK_key, self.clock())
+        with self.lock:
+            self.connections[drone.address] = connection
+        return connection
+
+    def remove(self, address: Address) -> Optional[HalfOpenConnection]:
+        with self.lock:
+            return self.connections.pop(address, None)
+
+    def evict_stale(self) -> list[HalfOpenConnection]:
+        ''' Removes and returns the handshakes started more than timeout seconds ago '''
+        evicted: list[HalfOpenConnection] = []
+        with self.lock:
+            deadline = self.clock() - self.timeout
+            while self.connections:
+                address, connection = next(iter(self.connections.items()))
+                if connection.started_at > deadline:
+                    break
+                del self.connections[address]
+                evicted.append(connection)
+        return evicted
+
+    def clear(self) -> list[HalfOpenConnection]:
+        with self.lock:
+            connections = list(self.connections.values())
+            self.connections.clear()
+        return connections
@@ -0,0 +1,251 @@
+import asyncio
+import heapq
+from itertools import count
+import random
+from socket import socket
+from threading import Condition, Thread
+from time import monotonic
+from typing import Callable, Optional
+from Packet import Address
+
+# Simulated network impairments of the sockets of gateway and drones: losses, delays, duplicates and reordering.
+# Every random choice comes from a seeded generator, so a run can be reproduced.
+
+class ImpairmentProfile:
+    ''' How a direction of a link is impaired.
+        Losses follow a Gilbert-Elliott model: the link is either good, losing datagrams with probability loss, or bad,
+        losing them with probability bad_loss. It turns bad with probability burst_start and good again with probability burst_end
+        at every datagram, so losses come in bursts. With burst_start = 0 losses are independent.
+        Every delivered datagram is delayed by delay plus or minus a uniform jitter; with probability reorder it is held back
+        by reorder_delay more, letting the following datagrams overtake it,
+        and with probability duplicate it is delivered twice. '''
+    loss: float
+    burst_start: float
+    burst_end: float
+    bad_loss: float
+    delay: float # seconds
+    jitter: float # seconds
+    duplicate: float
+    reorder: float
+    reorder_delay: float # seconds
+
+    def __init__(self, loss: float = 0, burst_start: float = 0, burst_end: float = 1, bad_loss: float = 1,
+                 delay: float = 0, jitter: float = 0, duplicate: float = 0, reorder: float = 0, reorder_delay: float = 0.05):
+        self.loss = loss
+        self.burst_start = burst_start
+        self.burst_end = burst_end
+        self.bad_loss = bad_loss
+        self.delay = delay
+        self.jitter = jitter
+        self.duplicate = duplicate
+        self.reorder = reorder
+        self.reorder_delay = reorder_delay
+
+    @property
+    def is_perfect(self) -> bool:
+        return (self.loss == 0 and self.burst_start == 0 and self.delay == 0 and self.jitter == 0 and self.duplicate == 0
+                and self.reorder == 0)
+
+    @property
+    def delays_datagrams(self) -> bool:
+        return self.delay > 0 or self.jitter > 0 or self.reorder > 0
+
+    @staticmethod
+    def parse(spec: str) -> 'ImpairmentProfile':
+        ''' Reads a profile written as comma separated key=value pairs,
+            e.g. "loss=0.05,burst=0.01:0.3:0.9,delay=0.02,jitter=0.005".
+            Keys are loss, burst (burst_start:burst_end:bad_loss), delay, jitter, duplicate, reorder and reorder_delay;
+            "none" is a perfect link '''
+        profile = ImpairmentProfile()
+        if spec.strip() in ("", "none"):
+            return profile
+        for item in spec.split(","):
+            key, _, value = item.partition("=")
+            key = key.strip()
+            if key == "burst":
+                profile.burst_start, profile.burst_end, profile.bad_loss = (float(v) for v in value.split(":"))
+            elif key in ("loss", "delay", "jitter", "duplicate", "reorder", "reorder_delay"):
+                setattr(profile, key, float(value))
+            else:
+                raise ValueError("Impairment sconosciuto: %s" % key)
+        return profile
+
+    def __str__(self) -> str:
+        if self.is_perfect:
+            return "none"
+        return "loss=%g,burst=%g:%g:%g,delay=%g,jitter=%g,duplicate=%g,reorder=%g,reorder_delay=%g" % (self.loss,
+            self.burst_start, self.burst_end, self.bad_loss, self.delay, self.jitter, self.duplicate, self.reorder,
+            self.reorder_delay)
+
+
+class Impairment:
+    ''' Decides the fate of every datagram crossing a direction of a link '''
+    profile: ImpairmentProfile
+    random: random.Random
+    bad: bool # state of the Gilbert-Elliott model.
+    sent: int
+    lost: int
+    duplicated: int
+
+    def __init__(self, profile: ImpairmentProfile, seed: Optional[int] = None):
+        self.profile = profile
+        self.random = random.Random(seed)
+        self.bad = False
+        self.sent = 0
+        self.lost = 0
+        self.duplicated = 0
+
+    def is_lost(self) -> bool:
+        self.sent += 1
+        p = self.profile
+        if p.burst_start:
+            self.bad = self.random.random() >= p.burst_end if self.bad else self.random.random() < p.burst_start
+        lost = self.random.random() < (p.bad_loss if self.bad else p.loss)
+        if lost:
+            self.lost += 1
+        return lost
+
+    def delays(self) -> list[float]:
+        ''' Seconds after which each copy of the datagram is delivered: empty if it's lost, two if it's duplicated '''
+        if self.profile.is_perfect:
+            self.sent += 1
+            return [0]
+        if self.is_lost():
+            return []
+        copies = 1
+        if self.random.random() < self.profile.duplicate:
+            copies = 2
+            self.duplicated += 1
+        return [self._delay() for _ in range(copies)]
+
+    def _delay(self) -> float:
+        p = self.profile
+        delay = p.delay + (self.random.uniform(-p.jitter, p.jitter) if p.jitter else 0)
+        if p.reorder and self.random.random() < p.reorder:
+            delay += p.reorder_delay
+        return max(0, delay)
+
+
+class ImpairmentConfig:
+    ''' The profiles of both directions of every link of a process,
+        and the seed from which the generator of each link is drawn '''
+    outbound: ImpairmentProfile
+    inbound: ImpairmentProfile
+
+    def __init__(self, outbound: Optional[ImpairmentProfile] = None, inbound: Optional[ImpairmentProfile] = None,
+                 seed: Optional[int] = None):
+        self.outbound = outbound if outbound else ImpairmentProfile()
+        self.inbound = inbound if inbound else ImpairmentProfile()
+        self.seeds = random.Random(seed)
+        self.delay_line: Optional[DelayLine] = None # shared by every socket
+
+    @property
+    def is_perfect(self) -> bool:
+        return self.outbound.is_perfect and self.inbound.is_perfect
+
+    def link(self) -> tuple[Impairment, Optional[Impairment]]:
+        ''' The impairments of a new link, outbound and inbound (None if the inbound direction is perfect) '''
+        outbound = Impairment(self.outbound, self.seeds.getrandbits(64))
+        inbound = Impairment(self.inbound, self.seeds.getrandbits(64))
+        return outbound, (None if self.inbound.is_perfect else inbound)
+
+    def inbound_link(self) -> Optional[Impairment]:
+        ''' The inbound impairment of a new link whose datagrams arrive at a socket shared with other links,
+            None if it's perfect '''
+        if self.inbound.is_perfect:
+            return None
+        return Impairment(self.inbound, self.seeds.getrandbits(64))
+
+    def wrap(self, sock: socket) -> 'ImpairedSocket':
+        if not self.delay_line and self.outbound.delays_datagrams:
+            self.delay_line = DelayLine()
+        return ImpairedSocket(sock, *self.link(), self.delay_line)
+
+
+class DelayLine:
+    ''' Calls callbacks after a delay from a background thread, used to deliver the delayed datagrams of blocking sockets '''
+    def __init__(self, clock: Callable[[], float] = monotonic):
+        self.clock = clock
+        self.pending: list[tuple[float, int, Callable[[], None]]] = []
+        self.order = count() # keeps callbacks with the same deadline in order
+        self.condition = Condition()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, delay: float, callback: Callable[[], None]):
+        with self.condition:
+            heapq.heappush(self.pending, (self.clock() + delay, next(self.order), callback))
+            self.condition.notify()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while not self.pending or self.pending[0][0] > self.clock():
+                    self.condition.wait(self.pending[0][0] - self.clock() if self.pending else None)
+                _, _, callback = heapq.heappop(self.pending)
+            try:
+                callback()
+            except OSError:
+                pass # the socket has been closed meanwhile
+
+
+class ImpairedSocket:
+    ''' A UDP socket whose outgoing datagrams go through outbound and incoming ones may be dropped by inbound.
+        sendto returns False if the datagram was lost, every other method is the socket's '''
+    sock: socket
+    outbound: Impairment
+    inbound: Optional[Impairment]
+
+    def __init__(self, sock: socket, outbound: Impairment, inbound: Optional[Impairment] = None,
+                 delay_line: Optional[DelayLine] = None):
+        self.sock = sock
+        self.outbound = outbound
+        self.inbound = inbound
+        self.delay_line = delay_line
+
+    def sendto(self, data: bytes, address: Address) -> bool:
+        delays = self.outbound.delays()
+        for delay in delays:
+            if delay == 0:
+                self.sock.sendto(data, address)
+            else:
+                if not self.delay_line:
+                    self.delay_line = DelayLine()
+                self.delay_line.schedule(delay, lambda: self.sock.sendto(data, address))
+        return bool(delays)
+
+    def recvfrom(self, bufsize: int) -> tuple[bytes, Address]:
+        while True:
+            data, address = self.sock.recvfrom(bufsize)
+            if not self.inbound or not self.inbound.is_lost():
+                return data, address
+
+    def __getattr__(self, name: str):
+        return getattr(self.sock, name)
+
+
+class ImpairedTransport:
+    ''' The same as ImpairedSocket for an asyncio.DatagramTransport, delayed datagrams are sent by the event loop '''
+    transport: asyncio.DatagramTransport
+    outbound: Impairment
+
+    def __init__(self, transport: asyncio.DatagramTransport, outbound: Impairment, loop: asyncio.AbstractEventLoop):
+        self.transport = transport
+        self.outbound = outbound
+        self.loop = loop
+
+    def sendto(self, data: bytes, address: Address) -> bool:
+        delays = self.outbound.delays()
+        for delay in delays:
+            if delay == 0:
+                self.transport.sendto(data, address)
+            else:
+                self.loop.call_later(delay, self._send_later, data, address)
+        return bool(delays)
+
+    def _send_later(self, data: bytes, address: Address):
+        if not self.transport.is_closing():
+            self.transport.sendto(data, address)
+
+    def __getattr__(self, name: str):
+        return getattr(self.transport, name)
@@ -0,0 +1,150 @@
+from collections import deque
+import heapq
+from itertools import count
+from threading import RLock
+from time import monotonic
+from typing import Callable, Optional
+from DTOs import *
+
+# Shipping requests which don't name a drone are queued as jobs and assigned by the gateway to the available drones.
+
+class AvailableDrone:
+    ''' Entry of a drone in the available drones' heap '''
+    drone: Drone
+    available_since: float
+    last_assigned_at: float # -inf if the drone never had a job.
+    priority: tuple
+
+    def __init__(self, drone: Drone, available_since: float, last_assigned_at: float):
+        self.drone = drone
+        self.available_since = available_since
+        self.last_assigned_at = last_assigned_at
+
+    def __lt__(self, other: 'AvailableDrone') -> bool:
+        return self.priority < other.priority
+
+
+# An assignment policy gives the priority of an available drone: the one with the lowest priority gets the next job.
+AssignmentPolicy = Callable[[AvailableDrone], tuple]
+
+ASSIGNMENT_POLICIES: dict[str, AssignmentPolicy] = {
+    "fifo": lambda d: (d.available_since,), # the drone available for the longest time.
+    # the drone whose last job is the oldest, drones which never had one come first.
+    "lru": lambda d: (d.last_assigned_at, d.available_since),
+    # the drone which has just become available, so the others can stay idle longer.
+    "shortest-idle": lambda d: (-d.available_since,),
+}
+
+class ShippingJob:
+    job_id: int
+    shipping_address: str
+    queued_at: float
+
+    def __init__(self, job_id: int, shipping_address: str, queued_at: float):
+        self.job_id = job_id
+        self.shipping_address = shipping_address
+        self.queued_at = queued_at
+
+
+class JobScheduler:
+    ''' Assigns the queued jobs to the available drones.
+        A job goes to an available drone chosen by the policy as soon as it is submitted, otherwise it waits in FIFO order
+        and goes to the first drone which becomes available. So jobs and available drones are never both waiting.
+        A drone which negotiated a window takes as many of the waiting jobs as its window, as the stops of a single route.
+        Available drones are kept in a heap ordered by the policy; entries of drones which stopped being available are
+        discarded lazily when they reach the top. '''
+    policy: AssignmentPolicy
+    jobs: deque[ShippingJob]
+    available: list[AvailableDrone]
+    entries: dict[int, AvailableDrone] # the valid heap entry of every available drone, by drone id.
+    last_assigned_at: dict[int, float]
+
+    def __init__(self, assign: Callable[[Drone, list[ShippingRequestDTO]], None],
+                 policy: AssignmentPolicy = ASSIGNMENT_POLICIES["fifo"],
+                 clock: Callable[[], float] = monotonic,
+                 on_queued: Callable[[ShippingJob], None] = lambda job: None,
+                 on_dequeued: Callable[[list[ShippingJob]], None] = lambda jobs: None):
+        ''' assign is called (with the lock held) to hand a route, i.e. one or more requests, to a drone.
+            on_queued and on_dequeued are called (with the lock held) when jobs start and stop waiting for a drone '''
+        self.assign = assign
+        self.policy = policy
+        self.clock = clock
+        self.on_queued = on_queued
+        self.on_dequeued = on_dequeued
+        self.jobs = deque()
+        self.available = []
+        self.entries = {}
+        self.last_assigned_at = {}
+        self.job_ids = count(1)
+        self.lock = RLock()
+
+    def __len__(self) -> int:
+        ''' Number of jobs waiting for a drone '''
+        return len(self.jobs)
+
+    def submit(self, shipping_address: str) -> ShippingJob:
+        with self.lock:
+            job = ShippingJob(next(self.job_ids), shipping_address, self.clock())
+            drone = self._pop_available()
+            if drone:
+                self._assign(drone, [job])
+            else:
+                self.jobs.append(job)
+                self.on_queued(job)
+            return job
+
+    def restore(self, job_id: int, shipping_address: str):
+        ''' Queues again a job which was waiting when the gateway stopped, keeping its id '''
+        with self.lock:
+            self.jobs.append(ShippingJob(job_id, shipping_address, self.clock()))
+            self.job_ids = count(max(job_id + 1, next(self.job_ids)))
+
+    def assign_to(self, drone: Drone, request: ShippingRequestDTO) -> bool:
+        ''' Assigns a request which names its drone. Returns False if the drone isn't free '''
+        with self.lock:
+            if not self._is_free(drone):
+                return False
+            self.entries.pop(drone.id, None)
+            self.last_assigned_at[drone.id] = self.clock()
+            self.assign(drone, [request])
+            return True
+
+    def drone_available(self, drone: Drone):
+        ''' The drone is free: gives it the oldest job or waits for one '''
+        with self.lock:
+            if not self._is_free(drone) or drone.id in self.entries:
+                return
+            if self.jobs:
+                jobs = [self.jobs.popleft() for _ in range(min(drone.window, len(self.jobs)))]
+                self.on_dequeued(jobs)
+                self._assign(drone, jobs)
+                return
+            entry = AvailableDrone(drone, self.clock(), self.last_assigned_at.get(drone.id, float("-inf")))
+            entry.priority = self.policy(entry)
+            self.entries[drone.id] = entry
+            heapq.heappush(self.available, entry)
+            if len(self.available) > 2 * len(self.entries) + 64: # too many discarded entries
+                self.available = list(self.entries.values())
+                heapq.heapify(self.available)
+
+    def drone_removed(self, drone: Drone):
+        with self.lock:
+            self.entries.pop(drone.id, None)
+            self.last_assigned_at.pop(drone.id, None)
+
+    @staticmethod
+    def _is_free(drone: Drone) -> bool:
+        return drone.state == DroneState.AVAILABLE and not drone.pending_shipping_requests
+
+    def _pop_available(self) -> Optional[Drone]:
+        while self.available:
+            entry = heapq.heappop(self.available)
+            if self.entries.get(entry.drone.id) is entry:
+                del self.entries[entry.drone.id]
+                if self._is_free(entry.drone):
+                    return entry.drone
+        return None
+
+    def _assign(self, drone: Drone, jobs: list[ShippingJob]):
+        self.last_assigned_at[drone.id] = self.clock()
+        self.assign(drone, [ShippingRequestDTO(drone.id, job.shipping_address) for job in jobs])
@@ -0,0 +1,275 @@
+import json
+import logging
+import os
+import queue
+from threading import Thread
+from time import monotonic, sleep
+from typing import Optional
+from DTOs import *
+from jobs import ShippingJob
+from Packet import Address
+
+# Write-ahead journal of the fleet: every state transition of a connected drone (connection, route assigned, AVB,
+# route acknowledged, new address, removal) and of the jobs' queue is appended to a file, so that a restarted gateway
+# gets its drones back with their sequence numbers, tokens and routes instead of waiting for them to connect again.
+# The gateway only enqueues a tuple, a background thread writes the records and syncs them to disk once every
+# FSYNC_INTERVAL seconds for all of those enqueued meanwhile. So a crash loses at most the transitions of the last interval.
+# The thread keeps its own copy of the state to which it applies the records, and writes that copy as a snapshot, starting
+# an empty journal, as soon as the journal holds as many records as half the snapshot's drones and jobs (at least COMPACT_EVERY):
+# replaying is reading the snapshot and the few records which follow it, so it costs about as much as the snapshot.
+#   DIRECTORY/snapshot.json: {"lsn": ..., "next_drone_id": ..., "next_job_id": ..., "drones": [...], "jobs": [[id, address], ...]}
+#   DIRECTORY/journal.log: a JSON object for each record, numbered by lsn. Records not newer than the snapshot are skipped.
+
+FSYNC_INTERVAL: float = 0.05 # seconds, the most transitions a crash can lose.
+COMPACT_EVERY: int = 1_000 # the fewest records after which a snapshot replaces the journal.
+SNAPSHOT_FILE = "snapshot.json"
+JOURNAL_FILE = "journal.log"
+
+LOG = logging.getLogger("gateway.journal")
+
+_STOP = None
+
+
+class DroneRecord:
+    ''' What the journal knows of a connected drone '''
+    id: int
+    address: Address
+    state: DroneState
+    send_sequence_number: int
+    expected_recv_sequence_number: int
+    window: int
+    resumption_token: Optional[int]
+    port: Optional[int] # port of the drone's own socket with the threads engine, None with the asyncio one.
+    route: list[str] # shipping addresses of the stops of its route.
+
+    def __init__(self, id: int, address: Address, state: DroneState, send_sequence_number: int,
+                 expected_recv_sequence_number: int, window: int, resumption_token: Optional[int], port: Optional[int],
+                 route: list[str]):
+        self.id = id
+        self.address = address
+        self.state = state
+        self.send_sequence_number = send_sequence_number
+        self.expected_recv_sequence_number = expected_recv_sequence_number
+        self.window = window
+        self.resumption_token = resumption_token
+        self.port = port
+        self.route = route
+
+    def encode(self) -> dict:
+        return {"id": self.id, "address": list(self.address), "state": self.state.name, "send": self.send_sequence_number,
+                "recv": self.expected_recv_sequence_number, "window": self.window, "token": self.resumption_token,
+                "port": self.port, "route": self.route}
+
+    @staticmethod
+    def decode(entry: dict) -> 'DroneRecord':
+        return DroneRecord(entry["id"], tuple(entry["address"]), DroneState[entry["state"]], entry["send"], entry["recv"],
+            entry["window"], entry["token"], entry["port"], entry["route"])
+
+
+class FleetState:
+    ''' The state rebuilt from the journal: connected drones by id and queued jobs in FIFO order '''
+    lsn: int # number of the last record applied.
+    next_drone_id: int
+    next_job_id: int
+    drones: dict[int, DroneRecord]
+    jobs: dict[int, str] # job id -> shipping address
+
+    def __init__(self):
+        self.lsn = 0
+        self.next_drone_id = 1
+        self.next_job_id = 1
+        self.drones = {}
+        self.jobs = {}
+
+    def apply(self, entry: dict):
+        op = entry["op"]
+        if op == "drone":
+            record = DroneRecord.decode(entry)
+            self.drones[record.id] = record
+            self.next_drone_id = max(self.next_drone_id, record.id + 1)
+        elif op == "removed":
+            self.drones.pop(entry["id"], None)
+        elif op == "queued":
+            self.jobs[entry["job"]] = entry["address"]
+            self.next_job_id = max(self.next_job_id, entry["job"] + 1)
+        elif op == "dequeued":
+            for job_id in entry["jobs"]:
+                self.jobs.pop(job_id, None)
+        self.lsn = entry["lsn"]
+
+    def encode(self) -> dict:
+        return {"lsn": self.lsn, "next_drone_id": self.next_drone_id, "next_job_id": self.next_job_id,
+                "drones": [d.encode() for d in self.drones.values()],
+                "jobs": [[id, address] for id, address in self.jobs.items()]}
+
+    @staticmethod
+    def decode(snapshot: dict) -> 'FleetState':
+        state = FleetState()
+        state.lsn = snapshot["lsn"]
+        state.next_drone_id = snapshot["next_drone_id"]
+        state.next_job_id = snapshot["next_job_id"]
+        for entry in snapshot["drones"]:
+            record = DroneRecord.decode(entry)
+            state.drones[record.id] = record
+        state.jobs = {id: address for id, address in snapshot["jobs"]}
+        return state
+
+
+def replay(directory: str) -> FleetState:
+    ''' The state left by the last run: its snapshot, if any, and the records appended after it.
+        A record torn by a crash while it was being written ends the replay '''
+    state = FleetState()
+    try:
+        with open(os.path.join(directory, SNAPSHOT_FILE), encoding="utf-8") as f:
+            state = FleetState.decode(json.load(f))
+    except FileNotFoundError:
+        pass
+    try:
+        with open(os.path.join(directory, JOURNAL_FILE), encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    LOG.warning("Journal: ignored a truncated record after lsn %d", state.lsn)
+                    break
+                if entry["lsn"] > state.lsn:
+                    state.apply(entry)
+    except FileNotFoundError:
+        pass
+    return state
+
+
+class Journal:
+    ''' Appends the transitions of the fleet to DIRECTORY/journal.log from a background thread.
+        Its methods can be called from any thread, they only capture the values to write '''
+    directory: str
+    fsync_interval: float
+    compact_every: int # the fewest records after which the journal is compacted.
+    state: FleetState # the writer thread's copy, don't touch it from other threads once started.
+    written: int # records written since the last snapshot.
+    syncs: int # fsync calls, each one for a batch of records.
+
+    def __init__(self, directory: str, fsync_interval: float = FSYNC_INTERVAL, compact_every: int = COMPACT_EVERY):
+        self.directory = directory
+        self.fsync_interval = fsync_interval
+        self.compact_every = compact_every
+        self.records: queue.SimpleQueue = queue.SimpleQueue()
+        self.state = FleetState()
+        self.written = 0
+        self.syncs = 0
+        self.file = None
+        self.thread: Optional[Thread] = None
+
+    def start(self, state: FleetState):
+        ''' Starts writing after the state which has been replayed, which becomes the first snapshot '''
+        os.makedirs(self.directory, exist_ok=True)
+        self.state = state
+        self.compact()
+        self.thread = Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        ''' Writes the records still in the queue and a last snapshot '''
+        if self.thread:
+            self.records.put(_STOP)
+            self.thread.join()
+            self.thread = None
+            self.compact()
+            self.file.close()
+
+    # ----- TRANSITIONS -----
+    def drone(self, drone: Drone):
+        ''' The drone connected or some of its journaled fields changed '''
+        port = None
+        if drone.sock is not None:
+            try:
+                port = drone.sock.getsockname()[1]
+            except OSError: # closed as the drone has just been removed, the writer keeps the port it knows
+                pass
+        self.records.put(("drone", drone.id, drone.address, drone.state, drone.send_sequence_number,
+            drone.expected_recv_sequence_number, drone.window, drone.resumption_token, port,
+            [r.shipping_address for r in drone.pending_shipping_requests]))
+
+    def drone_removed(self, drone: Drone):
+        self.records.put(("removed", drone.id))
+
+    def job_queued(self, job: ShippingJob):
+        self.records.put(("queued", job.job_id, job.shipping_address))
+
+    def jobs_dequeued(self, jobs: list[ShippingJob]):
+        self.records.put(("dequeued", [job.job_id for job in jobs]))
+
+    # ----- WRITER THREAD -----
+    def run(self):
+        while True:
+            batch = [self.records.get()]
+            started = monotonic()
+            sleep(self.fsync_interval) # the transitions of the next interval are synced together.
+            while True:
+                try:
+                    batch.append(self.records.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = _STOP in batch
+            records = [r for r in batch if r is not _STOP]
+            while records:
+                # a burst of records is split so that the journal never grows much beyond the compaction threshold.
+                room = max(1, self.compaction_threshold() - self.written)
+                self.write(records[:room])
+                records = records[room:]
+                if self.written >= self.compaction_threshold():
+                    self.compact()
+            LOG.debug("Journal: %d records synced in %.1f ms", len(batch), (monotonic() - started) * 1000)
+            if stopping:
+                return
+
+    def compaction_threshold(self) -> int:
+        ''' The journal is compacted once it holds half as many records as the snapshot's entries, so that replaying it
+            after a crash never takes much longer than reading the snapshot '''
+        return max(self.compact_every, (len(self.state.drones) + len(self.state.jobs)) // 2)
+
+    def write(self, batch: list[tuple]):
+        lines = []
+        for record in batch:
+            entry = self.entry(record)
+            self.state.apply(entry)
+            lines.append(json.dumps(entry, ensure_ascii=False))
+        if lines:
+            self.file.write("\n".join(lines) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.syncs += 1
+            self.written += len(lines)
+
+    def entry(self, record: tuple) -> dict:
+        lsn = self.state.lsn + 1
+        op = record[0]
+        if op == "drone":
+            _, id, address, state, send, recv, window, token, port, route = record
+            if port is None and id in self.state.drones:
+                port = self.state.drones[id].port
+            entry = DroneRecord(id, address, state, send, recv, window, token, port, route).encode()
+        elif op == "removed":
+            entry = {"id": record[1]}
+        elif op == "queued":
+            entry = {"job": record[1], "address": record[2]}
+        else:
+            entry = {"jobs": record[1]}
+        entry["op"] = op
+        entry["lsn"] = lsn
+        return entry
+
+    def compact(self):
+        ''' Replaces the journal with a snapshot of the state. The snapshot is in place before the journal is emptied,
+            a crash in between leaves records which are skipped as older than the snapshot '''
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        temporary = path + ".tmp"
+        with open(temporary, "w", encoding="utf-8") as f:
+            json.dump(self.state.encode(), f, ensure_ascii=False)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+        if self.file:
+            self.file.close()
+        self.file = open(os.path.join(self.directory, JOURNAL_FILE), "w", encoding="utf-8")
+        self.written = 0
@@ -0,0 +1,60 @@
+from collections import OrderedDict
+from threading import RLock
+from time import monotonic
+from typing import Callable
+from DTOs import *
+
+# A connected drone is alive as long as the gateway hears from it. Every packet counts, and a drone which has nothing
+# to send (waiting for a route or flying) repeats its last ACK every HEARTBEAT_INTERVAL seconds as a heartbeat,
+# which peers that don't know about heartbeats ignore as a duplicate. A drone silent for LIVENESS_TIMEOUT seconds is dead.
+
+HEARTBEAT_INTERVAL: float = 2 # seconds without sending anything after which a drone sends a heartbeat.
+LIVENESS_TIMEOUT: float = 15 # seconds without hearing from a drone after which it is considered dead.
+
+class LivenessTable:
+    ''' When each connected drone was last heard of.
+        Drones are kept in the order they were heard of, so the ones silent for the longest time are always at the front
+        and finding the dead ones only looks at them. '''
+    timeout: float
+    drones: OrderedDict[int, Drone]
+
+    def __init__(self, timeout: float = LIVENESS_TIMEOUT, clock: Callable[[], float] = monotonic):
+        self.timeout = timeout
+        self.clock = clock
+        self.drones = OrderedDict()
+        self.lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self.drones)
+
+    def heard(self, drone: Drone):
+        ''' A packet arrived from the drone, it also starts tracking a drone which has just connected '''
+        with self.lock:
+            drone.last_heard = self.clock()
+            self.drones[drone.id] = drone
+            self.drones.move_to_end(drone.id)
+
+    def touch(self, drone: Drone):
+        ''' A packet arrived from the drone: unlike heard, a drone which isn't tracked (e.g. it has just been evicted) stays
+            untracked '''
+        with self.lock:
+            if drone.id in self.drones:
+                drone.last_heard = self.clock()
+                self.drones.move_to_end(drone.id)
+
+    def remove(self, drone: Drone):
+        with self.lock:
+            self.drones.pop(drone.id, None)
+
+    def evict_dead(self) -> list[Drone]:
+        ''' Removes and returns the drones not heard of for more than timeout seconds '''
+        dead: list[Drone] = []
+        with self.lock:
+            deadline = self.clock() - self.timeout
+            while self.drones:
+                drone = next(iter(self.drones.values()))
+                if drone.last_heard > deadline:
+                    break
+                del self.drones[drone.id]
+                dead.append(drone)
+        return dead
@@ -0,0 +1,188 @@
+import argparse
+import asyncio
+import sys
+from time import monotonic
+from typing import Optional
+from drone_client import DroneClient, DroneClientState, DroneFleet
+from DTOs import *
+from impairment import ImpairmentConfig, ImpairmentProfile
+from Packet import Address
+import utils
+
+# Runs a fleet of simulated drones against a running gateway, together with a client which submits shipping jobs,
+# and measures what the drones and the client see.
+
+GATEWAY_UDP_ADDRESS: Address = ('127.0.0.1', 8081)
+GATEWAY_TCP_ADDRESS: Address = ('127.0.0.1', 8080)
+
+class LoadReport:
+    drones: int
+    connected: int
+    connect_latencies: list[float]
+    AVB_latencies: list[float]
+    dispatch_latencies: list[float] # from the submission of a job to the SHP received by a drone.
+    jobs: int
+    rejected_jobs: int
+    shipments: int
+    datagrams_sent: int # by the drones, retransmissions included.
+    datagrams_lost: int # of those sent by the drones.
+    port_changes: int # drones moved to a new socket while shipping.
+    resumptions: int # of those port changes, the ones after which the gateway resumed the connection.
+    elapsed: float # from the submission of the jobs to the last drone back to the station.
+
+    def __init__(self, drones: int):
+        self.drones = drones
+        self.connected = 0
+        self.connect_latencies = []
+        self.AVB_latencies = []
+        self.dispatch_latencies = []
+        self.jobs = 0
+        self.rejected_jobs = 0
+        self.shipments = 0
+        self.datagrams_sent = 0
+        self.datagrams_lost = 0
+        self.port_changes = 0
+        self.resumptions = 0
+        self.elapsed = 0
+
+    @property
+    def throughput(self) -> float:
+        ''' Shipments per second '''
+        return self.shipments / self.elapsed if self.elapsed else 0
+
+    def failures(self, min_throughput: float = 0) -> list[str]:
+        ''' What went wrong in the run: drones which didn't connect, jobs rejected or never shipped, a throughput below
+            min_throughput '''
+        failures = []
+        if self.connected < self.drones:
+            failures.append("%d droni non si sono connessi" % (self.drones - self.connected))
+        if self.rejected_jobs:
+            failures.append("%d spedizioni rifiutate" % self.rejected_jobs)
+        if self.shipments != self.jobs - self.rejected_jobs:
+            failures.append("%d spedizioni effettuate su %d accettate" % (self.shipments, self.jobs - self.rejected_jobs))
+        if self.throughput < min_throughput:
+            failures.append("%.1f spedizioni/s, meno di %.1f" % (self.throughput, min_throughput))
+        return failures
+
+    @staticmethod
+    def percentile(values: list[float], p: float) -> float:
+        if not values:
+            return float("nan")
+        values = sorted(values)
+        return values[min(len(values) - 1, int(len(values) * p))]
+
+    def __str__(self) -> str:
+        lines = ["%d droni, %d connessi, %d spedizioni su %d richieste (%d rifiutate) in %.2f s: %.1f spedizioni/s" %
+            (self.drones, self.connected, self.shipments, self.jobs, self.rejected_jobs, self.elapsed, self.throughput),
+            "%d datagrammi inviati dai droni, %d persi" % (self.datagrams_sent, self.datagrams_lost)]
+        if self.port_changes:
+            lines.append("%d cambi di porta, %d connessioni riprese" % (self.port_changes, self.resumptions))
+        for name, values in (("SYN->SYNACK", self.connect_latencies), ("AVB->ACK", self.AVB_latencies),
+            ("richiesta->SHP", self.dispatch_latencies)):
+            lines.append("%-16s p50 %8.1f ms   p90 %8.1f ms   p99 %8.1f ms   max %8.1f ms" % (name,
+                *(LoadReport.percentile(values, p) * 1000 for p in (0.5, 0.9, 0.99)), max(values, default=float("nan")) * 1000))
+        return "\n".join(lines)
+
+
+async def read_messages(reader: asyncio.StreamReader):
+    while True:
+        header = await reader.readexactly(utils.HEADER.size)
+        length, = utils.HEADER.unpack(header)
+        yield await reader.readexactly(length)
+
+async def generate_load(drones: int, jobs: int, flight_time: tuple[float, float] = (0.5, 1),
+                        impairment: Optional[ImpairmentConfig] = None, seed: Optional[int] = None,
+                        timeout: float = 60, udp_address: Address = GATEWAY_UDP_ADDRESS,
+                        tcp_address: Address = GATEWAY_TCP_ADDRESS, window: int = 1,
+                        port_change_interval: Optional[float] = None) -> LoadReport:
+    ''' Connects the drones, submits the jobs in a single batch without choosing the drones
+        and waits for every shipment to complete.
+        With port_change_interval, a random drone moves to a new socket that often while the jobs are shipped '''
+    report = LoadReport(drones)
+    submitted_at: dict[str, float] = {}
+    def shipping_started(drone: DroneClient):
+        for address in drone.route:
+            if address in submitted_at:
+                report.dispatch_latencies.append(monotonic() - submitted_at.pop(address))
+
+    fleet = DroneFleet(udp_address, flight_time, impairment, seed, shipping_started, window=window)
+    reader, writer = await asyncio.open_connection(*tcp_address)
+    result: asyncio.Future[ShippingBatchResultDTO] = asyncio.get_running_loop().create_future()
+    async def read_client_messages(): # the drones' updates must be read even if they aren't needed.
+        async for message in read_messages(reader):
+            if ShippingBatchResultDTO.is_shipping_batch_result(message):
+                result.set_result(ShippingBatchResultDTO.decode(message))
+    client_task = asyncio.create_task(read_client_messages())
+    async def change_ports():
+        while True:
+            await asyncio.sleep(port_change_interval)
+            await fleet.change_port()
+    port_changes_task: Optional[asyncio.Task] = None
+
+    deadline = monotonic() + timeout
+    try:
+        await fleet.launch(drones)
+        while fleet.count(DroneClientState.CONNECTING) and monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        report.connected = len(fleet.connect_latencies)
+
+        start = monotonic()
+        for i in range(jobs):
+            submitted_at["Job %d" % i] = start
+        writer.write(utils.frame(ShippingBatchDTO(1, [ShippingRequestDTO(None, address) for address in submitted_at]).encode()))
+        report.jobs = jobs
+        if port_change_interval:
+            port_changes_task = asyncio.create_task(change_ports())
+        report.rejected_jobs = jobs - (await asyncio.wait_for(result, max(0, deadline - monotonic()))).accepted
+        # a drone whose AVB wasn't acknowledged keeps retransmitting it until it gets a SHP, so it doesn't count as busy.
+        while (submitted_at or fleet.count(DroneClientState.SHIPPING)) and monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        report.elapsed = monotonic() - start
+    finally:
+        client_task.cancel()
+        if port_changes_task:
+            port_changes_task.cancel()
+        writer.close()
+        fleet.close()
+    report.connect_latencies = fleet.connect_latencies
+    report.AVB_latencies = fleet.AVB_latencies
+    report.shipments = fleet.shipments
+    report.datagrams_sent = sum(drone.transport.outbound.sent for drone in fleet.drones)
+    report.datagrams_lost = sum(drone.transport.outbound.lost for drone in fleet.drones)
+    report.port_changes = fleet.port_changes
+    report.resumptions = fleet.resumptions
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Simulates many drones on a single event loop against a running gateway")
+    parser.add_argument("--drones", type=int, default=100)
+    parser.add_argument("--jobs", type=int, default=None, help="shipping requests submitted, by default two for each drone.")
+    parser.add_argument("--flight-time", type=float, nargs=2, default=[0.5, 1], metavar=("MIN", "MAX"),
+        help="seconds a shipment lasts.")
+    parser.add_argument("--impair-send", type=ImpairmentProfile.parse, default=ImpairmentProfile(), metavar="PROFILE",
+        help="simulated impairment of the packets sent by the drones, e.g. "
+            "\"loss=0.05,burst=0.01:0.3:0.9,delay=0.02,jitter=0.005\". Default: %(default)s.")
+    parser.add_argument("--impair-recv", type=ImpairmentProfile.parse, default=ImpairmentProfile(), metavar="PROFILE",
+        help="simulated impairment of the packets received by the drones (losses only). Default: %(default)s.")
+    parser.add_argument("--seed", type=int, default=None, help="seed of flight times and impairments, to reproduce a run.")
+    parser.add_argument("--window", type=int, default=1,
+        help="SHPs a drone asks to receive without acknowledging each one, i.e. the most stops of its routes.")
+    parser.add_argument("--port-change-every", type=float, default=None, metavar="SECONDS",
+        help="while the jobs are shipped, a random drone moves to a new socket this often and resumes its connection from there.")
+    parser.add_argument("--timeout", type=float, default=60)
+    parser.add_argument("--check", action="store_true",
+        help="exits with status 1 unless every drone connected and every job was accepted and shipped exactly once, e.g. in CI.")
+    parser.add_argument("--min-throughput", type=float, default=0, metavar="SHIPMENTS_PER_SECOND",
+        help="with --check, the lowest throughput that passes.")
+    args = parser.parse_args()
+    report = asyncio.run(generate_load(args.drones, args.jobs if args.jobs is not None else 2 * args.drones,
+        tuple(args.flight_time), ImpairmentConfig(args.impair_send, args.impair_recv, args.seed), args.seed, args.timeout,
+        window=args.window,
+        port_change_interval=args.port_change_every))
+    print(report)
+    if args.check:
+        failures = report.failures(args.min_throughput)
+        for failure in failures:
+            print("FALLITO: " + failure)
+        sys.exit(1 if failures else 0)
@@ -0,0 +1,95 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+from typing import Optional, TextIO
+
+# Logging of gateway and drones. Records go through a queue to a background thread which formats and writes them,
+# so a packet path pays a level check when its messages are disabled and an enqueue when they aren't.
+# Messages take their arguments separately (LOG.debug("SHP %d", seq_num)) so that they are only formatted if written,
+# which means the arguments must not change after the call: numbers, strings, addresses and received packets.
+# RTT estimators are the exception, logged at debug level as they are when the record is written.
+#   DEBUG: why a packet was ignored, retransmissions, RTT estimates.
+#   INFO: every packet sent and received, drones connecting and disconnecting, clients' requests.
+
+LEVELS = {"debug": logging.DEBUG, "info": logging.INFO, "warning": logging.WARNING, "error": logging.ERROR}
+CONTEXT_FIELDS = ("drone", "address", "client") # set with extra=, or by a DroneLog.
+
+_listener: Optional[logging.handlers.QueueListener] = None
+atexit.register(lambda: stop())
+
+
+class TextFormatter(logging.Formatter):
+    ''' The console output: every message followed by an empty line '''
+    def format(self, record: logging.LogRecord) -> str:
+        return super().format(record).rstrip("\n") + "\n"
+
+
+class JsonFormatter(logging.Formatter):
+    ''' A JSON object for each record, on a single line, holding the context fields set on the record '''
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"ts": round(record.created, 6), "level": record.levelname.lower(), "logger": record.name,
+            "msg": record.getMessage().strip()}
+        for field in CONTEXT_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = "%s:%s" % value if isinstance(value, tuple) else value
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    ''' Enqueues the records as they are, the listener's thread formats them '''
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+
+class DroneLog(logging.LoggerAdapter):
+    ''' A logger whose records carry the id of a drone '''
+    def __init__(self, logger: logging.Logger, drone_id: int):
+        super().__init__(logger, {"drone": drone_id})
+
+
+def setup(level: str = "info", format: str = "text", file: Optional[str] = None):
+    ''' Sends every record to stdout, or to file, through the background thread. It can be called again to change the
+        configuration '''
+    global _listener
+    stop()
+    stream: TextIO = open(file, "a", encoding="utf-8") if file else sys.stdout
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(JsonFormatter() if format == "json" else TextFormatter())
+    records: queue.SimpleQueue = queue.SimpleQueue()
+    root = logging.getLogger()
+    for h in list(root.handlers):
+        root.removeHandler(h)
+    root.addHandler(_DeferredQueueHandler(records))
+    set_level(level)
+    _listener = logging.handlers.QueueListener(records, handler)
+    _listener.start()
+
+def set_level(level: str):
+    logging.getLogger().setLevel(LEVELS[level])
+
+def toggle_debug():
+    ''' Switches between debug and info, e.g. from a signal handler while the process runs '''
+    root = logging.getLogger()
+    root.setLevel(logging.INFO if root.level == logging.DEBUG else logging.DEBUG)
+
+def stop():
+    ''' Writes the records still in the queue and stops the background thread '''
+    global _listener
+    if _listener:
+        _listener.stop()
+        for handler in _listener.handlers:
+            handler.flush()
+        _listener = None
+
+def add_arguments(parser):
+    parser.add_argument("--log-level", choices=list(LEVELS), default="info",
+        help="debug: why packets are ignored and retransmitted too. info: packets and connections.")
+    parser.add_argument("--log-format", choices=["text", "json"], default="text",
+        help="json: a JSON object for each line, with the drone it refers to.")
+    parser.add_argument("--log-file", default=None, metavar="PATH", help="appends the log to this file instead of printing it.")
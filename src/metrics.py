@@ -0,0 +1,180 @@
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+from threading import Lock, Thread
+from time import sleep
+from typing import Callable, Optional
+from Packet import Address, Packet
+
+# Counters and histograms of the gateway, exposed in the Prometheus text format through a local HTTP endpoint (/metrics)
+# or written to a file every few seconds. Updating a metric takes an uncontended lock and a dict lookup, values which are
+# already kept elsewhere (e.g. drones by state) are only read when the metrics are collected.
+
+LATENCY_BUCKETS: tuple[float, ...] = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10) # seconds
+
+def _labels(names: tuple[str, ...], values: tuple[str, ...]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join('%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)) + "}"
+
+
+class Counter:
+    ''' A value which only goes up, one for each combination of label values '''
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values: dict[tuple[str, ...], float] = {}
+        self.lock = Lock()
+
+    def inc(self, *label_values: str, amount: float = 1):
+        with self.lock:
+            self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def get(self, *label_values: str) -> float:
+        return self.values.get(label_values, 0)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            values = sorted(self.values.items())
+        return ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name] + \
+            ["%s%s %g" % (self.name, _labels(self.labels, labels), value) for labels, value in values]
+
+
+class Histogram:
+    ''' Counts the observed values falling in each bucket, with their sum '''
+    def __init__(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1) # the last one is +Inf
+        self.sum = 0.0
+        self.lock = Lock()
+
+    def observe(self, value: float):
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+    @property
+    def count(self) -> int:
+        return sum(self.counts)
+
+    def render(self) -> list[str]:
+        with self.lock:
+            counts, total = list(self.counts), self.sum
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append('%s_bucket{le="%s"} %d' % (self.name, "+Inf" if bound == float("inf") else "%g" % bound, cumulative))
+        lines.append("%s_sum %g" % (self.name, total))
+        lines.append("%s_count %d" % (self.name, cumulative))
+        return lines
+
+
+class Collected:
+    ''' A metric whose values are read from elsewhere when the metrics are collected, as a dict from label value to value '''
+    def __init__(self, name: str, help: str, type: str, label: Optional[str], collect: Callable[[], dict[str, float]]):
+        self.name = name
+        self.help = help
+        self.type = type # "gauge" or "counter"
+        self.label = label
+        self.collect = collect
+
+    def render(self) -> list[str]:
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for label, value in sorted(self.collect().items()):
+            lines.append("%s%s %g" % (self.name, _labels((self.label,), (label,)) if self.label else "", value))
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self.metrics: dict[str, object] = {}
+
+    def register(self, metric):
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name: str, help: str, buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, help, buckets))
+
+    def collected(self, name: str, help: str, type: str, collect: Callable[[], dict[str, float]],
+                  label: Optional[str] = None) -> Collected:
+        return self.register(Collected(name, help, type, label, collect))
+
+    def render(self) -> str:
+        ''' Every metric in the Prometheus text exposition format '''
+        lines: list[str] = []
+        for metric in list(self.metrics.values()):
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+METRICS = MetricsRegistry()
+PACKETS_RECEIVED = METRICS.counter("gateway_packets_received_total", "Packets received from the drones.", ("type",))
+PACKETS_SENT = METRICS.counter("gateway_packets_sent_total", "Packets sent to the drones, retransmissions included.", ("type",))
+PACKETS_LOST = METRICS.counter("gateway_packets_lost_total",
+    "Packets sent to the drones and dropped by the simulated impairment.", ("type",))
+DUPLICATES = METRICS.counter("gateway_duplicates_ignored_total", "Packets ignored because they had already been received.",
+    ("type",))
+HANDSHAKE_LATENCY = METRICS.histogram("gateway_handshake_seconds", "From a drone's SYN to the ACK which completes the handshake.")
+ROUTE_LATENCY = METRICS.histogram("gateway_route_ack_seconds", "From the first SHP of a route to the ACK of its last stop.")
+UPDATE_LATENCY = METRICS.histogram("gateway_client_update_seconds",
+    "From a drone change to the update which carries it to the clients.")
+
+def packet_type(packet: Packet) -> str:
+    if packet.is_SYN: return "SYN"
+    if packet.is_SYNACK: return "SYNACK"
+    if packet.is_ACK: return "ACK"
+    if packet.is_AVB: return "AVB"
+    if packet.is_SHP: return "SHP"
+    return "unknown"
+
+def sent(name: str, delivered: bool):
+    ''' A packet named name has been sent to a drone, delivered is False if the simulated impairment dropped it '''
+    (PACKETS_SENT if delivered else PACKETS_LOST).inc(name)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass # scrapes aren't worth a line of the gateway's log
+
+
+def serve(address: Address) -> ThreadingHTTPServer:
+    ''' Serves /metrics from a background thread '''
+    server = ThreadingHTTPServer(address, _Handler)
+    server.daemon_threads = True
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+def write_periodically(path: str, interval: float):
+    ''' Rewrites the file with every metric each interval seconds, from a background thread. The file is replaced atomically,
+        so it can be read at any moment (e.g. by the textfile collector of node_exporter) '''
+    def run():
+        while True:
+            sleep(interval)
+            write(path)
+    Thread(target=run, daemon=True).start()
+
+def write(path: str):
+    temporary = path + ".tmp"
+    with open(temporary, "w") as f:
+        f.write(METRICS.render())
+    os.replace(temporary, path)
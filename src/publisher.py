@@ -0,0 +1,99 @@
+from console_server import ConsoleConnection, ConsoleServer
+import logging
+from threading import Condition, Lock, Thread
+from time import monotonic
+from typing import Optional
+from DTOs import *
+from metrics import UPDATE_LATENCY
+from registry import DroneRegistry
+
+UPDATE_WINDOW: float = 0.05 # seconds during which changes are collected into a single update.
+LOG = logging.getLogger("gateway.publisher")
+
+class ConsolePublisher:
+    ''' Keeps clients' consoles up to date from its own thread.
+        It wakes up as soon as a drone changes and waits window seconds to coalesce the changes which follow
+        into a single DronesUpdateDTO, which is encoded once and broadcast to every client.
+        So a burst of changes costs one update per window, with at most one entry per drone, whatever the number of clients. '''
+    registry: DroneRegistry
+    window: float
+    server: Optional[ConsoleServer]
+    changed: set[int] # ids of the drones changed since the last update.
+    removed: set[int] # ids of the drones disconnected since the last update.
+    version: int # number of the last update sent.
+    first_change_at: Optional[float] # when the oldest change not sent yet was made.
+
+    def __init__(self, registry: DroneRegistry, window: float = UPDATE_WINDOW):
+        self.registry = registry
+        self.window = window
+        self.server = None
+        self.changed = set()
+        self.removed = set()
+        self.version = 0
+        self.first_change_at = None
+        self.running = False
+        self.condition = Condition(Lock())
+        self.send_lock = Lock() # keeps snapshots and updates in the order of their versions.
+        self.thread: Optional[Thread] = None
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.run)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+
+    def drone_changed(self, drone: Drone):
+        ''' Thread-safe: the drone must be updated on client's console '''
+        with self.condition:
+            self.changed.add(drone.id)
+            self.first_change_at = self.first_change_at or monotonic()
+            self.condition.notify()
+
+    def drone_removed(self, drone: Drone):
+        ''' Thread-safe: the drone must be removed from client's console '''
+        with self.condition:
+            self.changed.discard(drone.id)
+            self.removed.add(drone.id)
+            self.first_change_at = self.first_change_at or monotonic()
+            self.condition.notify()
+
+    def send_snapshot(self, client: ConsoleConnection):
+        ''' Sends every drone to the client, on connection or when it asks for a resync.
+            The snapshot has the version of the last update, so the next update broadcast follows it '''
+        with self.send_lock:
+            if not self.server:
+                return
+            LOG.info("[GATEWAY]\t-->\tAggiornamento interfaccia (%d droni)\t-->\t[CLIENT %s:%s]", len(self.registry),
+                *client.address, extra={"client": client.address})
+            dto = DronesUpdateDTO(self.version, True, [DroneStatusDTO.of(d) for d in self.registry.values()])
+            self.server.send(client, dto.encode())
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.changed and not self.removed:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                # coalesces the changes made during the window
+                deadline = monotonic() + self.window
+                while self.running and monotonic() < deadline:
+                    self.condition.wait(deadline - monotonic())
+            with self.send_lock:
+                with self.condition:
+                    changed, removed, first_change_at = self.changed, self.removed, self.first_change_at
+                    self.changed, self.removed, self.first_change_at = set(), set(), None
+                drones = [d for d in map(self.registry.get_by_id, changed) if d]
+                if (drones or removed) and self.server and len(self.server):
+                    self.version += 1
+                    LOG.info("[GATEWAY]\t-->\tAggiornamento interfaccia (%d droni, %d disconnessi)\t-->\t[%d CLIENT]",
+                        len(drones), len(removed), len(self.server))
+                    dto = DronesUpdateDTO(self.version, False, [DroneStatusDTO.of(d) for d in drones], sorted(removed))
+                    self.server.broadcast(dto.encode())
+                    UPDATE_LATENCY.observe(monotonic() - first_change_at)
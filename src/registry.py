@@ -0,0 +1,92 @@
+import secrets
+from threading import RLock
+from typing import Iterator, Optional
+from DTOs import *
+from Packet import Address
+
+def new_resumption_token(shard: int = 0, shards: int = 1) -> int:
+    ''' A token that can't be guessed, so that nobody else can take over a drone's connection.
+        Its remainder modulo shards is shard, so a sharded gateway knows which worker holds the connection '''
+    token = secrets.randbits(64)
+    token += shard - token % shards
+    if token >= 1 << 64:
+        token -= shards
+    return token or shards
+
+
+class DroneRegistry:
+    ''' The connected drones, indexed by id, by address and by resumption token so that every lookup takes constant time.
+        Ids are allocated from a counter and never reused, so a disconnected drone's id can't be confused with a new drone.
+        Registries of the workers of a sharded gateway count with a step, each one from a different first id, so ids stay unique.
+        Mutations are serialized by a lock, lookups rely on single dict operations being atomic. '''
+    by_id: dict[int, Drone]
+    by_address: dict[Address, Drone]
+    by_token: dict[int, Drone]
+    next_id: int
+    id_step: int
+
+    def __init__(self, first_id: int = 1, id_step: int = 1):
+        self.by_id = {}
+        self.by_address = {}
+        self.by_token = {}
+        self.next_id = first_id
+        self.id_step = id_step
+        self.lock = RLock()
+
+    def allocate_id(self) -> int:
+        with self.lock:
+            id = self.next_id
+            self.next_id += self.id_step
+            return id
+
+    def add(self, drone: Drone):
+        with self.lock:
+            self.by_id[drone.id] = drone
+            self.by_address[drone.address] = drone
+            if drone.resumption_token is not None:
+                self.by_token[drone.resumption_token] = drone
+
+    def remove(self, drone: Drone) -> bool:
+        ''' Returns False if the drone wasn't registered '''
+        with self.lock:
+            if self.by_id.get(drone.id) is not drone:
+                return False
+            del self.by_id[drone.id]
+            # another drone may have connected from the same address since, e.g. this one restarted without its token.
+            if self.by_address.get(drone.address) is drone:
+                del self.by_address[drone.address]
+            if self.by_token.get(drone.resumption_token) is drone:
+                del self.by_token[drone.resumption_token]
+            return True
+
+    def move(self, drone: Drone, address: Address):
+        ''' The drone resumed its connection from another address '''
+        with self.lock:
+            if self.by_address.get(drone.address) is drone:
+                del self.by_address[drone.address]
+            drone.address = address
+            self.by_address[address] = drone
+
+    def get_by_id(self, id: int) -> Optional[Drone]:
+        return self.by_id.get(id)
+
+    def get_by_address(self, address: Address) -> Optional[Drone]:
+        return self.by_address.get(address)
+
+    def get_by_token(self, token: int) -> Optional[Drone]:
+        return self.by_token.get(token)
+
+    def __contains__(self, address: Address) -> bool:
+        return address in self.by_address
+
+    def __len__(self) -> int:
+        return len(self.by_id)
+
+    def values(self) -> list[Drone]:
+        ''' A snapshot of the registered drones in the order they connected, safe to iterate while other threads mutate the
+            registry '''
+        with self.lock:
+            return list(self.by_id.values())
+
+    def __iter__(self) -> Iterator[Drone]:
+        return iter(self.values())
@@ -0,0 +1,63 @@
+from typing import Optional
+
+# Round-trip time estimation and retransmission timeout (RTO) computation, as described by Jacobson/Karels (RFC 6298).
+
+INITIAL_RTO: float = 1 # seconds, the timeout used before any RTT has been measured.
+MIN_RTO: float = 0.1
+MAX_RTO: float = 10
+ALPHA: float = 1/8 # gain of the smoothed RTT
+BETA: float = 1/4 # gain of the RTT variation
+K: float = 4
+CLOCK_GRANULARITY: float = 0.05 # tick of the TimerWheel which fires the retransmissions.
+
+class RttEstimator:
+    ''' Keeps the smoothed RTT of a link and computes its retransmission timeout.
+        By Karn's rule, the RTT of a retransmitted packet must not be sampled, because the ACK can't be matched to a transmission.
+        The packets outstanding on the link share the estimator, so the timeout is backed off once per round of timeouts:
+        epoch counts the backoffs, and a packet timed out in an epoch which has already been backed off doesn't double it
+        again. '''
+    __slots__ = ("srtt", "rttvar", "rto", "samples", "retransmissions", "granularity", "epoch")
+    srtt: float
+    rttvar: float
+    rto: float
+    samples: int
+    retransmissions: int
+    granularity: float
+    epoch: int
+
+    def __init__(self, granularity: float = CLOCK_GRANULARITY):
+        self.srtt = 0
+        self.rttvar = 0
+        self.rto = INITIAL_RTO
+        self.samples = 0
+        self.retransmissions = 0
+        self.granularity = granularity
+        self.epoch = 0
+
+    def sample(self, rtt: float):
+        ''' Updates the estimate with the RTT of a packet which has been acknowledged without being retransmitted '''
+        if self.samples == 0:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = (1 - BETA) * self.rttvar + BETA * abs(self.srtt - rtt)
+            self.srtt = (1 - ALPHA) * self.srtt + ALPHA * rtt
+        self.samples += 1
+        self.rto = self.clamp(self.srtt + max(self.granularity, K * self.rttvar))
+
+    def backoff(self, epoch: Optional[int] = None) -> int:
+        ''' Doubles the timeout after a retransmission timeout expired, unless the packet was scheduled in an earlier epoch
+            (another packet's timeout already backed it off in this round). Returns the current epoch '''
+        self.retransmissions += 1
+        if epoch is None or epoch == self.epoch:
+            self.rto = self.clamp(self.rto * 2)
+            self.epoch += 1
+        return self.epoch
+
+    @staticmethod
+    def clamp(rto: float) -> float:
+        return min(MAX_RTO, max(MIN_RTO, rto))
+
+    def __str__(self) -> str:
+        return "RTO %.1f ms (SRTT %.1f ms, RTTVAR %.1f ms), %d ritrasmissioni" % (self.rto * 1000, self.srtt * 1000,
+            self.rttvar * 1000, self.retransmissions)
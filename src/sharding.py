@@ -0,0 +1,328 @@
+import asyncio
+from functools import partial
+import logging
+import multiprocessing
+from multiprocessing.connection import Connection, wait
+import signal
+from socket import *
+from threading import Lock, Thread
+from typing import Callable, Optional
+import zlib
+from async_gateway import GatewayProtocol
+from batch_io import BatchDatagramTransport
+from DTOs import *
+from handshake import HalfOpenTable
+from impairment import ImpairmentConfig
+from liveness import LivenessTable
+import log
+from metrics import HANDSHAKE_LATENCY
+from Packet import *
+from registry import DroneRegistry, new_resumption_token
+from window import MAX_WINDOW
+
+# A sharded gateway: the drones are partitioned across worker processes, each one running a GatewayProtocol on its own
+# event loop, and the coordinator (the main process) passes them the handshakes and keeps a copy of every drone.
+
+LOG = logging.getLogger("gateway.sharding")
+
+
+def shard_of(address: Address, workers: int) -> int:
+    ''' The worker of the drone connecting from address.
+        crc32 rather than hash(), which is salted differently in every process '''
+    return zlib.crc32(("%s:%d" % address).encode()) % workers
+
+def worker_of(drone_id: int, workers: int) -> int:
+    ''' The worker which allocated the id, see DroneRegistry.id_step '''
+    return (drone_id - 1) % workers
+
+
+class WorkerConfig:
+    ''' The gateway's options that apply to every worker '''
+    backlog: int
+    handshake_timeout: float
+    liveness_timeout: float
+    impairment: ImpairmentConfig
+    max_window: int
+    batch_io: bool
+    reuse_port: bool
+    log_level: str
+    log_format: str
+    log_file: Optional[str]
+
+    def __init__(self, backlog: int, handshake_timeout: float, liveness_timeout: float, impairment: ImpairmentConfig,
+                 max_window: int = MAX_WINDOW, batch_io: bool = False, reuse_port: bool = False, log_level: str = "info",
+                 log_format: str = "text", log_file: Optional[str] = None):
+        self.backlog = backlog
+        self.handshake_timeout = handshake_timeout
+        self.liveness_timeout = liveness_timeout
+        self.impairment = impairment
+        self.max_window = max_window
+        self.batch_io = batch_io
+        self.reuse_port = reuse_port
+        self.log_level = log_level
+        self.log_format = log_format
+        self.log_file = log_file
+
+
+# ----- WORKER PROCESS -----
+class Worker:
+    ''' Serves a shard of the drones. Messages from the coordinator:
+            ("datagram", data, address): a datagram which a drone sent to the coordinator's address.
+            ("route", drone_id, shipping_addresses, route_number): a route assigned to a drone, numbered per drone.
+            ("stop",)
+        Reports to the coordinator:
+            ("state", drone_id, address, state, window, shipping_addresses, route_number): a drone connected or changed state,
+                with the number of the last route the worker received for it.
+            ("removed", drone_id): a dead drone has been unregistered.
+            ("moved", drone_id, address): a drone resumed its connection from another address.
+            ("handshake", seconds): a handshake completed, the coordinator keeps the metrics.
+            ("forward", worker, data, address): a datagram for another worker, received by the listener. '''
+    def __init__(self, index: int, workers: int, listener: socket, inbox: Connection, reports: Connection, config: WorkerConfig):
+        ''' listener is the socket bound to the drones' address, read by the coordinator unless config.reuse_port '''
+        self.index = index
+        self.workers = workers
+        self.listener = listener
+        self.inbox = inbox
+        self.reports = reports
+        self.config = config
+        self.connected_drones = DroneRegistry(first_id=index + 1, id_step=workers)
+        self.protocol = GatewayProtocol(self.connected_drones, HalfOpenTable(config.backlog, config.handshake_timeout),
+            self.report_state, config.impairment, config.max_window, LivenessTable(config.liveness_timeout), self.report_removed,
+            self.report_moved, listener, partial(new_resumption_token, index, workers), self.report_handshake)
+        self.route_numbers: dict[int, int] = {} # by drone id, the number of the last route received.
+        self.stopped: Optional[asyncio.Future] = None
+
+    async def serve(self):
+        loop = asyncio.get_running_loop()
+        self.stopped = loop.create_future()
+        if self.config.batch_io:
+            await BatchDatagramTransport.create(lambda: self.protocol, ('127.0.0.1', 0))
+        else:
+            await loop.create_datagram_endpoint(lambda: self.protocol, local_addr=('127.0.0.1', 0))
+        loop.add_reader(self.inbox.fileno(), self.inbox_ready)
+        if self.config.reuse_port:
+            loop.add_reader(self.listener.fileno(), self.listener_ready)
+        LOG.debug("Worker %d: serving drones on port %d", self.index, self.protocol.port)
+        await self.stopped
+        loop.remove_reader(self.inbox.fileno())
+        if self.config.reuse_port:
+            loop.remove_reader(self.listener.fileno())
+        self.protocol.close()
+
+    def listener_ready(self):
+        ''' Handshakes arriving at the worker's own listener socket '''
+        while True:
+            try:
+                data, address = self.listener.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            index = dispatch_to(data, address, self.workers)
+            if index == self.index or index is None:
+                self.protocol.datagram_received(data, address)
+            else:
+                self.reports.send(("forward", index, data, address))
+
+    def inbox_ready(self):
+        while self.inbox.poll():
+            try:
+                message = self.inbox.recv()
+            except EOFError: # the coordinator is gone
+                message = ("stop",)
+            if message[0] == "datagram":
+                self.protocol.datagram_received(message[1], message[2])
+            elif message[0] == "route":
+                drone = self.connected_drones.get_by_id(message[1])
+                if drone: # otherwise it has just been removed, the coordinator queues the route's jobs again
+                    self.route_numbers[drone.id] = message[3]
+                    drone.pending_shipping_requests = [ShippingRequestDTO(drone.id, address) for address in message[2]]
+                    self.protocol.shipping_request_added(drone)
+            else:
+                if not self.stopped.done():
+                    self.stopped.set_result(None)
+                return
+
+    def report_state(self, drone: Drone):
+        route = [r.shipping_address for r in drone.pending_shipping_requests]
+        self.reports.send(("state", drone.id, drone.address, drone.state, drone.window, route,
+            self.route_numbers.get(drone.id, 0)))
+
+    def report_removed(self, drone: Drone):
+        self.route_numbers.pop(drone.id, None)
+        self.reports.send(("removed", drone.id))
+
+    def report_moved(self, drone: Drone):
+        self.reports.send(("moved", drone.id, drone.address))
+
+    def report_handshake(self, seconds: float):
+        self.reports.send(("handshake", seconds))
+
+
+def dispatch_to(data: bytes, address: Address, workers: int) -> Optional[int]:
+    ''' The worker of the drone which sent a datagram to the gateway's address, None for the worker which received it
+        with reuse_port. A SYN resuming a connection goes to the worker named by its token '''
+    try:
+        packet = Packet.decode(data)
+    except ValueError:
+        return None # the worker ignores it
+    if packet.is_SYN and packet.token:
+        return packet.token % workers
+    return None
+
+def run_worker(index: int, workers: int, listener: Optional[socket], inbox: Connection, reports: Connection, config: WorkerConfig,
+               address: Address):
+    # the coordinator handles SIGINT for every process, as the terminal sends it to all of them.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    log.setup(config.log_level, config.log_format, config.log_file)
+    if config.reuse_port:
+        listener = socket(AF_INET, SOCK_DGRAM)
+        listener.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+        listener.bind(address)
+    asyncio.run(Worker(index, workers, listener, inbox, reports, config).serve())
+    reports.close()
+
+
+# ----- COORDINATOR -----
+class ShardedGateway:
+    ''' Starts the workers and relays between them and the rest of the gateway, from two background threads.
+        connected_drones holds the coordinator's copy of every drone: its id, address, state and route, sock is None.
+        Routes are numbered per drone, and a state report is ignored if the worker sent it before receiving the last route
+        assigned to the drone, as it would take the route away from the coordinator's copy '''
+    address: Address
+    workers: int
+    connected_drones: DroneRegistry
+    sock: Optional[socket]
+    processes: list[multiprocessing.Process]
+    inboxes: list[Connection]
+    reports: list[Connection]
+
+    def __init__(self, address: Address, workers: int, config: WorkerConfig, connected_drones: DroneRegistry,
+                 on_state_change: Callable[[Drone], None] = lambda drone: None,
+                 on_drone_removed: Callable[[Drone], None] = lambda drone: None,
+                 on_drone_moved: Callable[[Drone], None] = lambda drone: None):
+        ''' The callbacks are the same as GatewayProtocol's, called with the coordinator's copy of the drone '''
+        self.address = address
+        self.workers = workers
+        self.config = config
+        self.connected_drones = connected_drones
+        self.on_state_change = on_state_change
+        self.on_drone_removed = on_drone_removed
+        self.on_drone_moved = on_drone_moved
+        self.sock = None
+        self.processes = []
+        self.inboxes = []
+        self.inbox_locks = [Lock() for _ in range(workers)]
+        self.reports = []
+        self.running = True
+        self.threads: list[Thread] = []
+        self.routes_assigned: dict[int, int] = {} # by drone id, the number of the last route sent to its worker.
+        self.lock = Lock() # serializes the routes assigned with the state reports applied.
+
+    def start(self):
+        ''' Forks the workers, so it must be called before the gateway starts any other thread (but logging's) '''
+        if not self.config.reuse_port:
+            self.sock = socket(AF_INET, SOCK_DGRAM)
+            self.sock.bind(self.address)
+            self.sock.settimeout(0.5) # every half second check if app is being closed.
+        context = multiprocessing.get_context("fork")
+        for index in range(self.workers):
+            inbox, inbox_writer = context.Pipe(duplex=False)
+            reports_reader, reports = context.Pipe(duplex=False)
+            process = context.Process(target=run_worker,
+                args=(index, self.workers, self.sock, inbox, reports, self.config, self.address),
+                name="gateway-worker-%d" % index, daemon=True)
+            process.start()
+            inbox.close()
+            reports.close()
+            self.processes.append(process)
+            self.inboxes.append(inbox_writer)
+            self.reports.append(reports_reader)
+        self.threads = [Thread(target=self.collect)]
+        if self.sock:
+            self.threads.append(Thread(target=self.dispatch))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running = False
+        for index in range(self.workers):
+            self.send(index, ("stop",))
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+        for thread in self.threads:
+            thread.join()
+        if self.sock:
+            self.sock.close()
+
+    def send(self, index: int, message: tuple):
+        with self.inbox_locks[index]:
+            try:
+                self.inboxes[index].send(message)
+            except (BrokenPipeError, OSError):
+                LOG.error("Worker %d is gone, dropped a message for it", index)
+
+    def assign_route(self, drone: Drone, route: list[ShippingRequestDTO]):
+        ''' Thread-safe: sets the route of the coordinator's copy of the drone and sends it to the drone's worker '''
+        with self.lock:
+            drone.pending_shipping_requests = route
+            route_number = self.routes_assigned.get(drone.id, 0) + 1
+            self.routes_assigned[drone.id] = route_number
+            self.send(worker_of(drone.id, self.workers), ("route", drone.id, [r.shipping_address for r in route], route_number))
+
+    def dispatch(self):
+        ''' Passes every datagram arriving at the gateway's address to the worker of its drone '''
+        while self.running:
+            try:
+                data, address = self.sock.recvfrom(4096)
+            except timeout:
+                continue
+            except OSError: # closed
+                return
+            index = dispatch_to(data, address, self.workers)
+            self.send(shard_of(address, self.workers) if index is None else index, ("datagram", data, address))
+
+    def collect(self):
+        ''' Applies the workers' reports to the coordinator's copy of the drones '''
+        reports = list(self.reports)
+        while reports:
+            for connection in wait(reports, timeout=0.5):
+                try:
+                    report = connection.recv()
+                except EOFError: # the worker exited
+                    reports.remove(connection)
+                    continue
+                self.report_received(report)
+
+    def report_received(self, report: tuple):
+        if report[0] == "forward":
+            self.send(report[1], ("datagram", report[2], report[3]))
+            return
+        if report[0] == "handshake":
+            HANDSHAKE_LATENCY.observe(report[1])
+            return
+        kind, drone_id = report[0], report[1]
+        drone = self.connected_drones.get_by_id(drone_id)
+        if kind == "state":
+            _, _, address, state, window, route, route_number = report
+            with self.lock:
+                if route_number < self.routes_assigned.get(drone_id, 0):
+                    LOG.debug("Ignored a state report of drone %d older than its last route", drone_id, extra={"drone": drone_id})
+                    return
+                if not drone:
+                    drone = Drone(drone_id, address, state, None)
+                    self.connected_drones.add(drone)
+                drone.state = state
+                drone.window = window
+                drone.pending_shipping_requests = [ShippingRequestDTO(drone_id, a) for a in route]
+            self.on_state_change(drone)
+        elif not drone:
+            return
+        elif kind == "removed":
+            with self.lock:
+                self.routes_assigned.pop(drone_id, None)
+            self.connected_drones.remove(drone)
+            self.on_drone_removed(drone)
+        elif kind == "moved":
+            self.connected_drones.move(drone, report[2])
+            self.on_drone_moved(drone)
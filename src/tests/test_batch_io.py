@@ -0,0 +1,62 @@
+from socket import socket, AF_INET, SOCK_DGRAM
+import unittest
+import batch_io
+from batch_io import BatchSocket
+
+class PartialLibc:
+    ''' The libc of batch_io whose sendmmsg takes at most limit messages at a time, as it does when it's interrupted '''
+    def __init__(self, libc, limit: int):
+        self.libc = libc
+        self.limit = limit
+        self.recvmmsg = libc.recvmmsg
+
+    def sendmmsg(self, fd, headers, count, flags):
+        return self.libc.sendmmsg(fd, headers, min(count, self.limit), flags)
+
+
+class BatchSocketTest(unittest.TestCase):
+    def setUp(self):
+        self.receiver = socket(AF_INET, SOCK_DGRAM)
+        self.receiver.bind(("127.0.0.1", 0))
+        self.receiver.settimeout(1)
+        self.sender = socket(AF_INET, SOCK_DGRAM)
+        self.sender.bind(("127.0.0.1", 0))
+
+    def tearDown(self):
+        self.receiver.close()
+        self.sender.close()
+
+    def received(self, count: int) -> list[bytes]:
+        return [self.receiver.recvfrom(4096)[0] for _ in range(count)]
+
+    def test_every_datagram_is_sent_in_order(self):
+        sender = BatchSocket(self.sender, batch_size=8)
+        datagrams = [(b"datagram %d" % i, self.receiver.getsockname()) for i in range(20)]
+        self.assertEqual(sender.send_many(datagrams), 20)
+        self.assertEqual(self.received(20), [data for data, _ in datagrams])
+
+    @unittest.skipUnless(batch_io._libc, "sendmmsg isn't available")
+    def test_the_rest_of_a_partial_sendmmsg_is_sent_too(self):
+        sender = BatchSocket(self.sender, batch_size=8)
+        libc = batch_io._libc
+        batch_io._libc = PartialLibc(libc, 3)
+        try:
+            datagrams = [(b"datagram %d" % i, self.receiver.getsockname()) for i in range(8)]
+            self.assertEqual(sender.send_many(datagrams), 8)
+        finally:
+            batch_io._libc = libc
+        self.assertEqual(sender.syscalls, 3)
+        self.assertEqual(self.received(8), [data for data, _ in datagrams])
+
+    def test_received_datagrams_carry_their_source_address(self):
+        receiver = BatchSocket(self.receiver)
+        for i in range(3):
+            self.sender.sendto(b"datagram %d" % i, self.receiver.getsockname())
+        datagrams = []
+        while len(datagrams) < 3:
+            datagrams += [(bytes(data), address) for data, address in receiver.recv_many()]
+        self.assertEqual(datagrams, [(b"datagram %d" % i, self.sender.getsockname()) for i in range(3)])
+
+
+if __name__ == "__main__":
+    unittest.main()
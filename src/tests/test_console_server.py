@@ -0,0 +1,53 @@
+import selectors
+import unittest
+from socket import socketpair
+from console_server import ConsoleConnection, ConsoleServer, SlowClientPolicy
+
+class SlowClientTest(unittest.TestCase):
+    ''' A client which never reads: its queue is only filled '''
+    def server(self, policy: str) -> ConsoleServer:
+        server = ConsoleServer(("127.0.0.1", 0), lambda connection, message: None, max_queued=4, slow_client_policy=policy)
+        self.addCleanup(server.close)
+        sock, peer = socketpair()
+        self.addCleanup(peer.close)
+        self.connection = ConsoleConnection(sock, ("127.0.0.1", 1))
+        server.connections[sock] = self.connection
+        server.selector.register(sock, selectors.EVENT_READ)
+        return server
+
+    def test_broadcasts_are_dropped_when_the_queue_is_full(self):
+        server = self.server(SlowClientPolicy.DROP)
+        for _ in range(6):
+            server.broadcast(b"delta")
+        self.assertEqual(len(self.connection.outbound), 4)
+        self.assertEqual(self.connection.dropped_messages, 2)
+        self.assertFalse(self.connection.closed)
+
+    def test_replies_are_queued_even_if_the_queue_is_full(self):
+        server = self.server(SlowClientPolicy.DROP)
+        for _ in range(4):
+            server.broadcast(b"delta")
+        server.send(self.connection, b"snapshot")
+        self.assertEqual(len(self.connection.outbound), 5)
+        self.assertEqual(bytes(self.connection.outbound[-1])[-8:], b"snapshot")
+        self.assertFalse(self.connection.closed)
+
+    def test_a_client_which_lets_replies_pile_up_is_disconnected(self):
+        server = self.server(SlowClientPolicy.DROP)
+        for _ in range(8):
+            server.send(self.connection, b"reply")
+        self.assertFalse(self.connection.closed)
+        server.send(self.connection, b"reply")
+        self.assertTrue(self.connection.closed)
+
+    def test_disconnect_policy(self):
+        server = self.server(SlowClientPolicy.DISCONNECT)
+        for _ in range(4):
+            server.broadcast(b"delta")
+        self.assertFalse(self.connection.closed)
+        server.send(self.connection, b"snapshot")
+        self.assertTrue(self.connection.closed)
+
+
+if __name__ == "__main__":
+    unittest.main()
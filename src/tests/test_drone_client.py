@@ -0,0 +1,110 @@
+import asyncio
+import unittest
+from async_gateway import GatewayProtocol
+from drone_client import DroneClientState, DroneFleet
+from DTOs import *
+from impairment import ImpairmentConfig, ImpairmentProfile
+from jobs import JobScheduler
+from registry import DroneRegistry
+
+class FleetTest(unittest.TestCase):
+    ''' A fleet of DroneClients against an asyncio gateway running on the same event loop,
+        with jobs assigned as the gateway does '''
+    def run_fleet(self, drones: int, jobs: int, window: int = 1, impairment: Optional[ImpairmentConfig] = None,
+                  timeout: float = 20) -> DroneFleet:
+        async def run() -> DroneFleet:
+            loop = asyncio.get_running_loop()
+            connected_drones = DroneRegistry()
+            def assign(drone: Drone, route: list[ShippingRequestDTO]):
+                drone.pending_shipping_requests = route
+                protocol.shipping_request_added(drone)
+            scheduler = JobScheduler(assign)
+            def state_changed(drone: Drone):
+                if drone.state == DroneState.AVAILABLE:
+                    scheduler.drone_available(drone)
+            protocol = GatewayProtocol(connected_drones, on_state_change=state_changed, impairment=impairment)
+            transport, _ = await loop.create_datagram_endpoint(lambda: protocol, local_addr=("127.0.0.1", 0))
+            fleet = DroneFleet(transport.get_extra_info("sockname"), flight_time=(0.01, 0.02), impairment=impairment, seed=1,
+                window=window)
+            try:
+                await fleet.launch(drones)
+                for i in range(jobs):
+                    scheduler.submit("Job %d" % i)
+                deadline = loop.time() + timeout
+                while ((fleet.shipments < jobs or len(scheduler) or fleet.count(DroneClientState.SHIPPING))
+                       and loop.time() < deadline):
+                    await asyncio.sleep(0.01)
+            finally:
+                fleet.close()
+                protocol.close()
+            return fleet
+        return asyncio.run(run())
+
+    def test_every_job_is_shipped(self):
+        fleet = self.run_fleet(drones=20, jobs=60)
+        self.assertEqual(len(fleet.connect_latencies), 20)
+        self.assertEqual(fleet.shipments, 60)
+
+    def test_every_job_is_shipped_with_windowed_routes(self):
+        fleet = self.run_fleet(drones=10, jobs=60, window=4)
+        self.assertEqual(fleet.shipments, 60)
+
+    def test_every_job_is_shipped_despite_losses(self):
+        profile = ImpairmentProfile(loss=0.1)
+        fleet = self.run_fleet(drones=10, jobs=20, window=2, impairment=ImpairmentConfig(profile, profile, seed=3), timeout=60)
+        self.assertEqual(fleet.shipments, 20)
+
+    def test_a_restarted_drone_resumes_its_connection(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            connected_drones = DroneRegistry()
+            protocol = GatewayProtocol(connected_drones)
+            transport, _ = await loop.create_datagram_endpoint(lambda: protocol, local_addr=("127.0.0.1", 0))
+            address = transport.get_extra_info("sockname")
+            tokens = []
+            first = DroneFleet(address, on_connected=lambda drone: tokens.append(drone.token))
+            await first.launch(1)
+            while first.count(DroneClientState.WAITING_SHP) < 1:
+                await asyncio.sleep(0.01)
+            first.close() # the drone dies, a new process takes over with its token
+            restarted = DroneFleet(address, on_connected=lambda drone: tokens.append(drone.token))
+            await restarted.launch(1, tokens)
+            while restarted.count(DroneClientState.WAITING_SHP) < 1:
+                await asyncio.sleep(0.01)
+            restarted.close()
+            protocol.close()
+            return tokens, connected_drones
+        tokens, connected_drones = asyncio.run(asyncio.wait_for(run(), 10))
+        self.assertEqual(len(tokens), 1) # the restarted drone didn't get a new connection
+        self.assertEqual(len(connected_drones), 1)
+
+    def test_a_drone_restarted_while_receiving_a_route_gets_all_of_it(self):
+        async def run():
+            loop = asyncio.get_running_loop()
+            connected_drones = DroneRegistry()
+            protocol = GatewayProtocol(connected_drones)
+            transport, _ = await loop.create_datagram_endpoint(lambda: protocol, local_addr=("127.0.0.1", 0))
+            address = transport.get_extra_info("sockname")
+            tokens = []
+            first = DroneFleet(address, window=4, on_connected=lambda drone: tokens.append(drone.token))
+            await first.launch(1)
+            while first.count(DroneClientState.WAITING_SHP) < 1:
+                await asyncio.sleep(0.01)
+            drone = next(iter(connected_drones.values()))
+            drone.pending_shipping_requests = [ShippingRequestDTO(None, "Stop %d" % i) for i in range(3)]
+            protocol.shipping_request_added(drone)
+            first.close() # the drone dies before it gets the SHPs
+            restarted = DroneFleet(address, flight_time=(0.01, 0.02), window=4)
+            await restarted.launch(1, tokens)
+            while restarted.shipments < 3:
+                await asyncio.sleep(0.01)
+            route = restarted.drones[0].route
+            restarted.close()
+            protocol.close()
+            return route
+        route = asyncio.run(asyncio.wait_for(run(), 10))
+        self.assertEqual(route, ["Stop 0", "Stop 1", "Stop 2"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,30 @@
+import unittest
+from DTOs import *
+
+class ShippingAddressTest(unittest.TestCase):
+    def test_addresses_holding_the_separators_are_invalid(self):
+        self.assertTrue(ShippingRequestDTO.is_valid_address("Via Roma 1, Milano"))
+        self.assertFalse(ShippingRequestDTO.is_valid_address(""))
+        self.assertFalse(ShippingRequestDTO.is_valid_address("Via Roma:::1"))
+        self.assertFalse(ShippingRequestDTO.is_valid_address("Via Roma\n1"))
+        self.assertFalse(ShippingRequestDTO.is_valid_address("x" * (MAX_ADDRESS_LENGTH + 1)))
+
+    def test_an_address_holding_the_field_separator_decodes_whole(self):
+        request = ShippingRequestDTO.decode(b"3:::Via Roma:::1")
+        self.assertEqual(request.drone_id, 3)
+        self.assertEqual(request.shipping_address, "Via Roma:::1")
+
+    def test_valid_addresses_survive_a_drones_update(self):
+        drone = Drone(1, ("127.0.0.1", 1000), DroneState.CURRENTLY_SHIPPING, None)
+        drone.pending_shipping_requests = [ShippingRequestDTO(1, "Via Roma 1"), ShippingRequestDTO(1, "Piazza Duomo")]
+        update = DronesUpdateDTO.decode(DronesUpdateDTO(7, True, [DroneStatusDTO.of(drone)]).encode())
+        self.assertEqual(update.drones[0].shipping_address, "Via Roma 1 -> Piazza Duomo")
+
+    def test_messages_may_quote_the_separator(self):
+        dto = GatewayInterfaceDTO.decode(GatewayInterfaceDTO("non può contenere \":::\"", is_error=True).encode())
+        self.assertTrue(dto.is_error)
+        self.assertEqual(dto.message, "non può contenere \":::\"")
+
+
+if __name__ == "__main__":
+    unittest.main()
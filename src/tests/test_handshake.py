@@ -0,0 +1,41 @@
+import unittest
+from DTOs import *
+from handshake import HalfOpenTable
+
+def drone(port: int) -> Drone:
+    return Drone(port, ("127.0.0.1", port), DroneState.NOT_AVAILABLE, None)
+
+class HalfOpenTableTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.table = HalfOpenTable(backlog=3, timeout=10, clock=lambda: self.now)
+
+    def test_the_table_is_full_at_the_backlog(self):
+        for port in (9001, 9002):
+            self.table.add(drone(port), ("SYNACK", port))
+        self.assertFalse(self.table.is_full())
+        self.table.add(drone(9003), ("SYNACK", 9003))
+        self.assertTrue(self.table.is_full())
+        self.table.remove(("127.0.0.1", 9002)) # the drone's ACK arrived
+        self.assertFalse(self.table.is_full())
+        self.assertNotIn(("127.0.0.1", 9002), self.table)
+
+    def test_stale_handshakes_are_evicted_oldest_first(self):
+        for port in (9001, 9002, 9003):
+            self.table.add(drone(port), ("SYNACK", port))
+            self.now += 4
+        self.now = 16.5 # the first two started more than 10 seconds ago
+        self.assertEqual([connection.drone.address[1] for connection in self.table.evict_stale()], [9001, 9002])
+        self.assertEqual(len(self.table), 1)
+        self.assertEqual(self.table.get(("127.0.0.1", 9003)).SYNACK_key, ("SYNACK", 9003))
+        self.assertEqual(self.table.evict_stale(), [])
+
+    def test_clear_returns_every_handshake(self):
+        for port in (9001, 9002):
+            self.table.add(drone(port), ("SYNACK", port))
+        self.assertEqual(len(self.table.clear()), 2)
+        self.assertEqual(len(self.table), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,51 @@
+import unittest
+from impairment import Impairment, ImpairmentConfig, ImpairmentProfile
+
+PROFILE = ImpairmentProfile.parse("loss=0.1,burst=0.05:0.4:0.8,delay=0.02,jitter=0.005,duplicate=0.05,reorder=0.1")
+
+class ImpairmentTest(unittest.TestCase):
+    def test_a_seed_reproduces_the_same_drops_and_delays(self):
+        first, second = Impairment(PROFILE, seed=42), Impairment(PROFILE, seed=42)
+        fates = [first.delays() for _ in range(2000)]
+        self.assertEqual([second.delays() for _ in range(2000)], fates)
+        self.assertEqual((first.lost, first.duplicated), (second.lost, second.duplicated))
+        self.assertTrue(any(not delays for delays in fates) and any(len(delays) == 2 for delays in fates))
+        other = Impairment(PROFILE, seed=43)
+        self.assertNotEqual([other.delays() for _ in range(2000)], fates)
+
+    def test_a_seed_reproduces_the_links_of_a_config(self):
+        def fates(config: ImpairmentConfig) -> list[list[float]]:
+            outbound, inbound = config.link()
+            return [outbound.delays() for _ in range(200)] + [[inbound.is_lost()] for _ in range(200)]
+        self.assertEqual(fates(ImpairmentConfig(PROFILE, PROFILE, seed=7)), fates(ImpairmentConfig(PROFILE, PROFILE, seed=7)))
+
+    def test_gilbert_elliott_transitions_follow_their_probabilities(self):
+        impairment = Impairment(ImpairmentProfile(loss=0, burst_start=0.1, burst_end=0.3, bad_loss=1), seed=1)
+        transitions = {(False, False): 0, (False, True): 0, (True, False): 0, (True, True): 0}
+        for _ in range(100_000):
+            was_bad = impairment.bad
+            lost = impairment.is_lost()
+            self.assertEqual(lost, impairment.bad) # only the bad state loses datagrams, and it loses all of them
+            transitions[was_bad, impairment.bad] += 1
+        good = transitions[False, False] + transitions[False, True]
+        bad = transitions[True, False] + transitions[True, True]
+        self.assertAlmostEqual(transitions[False, True] / good, 0.1, delta=0.01)
+        self.assertAlmostEqual(transitions[True, False] / bad, 0.3, delta=0.01)
+        self.assertAlmostEqual(impairment.lost / impairment.sent, 0.1 / (0.1 + 0.3), delta=0.01) # the stationary bad state
+
+    def test_losses_are_independent_without_bursts(self):
+        impairment = Impairment(ImpairmentProfile(loss=0.25), seed=1)
+        for _ in range(100_000):
+            impairment.is_lost()
+            self.assertFalse(impairment.bad)
+        self.assertAlmostEqual(impairment.lost / impairment.sent, 0.25, delta=0.01)
+
+    def test_a_profile_is_parsed_back_from_its_string(self):
+        self.assertEqual(str(ImpairmentProfile.parse(str(PROFILE))), str(PROFILE))
+        self.assertTrue(ImpairmentProfile.parse("none").is_perfect)
+        with self.assertRaises(ValueError):
+            ImpairmentProfile.parse("lag=1")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,70 @@
+import unittest
+from DTOs import *
+from jobs import ASSIGNMENT_POLICIES, JobScheduler
+
+class JobSchedulerTest(unittest.TestCase):
+    def scheduler(self, policy: str) -> JobScheduler:
+        self.now = 0.0
+        self.assigned: list[tuple[int, list[str]]] = []
+        self.drones = {id: Drone(id, ("127.0.0.1", 9000 + id), DroneState.AVAILABLE, None) for id in (1, 2, 3)}
+        return JobScheduler(self.assign, ASSIGNMENT_POLICIES[policy], clock=lambda: self.now)
+
+    def assign(self, drone: Drone, requests: list[ShippingRequestDTO]):
+        drone.pending_shipping_requests = requests
+        self.assigned.append((drone.id, [request.shipping_address for request in requests]))
+
+    def available(self, scheduler: JobScheduler, *ids: int):
+        ''' The drones become available one second apart, in this order '''
+        for id in ids:
+            self.drones[id].pending_shipping_requests = []
+            scheduler.drone_available(self.drones[id])
+            self.now += 1
+
+    def submitted(self, scheduler: JobScheduler, count: int) -> list[int]:
+        ''' The drones which got the next count jobs '''
+        for i in range(count):
+            scheduler.submit("Stop %d" % i)
+            self.now += 1
+        return [id for id, _ in self.assigned[-count:]]
+
+    def test_fifo_chooses_the_drone_available_for_the_longest_time(self):
+        scheduler = self.scheduler("fifo")
+        self.available(scheduler, 2, 3, 1)
+        self.assertEqual(self.submitted(scheduler, 3), [2, 3, 1])
+
+    def test_shortest_idle_chooses_the_drone_which_has_just_become_available(self):
+        scheduler = self.scheduler("shortest-idle")
+        self.available(scheduler, 2, 3, 1)
+        self.assertEqual(self.submitted(scheduler, 3), [1, 3, 2])
+
+    def test_lru_chooses_the_drone_whose_last_job_is_the_oldest(self):
+        scheduler = self.scheduler("lru")
+        self.available(scheduler, 1, 2)
+        self.assertEqual(self.submitted(scheduler, 2), [1, 2]) # 1 had its job first
+        self.available(scheduler, 2, 1, 3) # 3 never had a job
+        self.assertEqual(self.submitted(scheduler, 3), [3, 1, 2])
+
+    def test_jobs_wait_when_no_drone_is_eligible(self):
+        scheduler = self.scheduler("fifo")
+        self.available(scheduler, 1, 2)
+        self.drones[1].state = DroneState.CURRENTLY_SHIPPING # its entry is discarded when it reaches the top
+        scheduler.drone_removed(self.drones[2])
+        job = scheduler.submit("Via Zamboni 33")
+        self.assertEqual(self.assigned, [])
+        self.assertEqual(list(scheduler.jobs), [job])
+        self.available(scheduler, 3) # the first drone available takes the waiting job
+        self.assertEqual(self.assigned, [(3, ["Via Zamboni 33"])])
+        self.assertEqual(len(scheduler), 0)
+
+    def test_a_drone_takes_as_many_waiting_jobs_as_its_window(self):
+        scheduler = self.scheduler("fifo")
+        for i in range(3):
+            scheduler.submit("Stop %d" % i)
+        self.drones[1].window = 2
+        self.available(scheduler, 1)
+        self.assertEqual(self.assigned, [(1, ["Stop 0", "Stop 1"])])
+        self.assertEqual(len(scheduler), 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,132 @@
+import json
+import os
+from socket import socket, AF_INET, SOCK_DGRAM
+import tempfile
+import unittest
+from DTOs import *
+import gateway
+from jobs import JobScheduler, ShippingJob
+from journal import JOURNAL_FILE, SNAPSHOT_FILE, FleetState, Journal, replay
+from Packet import Packet
+
+def drone(id: int, send_sequence_number: int = 1, sock: Optional[socket] = None) -> Drone:
+    drone = Drone(id, ("127.0.0.1", 9000 + id), DroneState.AVAILABLE, sock, send_sequence_number, 2)
+    drone.pending_shipping_requests = [ShippingRequestDTO(id, "Stop %d" % id)]
+    return drone
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.journal = Journal(self.directory.name, fsync_interval=0.001, compact_every=10)
+        self.journal.start(FleetState())
+
+    def tearDown(self):
+        if self.journal.thread and self.journal.thread.is_alive():
+            self.crash()
+        if self.journal.file:
+            self.journal.file.close()
+        self.directory.cleanup()
+
+    def crash(self):
+        ''' Stops the writer after the records enqueued, without the snapshot of a clean stop '''
+        self.journal.records.put(None)
+        self.journal.thread.join()
+
+    def journaled_records(self) -> list[str]:
+        with open(os.path.join(self.directory.name, JOURNAL_FILE), encoding="utf-8") as f:
+            return f.read().splitlines()
+
+    def test_every_transition_is_replayed(self):
+        self.journal.drone(drone(1))
+        self.journal.drone(drone(2))
+        self.journal.drone_removed(drone(1))
+        self.journal.job_queued(ShippingJob(1, "Via Zamboni 33", 0))
+        self.journal.job_queued(ShippingJob(2, "Piazza Maggiore", 0))
+        self.journal.jobs_dequeued([ShippingJob(1, "Via Zamboni 33", 0)])
+        self.crash()
+        state = replay(self.directory.name)
+        self.assertEqual(list(state.drones), [2])
+        self.assertEqual(state.drones[2].route, ["Stop 2"])
+        self.assertEqual(state.drones[2].expected_recv_sequence_number, 2)
+        self.assertEqual(state.jobs, {2: "Piazza Maggiore"})
+        self.assertEqual((state.lsn, state.next_drone_id, state.next_job_id), (6, 3, 3))
+
+    def test_a_record_torn_by_a_crash_ends_the_replay(self):
+        self.journal.drone(drone(1))
+        self.journal.drone(drone(2))
+        self.crash()
+        with open(os.path.join(self.directory.name, JOURNAL_FILE), "a", encoding="utf-8") as f:
+            f.write('{"op": "removed", "id": 1, "ls')
+        state = replay(self.directory.name)
+        self.assertEqual(sorted(state.drones), [1, 2])
+        self.assertEqual(state.lsn, 2)
+
+    def test_the_journal_is_compacted_into_a_snapshot(self):
+        for i in range(25):
+            self.journal.drone(drone(i % 5 + 1, send_sequence_number=i))
+        self.crash()
+        with open(os.path.join(self.directory.name, SNAPSHOT_FILE), encoding="utf-8") as f:
+            self.assertEqual(json.load(f)["lsn"], 20)
+        self.assertEqual(len(self.journaled_records()), 5)
+        state = replay(self.directory.name) # the snapshot and the records after it
+        self.assertEqual(state.lsn, 25)
+        self.assertEqual({id: d.send_sequence_number for id, d in state.drones.items()}, {1: 20, 2: 21, 3: 22, 4: 23, 5: 24})
+
+    def test_records_older_than_the_snapshot_are_skipped(self):
+        ''' a crash between writing the snapshot and emptying the journal '''
+        self.journal.drone(drone(1))
+        self.journal.drone_removed(drone(1))
+        self.crash()
+        records = self.journaled_records()
+        self.journal.compact()
+        with open(os.path.join(self.directory.name, JOURNAL_FILE), "w", encoding="utf-8") as f:
+            f.write("\n".join(records) + "\n")
+        state = replay(self.directory.name)
+        self.assertEqual(state.drones, {})
+        self.assertEqual(state.lsn, 2)
+
+    def test_a_clean_stop_leaves_only_a_snapshot(self):
+        self.journal.drone(drone(1))
+        self.journal.stop()
+        self.assertEqual(self.journaled_records(), [])
+        self.assertEqual(list(replay(self.directory.name).drones), [1])
+
+    def test_the_port_of_a_removed_drone_is_kept(self):
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        port = sock.getsockname()[1]
+        self.journal.drone(drone(1, sock=sock))
+        sock.close()
+        self.journal.drone(drone(1, send_sequence_number=2, sock=sock))
+        self.crash()
+        state = replay(self.directory.name)
+        self.assertEqual(state.drones[1].port, port)
+        self.assertEqual(state.drones[1].send_sequence_number, 2)
+
+    def test_an_AVB_received_while_idle_is_journaled(self):
+        ''' a restarted drone which didn't know it was already AVAILABLE '''
+        sock = socket(AF_INET, SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(1)
+        peer = socket(AF_INET, SOCK_DGRAM)
+        peer.bind(("127.0.0.1", 0))
+        self.addCleanup(sock.close)
+        self.addCleanup(peer.close)
+        idle = Drone(1, peer.getsockname(), DroneState.AVAILABLE, sock, 1, 2)
+        self.journal.drone(idle)
+        self.patch(gateway, "JOURNAL", self.journal)
+        self.patch(gateway, "JOBS", JobScheduler(lambda drone, requests: None))
+        peer.sendto(Packet.AVB(2).encode(), sock.getsockname())
+        gateway.listen_while_idle(idle)
+        self.assertEqual(idle.expected_recv_sequence_number, 3)
+        self.crash()
+        self.assertEqual(replay(self.directory.name).drones[1].expected_recv_sequence_number, 3)
+
+    def patch(self, module, name: str, value):
+        original = getattr(module, name, None)
+        setattr(module, name, value)
+        self.addCleanup(setattr, module, name, original)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+from DTOs import *
+from liveness import LivenessTable
+
+class LivenessTableTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 0.0
+        self.table = LivenessTable(timeout=10, clock=lambda: self.now)
+        self.drones = [Drone(id, ("127.0.0.1", 9000 + id), DroneState.AVAILABLE, None) for id in (1, 2, 3)]
+
+    def test_the_drones_silent_for_too_long_are_evicted(self):
+        for drone in self.drones:
+            self.table.heard(drone)
+            self.now += 1
+        self.table.heard(self.drones[0])
+        self.now = 11.5
+        self.assertEqual([d.id for d in self.table.evict_dead()], [2])
+        self.assertEqual(len(self.table), 2)
+
+    def test_an_evicted_drone_is_evicted_only_once(self):
+        self.table.heard(self.drones[0])
+        self.now = 11
+        self.assertEqual(self.table.evict_dead(), [self.drones[0]])
+        self.table.touch(self.drones[0]) # a late packet read by the drone's thread
+        self.now = 30
+        self.assertEqual(self.table.evict_dead(), [])
+
+    def test_touch_refreshes_a_tracked_drone(self):
+        self.table.heard(self.drones[0])
+        self.now = 9
+        self.table.touch(self.drones[0])
+        self.now = 15
+        self.assertEqual(self.table.evict_dead(), [])
+        self.assertEqual(self.drones[0].last_heard, 9)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,41 @@
+import struct
+import unittest
+from Packet import *
+
+def round_trip(packet: Packet) -> Packet:
+    return Packet.decode(packet.encode())
+
+class PacketTest(unittest.TestCase):
+    def test_an_ACK_carries_its_SACK_blocks(self):
+        ACK = round_trip(Packet.ACK(5, SACK_blocks=[(7, 9), (12, 13)]))
+        self.assertEqual(list(ACK.SACK_blocks), [(7, 9), (12, 13)])
+        self.assertIsNone(ACK.token)
+
+    def test_the_token_has_its_own_flag(self):
+        SYNACK = round_trip(Packet.SYNACK(ACK_number=1, new_port=54321, window=8, token=0x0123456789ABCDEF))
+        self.assertEqual((SYNACK.window, SYNACK.token), (8, 0x0123456789ABCDEF))
+        self.assertEqual(SYNACK.SACK_blocks, ())
+        self.assertFalse(SYNACK.route_follows or SYNACK.has_more_stops)
+        self.assertEqual(round_trip(Packet.SYN(token=NO_TOKEN)).token, NO_TOKEN)
+
+    def test_a_resumed_SYNACK_says_the_route_follows(self):
+        SYNACK = round_trip(Packet.SYNACK(ACK_number=3, new_port=54321, token=1, sequence_number=4, route_follows=True))
+        self.assertTrue(SYNACK.route_follows)
+        self.assertFalse(SYNACK.has_more_stops)
+
+    def test_packets_without_the_new_flags_stay_version_1(self):
+        for packet in (Packet.ACK(5, SACK_blocks=[(7, 9)]), Packet.SHP(4, "Via Zamboni 33", has_more_stops=True),
+            Packet.SYN(window=4)):
+            self.assertEqual(packet.encode()[0], 1)
+        self.assertEqual(Packet.SYN(token=NO_TOKEN).encode()[0], WIRE_VERSION)
+
+    def test_version_1_resumption_flags_are_understood(self):
+        SYNACK = struct.pack('!BBIIHH', 1, FLAG_SYNACK | 0x40 | 0x80, 4, 3, 54321, 0xFFFF) + struct.pack('!Q', 7)
+        packet = Packet.decode(SYNACK)
+        self.assertEqual(packet.token, 7)
+        self.assertTrue(packet.route_follows)
+        self.assertFalse(packet.has_more_stops)
+
+
+if __name__ == "__main__":
+    unittest.main()
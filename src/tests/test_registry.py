@@ -0,0 +1,56 @@
+import unittest
+from DTOs import *
+from registry import DroneRegistry, new_resumption_token
+
+class DroneRegistryTest(unittest.TestCase):
+    def setUp(self):
+        self.registry = DroneRegistry()
+
+    def drone(self, port: int, token: Optional[int] = None) -> Drone:
+        drone = Drone(self.registry.allocate_id(), ("127.0.0.1", port), DroneState.AVAILABLE, None)
+        drone.resumption_token = token
+        self.registry.add(drone)
+        return drone
+
+    def assertIndexed(self, *drones: Drone):
+        ''' The three indexes hold exactly these drones '''
+        self.assertEqual(self.registry.by_id, {drone.id: drone for drone in drones})
+        self.assertEqual(self.registry.by_address, {drone.address: drone for drone in drones})
+        self.assertEqual(self.registry.by_token,
+            {drone.resumption_token: drone for drone in drones if drone.resumption_token is not None})
+
+    def test_a_removed_drone_leaves_every_index(self):
+        first, second = self.drone(9001, token=11), self.drone(9002)
+        self.assertTrue(self.registry.remove(first))
+        self.assertIndexed(second)
+        self.assertFalse(self.registry.remove(first))
+        self.assertIsNone(self.registry.get_by_token(11))
+
+    def test_a_moved_drone_is_found_at_its_new_address_only(self):
+        moved, other = self.drone(9001, token=11), self.drone(9002, token=12)
+        self.registry.move(moved, ("127.0.0.1", 9101))
+        self.assertIndexed(moved, other)
+        self.assertNotIn(("127.0.0.1", 9001), self.registry)
+        self.assertIs(self.registry.get_by_token(11), moved)
+        self.registry.remove(moved)
+        self.assertIndexed(other)
+
+    def test_removing_a_drone_keeps_the_new_drone_at_its_address(self):
+        ''' a drone restarted without its token connects again as a new drone before the old one is reaped '''
+        old = self.drone(9001, token=11)
+        new = self.drone(9001, token=12)
+        self.assertTrue(self.registry.remove(old))
+        self.assertIndexed(new)
+
+    def test_ids_are_never_reused(self):
+        first = self.drone(9001)
+        self.registry.remove(first)
+        self.assertEqual(self.drone(9001).id, first.id + 1)
+
+    def test_tokens_name_their_shard(self):
+        for shard in range(4):
+            self.assertEqual(new_resumption_token(shard, 4) % 4, shard)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,150 @@
+import unittest
+from rtt import INITIAL_RTO, K, MAX_RTO, MIN_RTO, RttEstimator
+from timer_wheel import RetransmissionScheduler, TimerWheel
+from tests.test_timer_wheel import FakeClock
+
+class RttEstimatorTest(unittest.TestCase):
+    def test_initial_timeout(self):
+        self.assertEqual(RttEstimator().rto, INITIAL_RTO)
+
+    def test_first_sample(self):
+        rtt = RttEstimator(granularity=0.01)
+        rtt.sample(0.2)
+        self.assertAlmostEqual(rtt.srtt, 0.2)
+        self.assertAlmostEqual(rtt.rttvar, 0.1)
+        self.assertAlmostEqual(rtt.rto, 0.2 + K * 0.1)
+
+    def test_later_samples_are_smoothed(self):
+        rtt = RttEstimator(granularity=0.01)
+        rtt.sample(0.2)
+        rtt.sample(0.6)
+        self.assertAlmostEqual(rtt.rttvar, 3/4 * 0.1 + 1/4 * 0.4)
+        self.assertAlmostEqual(rtt.srtt, 7/8 * 0.2 + 1/8 * 0.6)
+        self.assertEqual(rtt.samples, 2)
+
+    def test_timeout_is_at_least_the_clock_granularity_above_the_rtt(self):
+        rtt = RttEstimator(granularity=0.05)
+        for _ in range(50):
+            rtt.sample(0.2) # the variation decays towards 0
+        self.assertAlmostEqual(rtt.rto, rtt.srtt + 0.05)
+
+    def test_timeout_is_clamped(self):
+        fast = RttEstimator(granularity=0)
+        fast.sample(0.001)
+        self.assertEqual(fast.rto, MIN_RTO)
+        slow = RttEstimator()
+        slow.sample(MAX_RTO)
+        self.assertEqual(slow.rto, MAX_RTO)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        rtt = RttEstimator()
+        rtt.backoff()
+        self.assertEqual(rtt.rto, 2 * INITIAL_RTO)
+        for _ in range(10):
+            rtt.backoff()
+        self.assertEqual(rtt.rto, MAX_RTO)
+        self.assertEqual(rtt.retransmissions, 11)
+
+    def test_a_timeout_of_an_earlier_epoch_does_not_back_off_again(self):
+        rtt = RttEstimator()
+        epoch = rtt.epoch
+        self.assertEqual(rtt.backoff(epoch), epoch + 1)
+        self.assertEqual(rtt.backoff(epoch), epoch + 1)
+        self.assertEqual(rtt.rto, 2 * INITIAL_RTO)
+        self.assertEqual(rtt.retransmissions, 2)
+
+    def test_a_sample_after_a_backoff_restores_the_timeout(self):
+        rtt = RttEstimator(granularity=0.01)
+        rtt.backoff()
+        rtt.backoff()
+        rtt.sample(0.1)
+        self.assertAlmostEqual(rtt.rto, 0.1 + K * 0.05)
+
+
+class AdaptiveRetransmissionTest(unittest.TestCase):
+    ''' RetransmissionScheduler with the RttEstimator of the link '''
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=0.05, slots=64, clock=self.clock)
+        self.retransmissions = RetransmissionScheduler(self.wheel, timeout=1)
+        self.rtt = RttEstimator(granularity=0.05)
+        self.transmitted = 0
+
+    def transmit(self):
+        self.transmitted += 1
+
+    def advance_to(self, now: float):
+        self.clock.now = now
+        self.wheel.advance()
+
+    def test_acknowledged_packets_are_sampled(self):
+        self.retransmissions.send(1, self.transmit, self.rtt)
+        self.clock.now = 0.3
+        self.retransmissions.acknowledged(1)
+        self.assertEqual(self.rtt.samples, 1)
+        self.assertAlmostEqual(self.rtt.srtt, 0.3)
+
+    def test_karns_rule_retransmitted_packets_are_not_sampled(self):
+        self.retransmissions.send(1, self.transmit, self.rtt)
+        self.advance_to(1.05)
+        self.assertEqual(self.transmitted, 2)
+        self.retransmissions.acknowledged(1)
+        self.assertEqual(self.rtt.samples, 0)
+
+    def test_karns_rule_applies_to_fast_retransmissions_too(self):
+        self.retransmissions.send(1, self.transmit, self.rtt)
+        self.retransmissions.retransmit_now(1)
+        self.clock.now = 0.2
+        self.retransmissions.acknowledged(1)
+        self.assertEqual(self.rtt.samples, 0)
+        self.assertEqual(self.rtt.retransmissions, 1)
+
+    def test_implicit_acknowledgements_are_not_sampled(self):
+        self.retransmissions.send(1, self.transmit, self.rtt)
+        self.clock.now = 0.2
+        self.retransmissions.acknowledged(1, rtt_sample=False)
+        self.assertEqual(self.rtt.samples, 0)
+
+    def test_the_timeout_follows_the_rtt_and_backs_off(self):
+        self.rtt.sample(0.2) # RTO 0.6
+        self.retransmissions.send(1, self.transmit, self.rtt)
+        self.advance_to(0.55)
+        self.assertEqual(self.transmitted, 1)
+        self.advance_to(0.65)
+        self.assertEqual(self.transmitted, 2)
+        self.assertAlmostEqual(self.rtt.rto, 1.2)
+        self.advance_to(1.75) # the second timeout is doubled
+        self.assertEqual(self.transmitted, 2)
+        self.advance_to(2)
+        self.assertEqual(self.transmitted, 3)
+
+    def test_packets_timed_out_together_back_off_once(self):
+        self.rtt.sample(0.2) # RTO 0.6
+        for key in range(8):
+            self.retransmissions.send(key, self.transmit, self.rtt)
+        self.advance_to(0.65)
+        self.assertEqual(self.transmitted, 16)
+        self.assertAlmostEqual(self.rtt.rto, 1.2) # not 0.6 * 2 ** 8
+        self.assertEqual(self.rtt.retransmissions, 8)
+        self.advance_to(1.75)
+        self.assertEqual(self.transmitted, 16)
+        self.advance_to(2) # the second round of timeouts doubles it once more
+        self.assertEqual(self.transmitted, 24)
+        self.assertAlmostEqual(self.rtt.rto, 2.4)
+
+    def test_a_packet_scheduled_before_the_last_backoff_does_not_double_it(self):
+        self.rtt.sample(0.2)
+        self.retransmissions.send(1, self.transmit, self.rtt)
+        self.advance_to(0.65)
+        self.assertAlmostEqual(self.rtt.rto, 1.2)
+        self.advance_to(0.9)
+        self.retransmissions.send(2, self.transmit, self.rtt) # times out at about 2.1
+        self.advance_to(2) # packet 1 times out again
+        self.assertAlmostEqual(self.rtt.rto, 2.4)
+        self.advance_to(2.2)
+        self.assertEqual(self.transmitted, 5)
+        self.assertAlmostEqual(self.rtt.rto, 2.4)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,47 @@
+from multiprocessing import Pipe
+import unittest
+from DTOs import *
+from impairment import ImpairmentConfig
+from registry import DroneRegistry
+from sharding import ShardedGateway, WorkerConfig
+
+class CoordinatorTest(unittest.TestCase):
+    ''' The coordinator's copy of the drones, fed with reports as a worker would send them, without starting the workers '''
+    def setUp(self):
+        self.changed: list[tuple[DroneState, list[str]]] = []
+        self.gateway = ShardedGateway(("127.0.0.1", 0), 1, WorkerConfig(8, 10, 15, ImpairmentConfig()), DroneRegistry(),
+            on_state_change=self.state_changed)
+        self.inbox, inbox_writer = Pipe(duplex=False)
+        self.gateway.inboxes.append(inbox_writer)
+        self.addCleanup(self.inbox.close)
+        self.addCleanup(inbox_writer.close)
+
+    def state_changed(self, drone: Drone):
+        self.changed.append((drone.state, [r.shipping_address for r in drone.pending_shipping_requests]))
+
+    def report_state(self, state: DroneState, route: list[str], route_number: int):
+        self.gateway.report_received(("state", 1, ("127.0.0.1", 9001), state, 1, route, route_number))
+
+    def test_a_report_sent_before_the_last_route_is_ignored(self):
+        self.report_state(DroneState.AVAILABLE, [], 0)
+        drone = self.gateway.connected_drones.get_by_id(1)
+        self.gateway.assign_route(drone, [ShippingRequestDTO(1, "Via Zamboni 33")])
+        self.assertEqual(self.inbox.recv(), ("route", 1, ["Via Zamboni 33"], 1))
+        self.report_state(DroneState.AVAILABLE, [], 0) # a heartbeat's report, built before the worker got the route
+        self.assertEqual([r.shipping_address for r in drone.pending_shipping_requests], ["Via Zamboni 33"])
+        self.report_state(DroneState.CURRENTLY_SHIPPING, ["Via Zamboni 33"], 1)
+        self.report_state(DroneState.AVAILABLE, [], 1) # the route is delivered
+        self.assertEqual(self.changed,
+            [(DroneState.AVAILABLE, []), (DroneState.CURRENTLY_SHIPPING, ["Via Zamboni 33"]), (DroneState.AVAILABLE, [])])
+
+    def test_routes_are_numbered_again_after_the_drone_is_removed(self):
+        self.report_state(DroneState.AVAILABLE, [], 0)
+        self.gateway.assign_route(self.gateway.connected_drones.get_by_id(1), [ShippingRequestDTO(1, "Via Zamboni 33")])
+        self.gateway.report_received(("removed", 1))
+        self.assertIsNone(self.gateway.connected_drones.get_by_id(1))
+        self.report_state(DroneState.AVAILABLE, [], 0)
+        self.assertIsNotNone(self.gateway.connected_drones.get_by_id(1))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,163 @@
+import unittest
+from timer_wheel import RetransmissionScheduler, TimerWheel
+
+class FakeClock:
+    ''' A clock which only moves when the test says so '''
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+class TimerWheelTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=1, slots=8, clock=self.clock)
+        self.fired = []
+
+    def advance_to(self, now: float) -> int:
+        self.clock.now = now
+        return self.wheel.advance()
+
+    def test_fires_when_the_delay_expires(self):
+        self.wheel.schedule(3, lambda: self.fired.append("a"))
+        self.assertEqual(self.advance_to(2), 0)
+        self.assertEqual(self.advance_to(3), 1)
+        self.assertEqual(self.fired, ["a"])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_delay_is_rounded_up_to_the_next_tick(self):
+        self.wheel.schedule(0.1, lambda: self.fired.append("a"))
+        self.assertEqual(self.advance_to(0.9), 0)
+        self.assertEqual(self.advance_to(1), 1)
+
+    def test_timers_beyond_a_revolution_wait_for_their_round(self):
+        # with 8 slots a delay of 20 ticks shares its slot with ticks 4 and 12.
+        self.wheel.schedule(20, lambda: self.fired.append("late"))
+        self.wheel.schedule(4, lambda: self.fired.append("early"))
+        self.advance_to(4)
+        self.assertEqual(self.fired, ["early"])
+        self.advance_to(12)
+        self.assertEqual(self.fired, ["early"])
+        self.advance_to(19)
+        self.assertEqual(self.fired, ["early"])
+        self.advance_to(20)
+        self.assertEqual(self.fired, ["early", "late"])
+
+    def test_rollover_when_advanced_one_tick_at_a_time(self):
+        self.wheel.schedule(17, lambda: self.fired.append("a"))
+        for now in range(1, 17):
+            self.advance_to(now)
+        self.assertEqual(self.fired, [])
+        self.advance_to(17)
+        self.assertEqual(self.fired, ["a"])
+
+    def test_scheduling_after_a_long_sleep_counts_from_now(self):
+        self.advance_to(100)
+        self.wheel.schedule(2, lambda: self.fired.append("a"))
+        self.advance_to(101)
+        self.assertEqual(self.fired, [])
+        self.advance_to(102)
+        self.assertEqual(self.fired, ["a"])
+
+    def test_cancelled_timers_never_fire(self):
+        timer = self.wheel.schedule(2, lambda: self.fired.append("a"))
+        self.wheel.schedule(2, lambda: self.fired.append("b"))
+        self.wheel.cancel(timer)
+        self.assertTrue(timer.cancelled)
+        self.assertEqual(len(self.wheel), 1)
+        self.advance_to(10)
+        self.assertEqual(self.fired, ["b"])
+
+    def test_cancelling_twice_or_after_firing_is_harmless(self):
+        timer = self.wheel.schedule(1, lambda: self.fired.append("a"))
+        self.advance_to(1)
+        self.wheel.cancel(timer)
+        self.wheel.cancel(timer)
+        self.assertEqual(len(self.wheel), 0)
+        self.assertEqual(self.fired, ["a"])
+
+    def test_time_until_next_timer(self):
+        self.assertIsNone(self.wheel.time_until_next_timer())
+        self.wheel.schedule(5, lambda: None)
+        self.wheel.schedule(3, lambda: None)
+        self.clock.now = 1.5
+        self.assertAlmostEqual(self.wheel.time_until_next_timer(), 1.5)
+
+    def test_callbacks_can_schedule_timers(self):
+        def reschedule():
+            self.fired.append(self.clock.now)
+            if len(self.fired) < 3:
+                self.wheel.schedule(2, reschedule)
+        self.wheel.schedule(2, reschedule)
+        for now in range(1, 10):
+            self.advance_to(now)
+        self.assertEqual(self.fired, [2, 4, 6])
+
+
+class RetransmissionSchedulerTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.wheel = TimerWheel(tick=0.1, slots=64, clock=self.clock)
+        self.retransmissions = RetransmissionScheduler(self.wheel, timeout=1)
+        self.transmitted = []
+
+    def advance_to(self, now: float):
+        self.clock.now = now
+        self.wheel.advance()
+
+    def send(self, key):
+        self.retransmissions.send(key, lambda: self.transmitted.append(key))
+
+    def test_transmits_at_once_and_at_every_timeout(self):
+        self.send("a")
+        self.assertEqual(self.transmitted, ["a"])
+        self.advance_to(1.05)
+        self.advance_to(2.05)
+        self.assertEqual(self.transmitted, ["a", "a", "a"])
+        self.assertEqual(self.retransmissions.retransmitted, 2)
+
+    def test_acknowledged_packets_are_not_retransmitted(self):
+        self.send("a")
+        self.send("b")
+        self.assertTrue(self.retransmissions.acknowledged("a"))
+        self.assertFalse(self.retransmissions.acknowledged("a"))
+        self.advance_to(1.05)
+        self.assertEqual(self.transmitted, ["a", "b", "b"])
+        self.assertNotIn("a", self.retransmissions)
+        self.assertEqual(len(self.wheel), 1)
+
+    def test_retransmit_now_restarts_the_timeout(self):
+        self.send("a")
+        self.advance_to(0.55)
+        self.retransmissions.retransmit_now("a")
+        self.advance_to(1.05)
+        self.assertEqual(self.transmitted, ["a", "a"])
+        self.advance_to(1.6)
+        self.assertEqual(self.transmitted, ["a", "a", "a"])
+
+    def test_retransmit_now_ignores_acknowledged_packets(self):
+        self.send("a")
+        self.retransmissions.acknowledged("a")
+        self.retransmissions.retransmit_now("a")
+        self.assertEqual(self.transmitted, ["a"])
+
+    def test_sending_a_key_again_replaces_its_packet(self):
+        self.send("a")
+        self.send("a")
+        self.assertEqual(len(self.retransmissions), 1)
+        self.assertEqual(len(self.wheel), 1)
+
+    def test_cancel_all(self):
+        self.send("a")
+        self.send("b")
+        self.retransmissions.cancel_all()
+        self.advance_to(5)
+        self.assertEqual(self.transmitted, ["a", "b"])
+        self.assertEqual(len(self.retransmissions), 0)
+        self.assertEqual(len(self.wheel), 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
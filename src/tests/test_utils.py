@@ -0,0 +1,58 @@
+import unittest
+from utils import HEADER, FramedReader, frame
+
+class ChunkedSocket:
+    ''' A stream socket which receives the chunks given, one per recv_into at most, and then is closed by the peer '''
+    def __init__(self, *chunks: bytes):
+        self.chunks = list(chunks)
+
+    def recv_into(self, view: memoryview) -> int:
+        if not self.chunks:
+            return 0
+        chunk = self.chunks.pop(0)
+        received = min(len(view), len(chunk))
+        view[:received] = chunk[:received]
+        if received < len(chunk):
+            self.chunks.insert(0, chunk[received:])
+        return received
+
+
+class FramedReaderTest(unittest.TestCase):
+    def test_a_partial_header_waits_for_the_rest(self):
+        data = frame(b"snapshot")
+        reader = FramedReader(ChunkedSocket(data[:2], data[2:]))
+        self.assertEqual(reader.read_messages(), [])
+        self.assertEqual(reader.read_messages(), [b"snapshot"])
+        self.assertIsNone(reader.read_messages())
+
+    def test_frames_split_across_reads(self):
+        messages = [b"delta %d" % i for i in range(5)] + [b"", b"x" * 300]
+        data = b"".join(frame(message) for message in messages)
+        chunks = [data[i:i + 7] for i in range(0, len(data), 7)]
+        self.assertEqual(list(FramedReader(ChunkedSocket(*chunks))), messages)
+
+    def test_many_frames_in_one_read(self):
+        reader = FramedReader(ChunkedSocket(frame(b"a") + frame(b"bc") + frame(b"def")[:5]))
+        self.assertEqual(reader.read_messages(), [b"a", b"bc"])
+        self.assertEqual((reader.start, reader.end), (HEADER.size * 2 + 3, HEADER.size * 3 + 4))
+
+    def test_the_incomplete_message_is_moved_to_the_front(self):
+        first, second = frame(b"0123456789"), frame(b"abcdef")
+        reader = FramedReader(ChunkedSocket(first + second[:3], second[3:]), buffer_size=20)
+        self.assertEqual(reader.read_messages(), [b"0123456789"])
+        self.assertEqual((reader.start, reader.end), (14, 17))
+        self.assertEqual(reader.read_messages(), [b"abcdef"])
+        self.assertEqual(len(reader.buffer), 20) # compacted, not grown
+        self.assertEqual((reader.start, reader.end), (0, 0))
+
+    def test_the_buffer_grows_for_a_message_which_does_not_fit(self):
+        message = bytes(range(256)) * 4
+        data = frame(message)
+        reader = FramedReader(ChunkedSocket(data[:16], data[16:]), buffer_size=16)
+        self.assertEqual(reader.read_messages(), [])
+        self.assertEqual(reader.read_messages(), [message])
+        self.assertEqual(len(reader.buffer), len(data))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,172 @@
+import unittest
+from Packet import Packet
+from window import MAX_SACK_BLOCKS, ReceiveWindow, SendWindow, negotiate
+
+def SHP(seq_num: int, has_more_stops: bool = True) -> Packet:
+    return Packet.SHP(sequence_number=seq_num, shipping_address="Stop %d" % seq_num, has_more_stops=has_more_stops)
+
+class NegotiateTest(unittest.TestCase):
+    def test_negotiate(self):
+        self.assertEqual(negotiate(None, 8), 1) # a stop-and-wait peer
+        self.assertEqual(negotiate(4, 8), 4)
+        self.assertEqual(negotiate(16, 8), 8)
+        self.assertEqual(negotiate(4, 1), 1)
+        self.assertEqual(negotiate(0, 8), 1)
+
+
+class ReceiveWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.window = ReceiveWindow(10, size=8)
+
+    def test_in_order_packets_are_delivered_at_once(self):
+        self.assertTrue(self.window.receive(SHP(10)))
+        self.assertEqual([p.seq_num for p in self.window.pop_in_order()], [10])
+        self.assertEqual(self.window.expected, 11)
+        self.assertEqual(self.window.ACK().ACK_num, 11)
+
+    def test_out_of_order_packets_wait_for_the_missing_one(self):
+        self.window.receive(SHP(12))
+        self.window.receive(SHP(11))
+        self.assertEqual(self.window.pop_in_order(), [])
+        self.assertEqual(self.window.ACK().ACK_num, 10)
+        self.window.receive(SHP(10))
+        self.assertEqual([p.seq_num for p in self.window.pop_in_order()], [10, 11, 12])
+        self.assertEqual(self.window.ACK().ACK_num, 13)
+        self.assertEqual(self.window.SACK_blocks(), [])
+
+    def test_adjacent_packets_are_merged_into_one_block(self):
+        for seq_num in (12, 14, 13, 16):
+            self.window.receive(SHP(seq_num))
+        self.assertEqual(self.window.SACK_blocks(), [(12, 15), (16, 17)])
+        ACK = Packet.decode(self.window.ACK().encode())
+        self.assertEqual(ACK.ACK_num, 10)
+        self.assertEqual([tuple(block) for block in ACK.SACK_blocks], [(12, 15), (16, 17)])
+
+    def test_blocks_coalesce_as_the_gaps_are_filled(self):
+        for seq_num in (11, 13, 15):
+            self.window.receive(SHP(seq_num))
+        self.assertEqual(self.window.SACK_blocks(), [(11, 12), (13, 14), (15, 16)])
+        self.window.receive(SHP(12))
+        self.window.receive(SHP(14))
+        self.assertEqual(self.window.SACK_blocks(), [(11, 16)])
+
+    def test_at_most_MAX_SACK_BLOCKS_are_reported(self):
+        window = ReceiveWindow(0, size=4 * MAX_SACK_BLOCKS)
+        for seq_num in range(1, 4 * MAX_SACK_BLOCKS, 2):
+            window.receive(SHP(seq_num))
+        blocks = window.SACK_blocks()
+        self.assertEqual(len(blocks), MAX_SACK_BLOCKS)
+        self.assertEqual(blocks[0], (1, 2)) # the lowest ones, next to the cumulative ACK
+
+    def test_duplicates_below_the_cumulative_ACK_are_refused(self):
+        self.window.receive(SHP(10))
+        self.window.pop_in_order()
+        self.assertFalse(self.window.receive(SHP(10)))
+        self.assertFalse(self.window.receive(SHP(3)))
+        self.assertEqual(self.window.pop_in_order(), [])
+        self.assertEqual(self.window.ACK().ACK_num, 11)
+
+    def test_duplicates_of_buffered_packets_are_refused(self):
+        self.assertTrue(self.window.receive(SHP(12)))
+        self.assertFalse(self.window.receive(SHP(12)))
+        self.assertEqual(self.window.SACK_blocks(), [(12, 13)])
+
+    def test_packets_beyond_the_window_are_refused(self):
+        self.assertTrue(self.window.receive(SHP(17)))
+        self.assertFalse(self.window.receive(SHP(18)))
+        self.assertEqual(self.window.SACK_blocks(), [(17, 18)])
+
+    def test_the_window_slides_when_packets_are_delivered(self):
+        for seq_num in range(10, 18):
+            self.assertTrue(self.window.receive(SHP(seq_num)))
+        self.assertFalse(self.window.receive(SHP(18))) # full
+        self.window.pop_in_order()
+        self.assertTrue(self.window.receive(SHP(18)))
+
+    def test_stop_and_wait(self):
+        window = ReceiveWindow(5)
+        self.assertFalse(window.receive(SHP(6)))
+        self.assertTrue(window.receive(SHP(5)))
+
+
+class SendWindowTest(unittest.TestCase):
+    def setUp(self):
+        self.window = SendWindow()
+        for seq_num in range(10, 15):
+            self.window.sent(seq_num)
+
+    def test_a_cumulative_ACK_acknowledges_every_packet_before_it(self):
+        acknowledged, lost = self.window.acknowledged(13, [])
+        self.assertEqual(acknowledged, [10, 11, 12])
+        self.assertEqual(lost, [])
+        self.assertEqual(self.window.outstanding, [13, 14])
+
+    def test_selectively_acknowledged_packets_leave_the_window(self):
+        acknowledged, lost = self.window.acknowledged(10, [(12, 13), (14, 15)])
+        self.assertEqual(acknowledged, [12, 14])
+        self.assertEqual(self.window.outstanding, [10, 11, 13])
+
+    def test_packets_before_the_first_block_are_lost_and_retransmitted_once(self):
+        _, lost = self.window.acknowledged(10, [(12, 13)])
+        self.assertEqual(lost, [10, 11])
+        _, lost = self.window.acknowledged(10, [(12, 14)])
+        self.assertEqual(lost, []) # their timeout takes over
+        _, lost = self.window.acknowledged(11, [(12, 15)])
+        self.assertEqual(lost, [])
+        self.assertEqual(self.window.outstanding, [11])
+
+    def test_a_later_gap_is_reported_once_the_earlier_is_filled(self):
+        _, lost = self.window.acknowledged(10, [(11, 12)])
+        self.assertEqual(lost, [10])
+        self.window.acknowledged(11, [])
+        self.window.sent(15)
+        self.window.sent(16)
+        _, lost = self.window.acknowledged(11, [(13, 15)])
+        self.assertEqual(lost, [12])
+
+    def test_a_duplicate_ACK_acknowledges_nothing(self):
+        self.window.acknowledged(12, [])
+        acknowledged, lost = self.window.acknowledged(12, [])
+        self.assertEqual((acknowledged, lost), ([], []))
+        acknowledged, lost = self.window.acknowledged(11, [])
+        self.assertEqual((acknowledged, lost), ([], []))
+
+    def test_the_last_ACK_empties_the_window(self):
+        self.window.acknowledged(15, [])
+        self.assertFalse(self.window)
+
+    def test_clear(self):
+        self.window.acknowledged(10, [(12, 13)])
+        self.assertEqual(self.window.clear(), [10, 11, 13, 14])
+        self.assertEqual(len(self.window), 0)
+        self.assertEqual(self.window.fast_retransmitted, set())
+
+
+class WindowedTransferTest(unittest.TestCase):
+    ''' Both sides together: a route of 6 stops whose second and fifth SHPs are lost '''
+    def test_only_the_missing_packets_are_retransmitted(self):
+        sender, receiver = SendWindow(), ReceiveWindow(0, size=6)
+        route = [SHP(seq_num, has_more_stops=seq_num < 5) for seq_num in range(6)]
+        delivered: list[Packet] = []
+        retransmitted: list[int] = []
+        def arrived(packet: Packet):
+            receiver.receive(packet)
+            delivered.extend(receiver.pop_in_order())
+            ACK = receiver.ACK()
+            _, lost = sender.acknowledged(ACK.ACK_num, ACK.SACK_blocks)
+            for seq_num in lost: # the gaps before the first block are filled one at a time
+                retransmitted.append(seq_num)
+                arrived(route[seq_num])
+        for packet in route:
+            sender.sent(packet.seq_num)
+        for packet in route:
+            if packet.seq_num not in (1, 4):
+                arrived(packet)
+        self.assertEqual(retransmitted, [1, 4])
+        self.assertEqual([p.seq_num for p in delivered], list(range(6)))
+        self.assertFalse(delivered[-1].has_more_stops)
+        self.assertFalse(sender)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,242 @@
+import asyncio
+from math import ceil
+from threading import Condition, RLock
+from time import monotonic
+from typing import Callable, Hashable, Optional
+from rtt import CLOCK_GRANULARITY, RttEstimator
+
+# A hashed timer wheel: scheduling and cancelling a timer is O(1), and every tick only looks at the timers of one slot.
+
+class Timer:
+    ''' Handle of a scheduled callback, returned by TimerWheel.schedule '''
+    __slots__ = ("deadline", "rounds", "callback")
+    deadline: int
+    rounds: int
+    callback: Optional[Callable[[], None]]
+
+    def __init__(self, deadline: int, rounds: int, callback: Callable[[], None]):
+        self.deadline = deadline
+        self.rounds = rounds
+        self.callback = callback
+
+    @property
+    def cancelled(self) -> bool:
+        return self.callback is None
+
+
+class TimerWheel:
+    tick: float
+    slots: list[set[Timer]]
+    current_tick: int
+    count: int
+
+    def __init__(self, tick: float = CLOCK_GRANULARITY, slots: int = 512, clock: Callable[[], float] = monotonic):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.clock = clock
+        self.start = clock()
+        self.current_tick = 0
+        self.count = 0
+        self.lock = RLock()
+        self.condition = Condition(self.lock)
+
+    def __len__(self) -> int:
+        return self.count
+
+    def tick_at(self, now: float) -> int:
+        return int((now - self.start) / self.tick)
+
+    def schedule(self, delay: float, callback: Callable[[], None]) -> Timer:
+        ''' Calls callback after delay seconds, rounded up to the next tick '''
+        with self.lock:
+            deadline = max(self.tick_at(self.clock()) + max(1, ceil(delay / self.tick)), self.current_tick + 1)
+            timer = Timer(deadline, (deadline - self.current_tick - 1) // len(self.slots), callback)
+            self.slots[deadline % len(self.slots)].add(timer)
+            self.count += 1
+            self.condition.notify()
+            return timer
+
+    def cancel(self, timer: Timer):
+        with self.lock:
+            if timer.cancelled:
+                return
+            timer.callback = None
+            slot = self.slots[timer.deadline % len(self.slots)]
+            if timer in slot:
+                slot.remove(timer)
+                self.count -= 1
+
+    def advance(self, now: Optional[float] = None) -> int:
+        ''' Fires every timer expired up to now. Returns the number of fired timers '''
+        expired: list[Callable[[], None]] = []
+        with self.lock:
+            target = self.tick_at(self.clock() if now is None else now)
+            if self.count == 0:
+                self.current_tick = max(self.current_tick, target)
+            while self.current_tick < target and self.count > 0:
+                self.current_tick += 1
+                slot = self.slots[self.current_tick % len(self.slots)]
+                for timer in list(slot):
+                    if timer.rounds > 0:
+                        timer.rounds -= 1
+                    else:
+                        slot.remove(timer)
+                        self.count -= 1
+                        expired.append(timer.callback)
+                        timer.callback = None
+            self.current_tick = max(self.current_tick, target)
+        for callback in expired:
+            callback()
+        return len(expired)
+
+    def time_until_next_tick(self) -> float:
+        return self.start + (self.tick_at(self.clock()) + 1) * self.tick - self.clock()
+
+    def time_until_next_timer(self) -> Optional[float]:
+        ''' Seconds until the earliest timer fires, None if there is none. It looks at every timer,
+            so it suits a wheel holding a handful of them, e.g. to wait on a selector until then '''
+        with self.lock:
+            if not self.count:
+                return None
+            deadline = min(timer.deadline for slot in self.slots for timer in slot)
+            return max(0.0, self.start + deadline * self.tick - self.clock())
+
+    def run(self, should_run: Callable[[], bool], poll_interval: float = 0.5):
+        ''' Drives the wheel from a dedicated thread until should_run returns False.
+            While there are no timers the thread sleeps, waking up every poll_interval to check should_run '''
+        while should_run():
+            with self.lock:
+                self.condition.wait(self.time_until_next_tick() if self.count else poll_interval)
+            self.advance()
+
+
+class EventLoopDriver:
+    ''' Drives a TimerWheel from an asyncio event loop instead of a thread.
+        The loop is asked to advance the wheel at its next tick only while the wheel has timers,
+        so an idle wheel costs nothing '''
+    wheel: TimerWheel
+    loop: asyncio.AbstractEventLoop
+    handle: Optional[asyncio.TimerHandle]
+
+    def __init__(self, wheel: TimerWheel, loop: asyncio.AbstractEventLoop):
+        self.wheel = wheel
+        self.loop = loop
+        self.handle = None
+
+    def arm(self):
+        ''' Must be called after scheduling a timer '''
+        if self.handle is None and len(self.wheel):
+            self.handle = self.loop.call_later(self.wheel.time_until_next_tick(), self._advance)
+
+    def _advance(self):
+        self.handle = None
+        self.wheel.advance()
+        self.arm()
+
+    def cancel(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+
+
+class Retransmission:
+    ''' A packet waiting for its ACK '''
+    __slots__ = ("transmit", "timeout", "rtt", "sent_at", "retries", "timer", "epoch")
+    transmit: Callable[[], None]
+    timeout: float
+    rtt: Optional[RttEstimator]
+    sent_at: float
+    retries: int
+    timer: Optional[Timer]
+    epoch: int # epoch of the RttEstimator when the timer was scheduled
+
+    def __init__(self, transmit: Callable[[], None], timeout: float, rtt: Optional[RttEstimator], sent_at: float):
+        self.transmit = transmit
+        self.timeout = timeout
+        self.rtt = rtt
+        self.sent_at = sent_at
+        self.retries = 0
+        self.timer = None
+        self.epoch = rtt.epoch if rtt else 0
+
+
+class RetransmissionScheduler:
+    ''' Keeps every unacknowledged packet in one place and retransmits it each time its timeout expires, until it is acknowledged.
+        Packets are identified by a key chosen by the caller, for example (drone address, sequence number).
+        When a packet is sent with the RttEstimator of its link the timeout adapts to the measured RTT and it is doubled
+        once per round of expired timeouts, otherwise the fixed timeout is used. '''
+    wheel: TimerWheel
+    timeout: float
+    outstanding: dict[Hashable, Retransmission]
+    retransmitted: int # packets transmitted again, by timeout or by retransmit_now.
+
+    def __init__(self, wheel: TimerWheel, timeout: float = 1):
+        self.wheel = wheel
+        self.timeout = timeout
+        self.outstanding = {}
+        self.retransmitted = 0
+        self.lock = RLock()
+
+    def __len__(self) -> int:
+        return len(self.outstanding)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return key in self.outstanding
+
+    def send(self, key: Hashable, transmit: Callable[[], None], rtt: Optional[RttEstimator] = None):
+        ''' Transmits now and then again at every timeout until acknowledged(key) is called '''
+        with self.lock:
+            self.acknowledged(key, rtt_sample=False)
+            retransmission = Retransmission(transmit, rtt.rto if rtt else self.timeout, rtt, self.wheel.clock())
+            self.outstanding[key] = retransmission
+            self._schedule(key, retransmission)
+        transmit()
+
+    def retransmit_now(self, key: Hashable):
+        ''' Retransmits immediately (e.g. the peer showed that it lost the packet) and restarts the timeout '''
+        with self.lock:
+            retransmission = self.outstanding.get(key)
+            if not retransmission:
+                return
+            self.wheel.cancel(retransmission.timer)
+            retransmission.retries += 1
+            self.retransmitted += 1
+            if retransmission.rtt:
+                retransmission.rtt.retransmissions += 1
+            self._schedule(key, retransmission)
+        retransmission.transmit()
+
+    def acknowledged(self, key: Hashable, rtt_sample: bool = True) -> bool:
+        ''' Stops retransmitting the packet. Returns False if it wasn't outstanding.
+            rtt_sample must be False when the packet is acknowledged implicitly (e.g. by a later packet of the peer),
+            as the time elapsed isn't a round-trip time '''
+        with self.lock:
+            retransmission = self.outstanding.pop(key, None)
+            if not retransmission:
+                return False
+            self.wheel.cancel(retransmission.timer)
+            if rtt_sample and retransmission.rtt and retransmission.retries == 0: # Karn's rule
+                retransmission.rtt.sample(self.wheel.clock() - retransmission.sent_at)
+            return True
+
+    def cancel_all(self):
+        with self.lock:
+            for key in list(self.outstanding):
+                self.acknowledged(key, rtt_sample=False)
+
+    def _schedule(self, key: Hashable, retransmission: Retransmission):
+        retransmission.timer = self.wheel.schedule(retransmission.timeout, lambda: self._expired(key, retransmission))
+
+    def _expired(self, key: Hashable, retransmission: Retransmission):
+        with self.lock:
+            if self.outstanding.get(key) is not retransmission:
+                return
+            retransmission.retries += 1
+            self.retransmitted += 1
+            if retransmission.rtt:
+                retransmission.epoch = retransmission.rtt.backoff(retransmission.epoch)
+                retransmission.timeout = retransmission.rtt.rto
+            else:
+                retransmission.timeout = self.timeout
+            self._schedule(key, retransmission)
+        retransmission.transmit()
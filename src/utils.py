@@ -1,28 +1,101 @@
 from socket import socket
 import struct
-from typing import Optional
+from typing import Iterator, Optional
 
 # Utilities for turning a socket stream communication into a message-like communication
 # Using the first 4 bytes of evey message to describe its length.
 
+HEADER = struct.Struct('!I')
+READ_BUFFER_SIZE: int = 64 * 1024
+
+def frame(message: bytes) -> bytes:
+    ''' The message preceded by its length, ready to be written to the socket '''
+    return HEADER.pack(len(message)) + message
+
 def send_message(sock: socket, message: bytes):
-    length = len(message)
-    sock.sendall(struct.pack('!I', length))
-    sock.sendall(message)
+    ''' Writes the header and the message with a single system call '''
+    header = HEADER.pack(len(message))
+    sent = sock.sendmsg([header, message])
+    if sent < len(header) + len(message): # the socket accepted only part of it
+        sock.sendall(memoryview(header + message)[sent:])
 
 def recv_one_message(sock: socket) -> Optional[bytes]:
-    lengthbuf = recvall(sock, 4)
+    lengthbuf = recvall(sock, HEADER.size)
     if not lengthbuf:
         return None
-    length, = struct.unpack('!I', lengthbuf)
+    length, = HEADER.unpack(lengthbuf)
     return recvall(sock, length)
 
 def recvall(sock: socket, count: int) -> Optional[bytes]:
-    buf = b''
-    while count:
-        newbuf = sock.recv(count)
-        if not newbuf:
+    buf = bytearray(count)
+    view = memoryview(buf)
+    while view:
+        received = sock.recv_into(view)
+        if not received:
+            return None
+        view = view[received:]
+    return bytes(buf)
+
+
+class FramedReader:
+    ''' Reads the messages of a socket into a reusable buffer.
+        A single recv_into can bring in many messages, which are all parsed out of the buffer without further system calls.
+        Iterating over the reader yields every message until the peer closes the connection (blocking sockets),
+        read_messages serves non-blocking sockets. '''
+    buffer: bytearray
+    start: int # first byte not parsed yet.
+    end: int # first free byte.
+
+    def __init__(self, sock: socket, buffer_size: int = READ_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(buffer_size)
+        self.start = 0
+        self.end = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            messages = self.read_messages()
+            if messages is None:
+                return
+            yield from messages
+
+    def read_messages(self) -> Optional[list[bytes]]:
+        ''' Receives once and returns the messages completed, None if the peer closed the connection.
+            A non-blocking socket with nothing to read raises BlockingIOError '''
+        self._make_room()
+        received = self.sock.recv_into(memoryview(self.buffer)[self.end:])
+        if not received:
             return None
-        buf += newbuf
-        count -= len(newbuf)
-    return buf
\ No newline at end of file
+        self.end += received
+        return self._parse()
+
+    def _parse(self) -> list[bytes]:
+        messages: list[bytes] = []
+        view = memoryview(self.buffer)
+        while self.end - self.start >= HEADER.size:
+            length, = HEADER.unpack_from(self.buffer, self.start)
+            if self.end - self.start - HEADER.size < length:
+                break
+            self.start += HEADER.size
+            messages.append(bytes(view[self.start:self.start + length]))
+            self.start += length
+        if self.start == self.end:
+            self.start = self.end = 0
+        return messages
+
+    def _make_room(self):
+        ''' Moves the incomplete message to the front of the buffer when little space is left,
+            growing it if the message doesn't fit '''
+        if len(self.buffer) - self.end >= len(self.buffer) // 4:
+            return
+        pending = self.end - self.start
+        if pending >= HEADER.size:
+            length, = HEADER.unpack_from(self.buffer, self.start)
+            needed = HEADER.size + length
+        else:
+            needed = HEADER.size
+        if needed > len(self.buffer):
+            self.buffer.extend(bytes(needed - len(self.buffer)))
+        self.buffer[:pending] = self.buffer[self.start:self.end]
+        self.start = 0
+        self.end = pending
@@ -0,0 +1,93 @@
+from typing import Optional, Sequence
+from Packet import Packet, SackBlock
+
+# Windowed mode of the drone protocol: the gateway sends every SHP of a route (a list of stops) without waiting for the ACK
+# of the previous one, and the drone acknowledges them with a cumulative ACK (the next sequence number it expects) plus the
+# blocks of packets it received beyond a gap (selective ACK), so that only the missing SHPs are retransmitted.
+# The window is negotiated in the handshake: the drone proposes it in the SYN, the gateway grants at most MAX_WINDOW in the
+# SYNACK.
+# A peer which doesn't send a window speaks the old stop-and-wait protocol, which is the windowed mode with window 1.
+
+MAX_WINDOW: int = 8 # stops of a route, all of them can be in flight at the same time.
+MAX_SACK_BLOCKS: int = 4
+
+def negotiate(proposed: Optional[int], maximum: int) -> int:
+    ''' The window granted to a drone which proposed the given one (None if it doesn't know the windowed mode) '''
+    return max(1, min(proposed or 1, maximum))
+
+
+class ReceiveWindow:
+    ''' The receiver side: keeps the packets arrived out of order until the missing ones arrive '''
+    __slots__ = ("expected", "size", "buffered")
+    expected: int # first sequence number not received yet, i.e. the cumulative ACK number.
+    size: int
+    buffered: dict[int, Packet]
+
+    def __init__(self, expected: int, size: int = 1):
+        self.expected = expected
+        self.size = size
+        self.buffered = {}
+
+    def receive(self, packet: Packet) -> bool:
+        ''' Returns False if the packet is a duplicate or it is beyond the window '''
+        if packet.seq_num < self.expected or packet.seq_num >= self.expected + self.size or packet.seq_num in self.buffered:
+            return False
+        self.buffered[packet.seq_num] = packet
+        return True
+
+    def pop_in_order(self) -> list[Packet]:
+        ''' The packets which can be delivered, as every packet before them has arrived '''
+        packets = []
+        while self.expected in self.buffered:
+            packets.append(self.buffered.pop(self.expected))
+            self.expected += 1
+        return packets
+
+    def SACK_blocks(self) -> list[SackBlock]:
+        blocks: list[SackBlock] = []
+        for seq_num in sorted(self.buffered):
+            if blocks and blocks[-1][1] == seq_num:
+                blocks[-1] = (blocks[-1][0], seq_num + 1)
+            else:
+                blocks.append((seq_num, seq_num + 1))
+        return blocks[:MAX_SACK_BLOCKS]
+
+    def ACK(self) -> Packet:
+        return Packet.ACK(self.expected, self.SACK_blocks())
+
+
+class SendWindow:
+    ''' The sender side: the sequence numbers waiting for an ACK '''
+    __slots__ = ("outstanding", "fast_retransmitted")
+    outstanding: list[int] # in sending order
+    fast_retransmitted: set[int]
+
+    def __init__(self):
+        self.outstanding = []
+        self.fast_retransmitted = set()
+
+    def __len__(self) -> int:
+        return len(self.outstanding)
+
+    def sent(self, seq_num: int):
+        self.outstanding.append(seq_num)
+
+    def acknowledged(self, ACK_num: int, SACK_blocks: Sequence[SackBlock]) -> tuple[list[int], list[int]]:
+        ''' Returns the sequence numbers acknowledged by the ACK and the ones to retransmit at once because the receiver
+            got some packets sent after them. Each packet is retransmitted this way only once, then its timeout takes over '''
+        def is_acknowledged(seq_num: int) -> bool:
+            return seq_num < ACK_num or any(start <= seq_num < end for start, end in SACK_blocks)
+        acknowledged = [s for s in self.outstanding if is_acknowledged(s)]
+        self.outstanding = [s for s in self.outstanding if not is_acknowledged(s)]
+        first_selectively_acknowledged = min((start for start, _ in SACK_blocks), default=0)
+        lost = [s for s in self.outstanding if s < first_selectively_acknowledged and s not in self.fast_retransmitted]
+        self.fast_retransmitted.update(lost)
+        self.fast_retransmitted.difference_update(acknowledged)
+        return acknowledged, lost
+
+    def clear(self) -> list[int]:
+        ''' Forgets every outstanding packet, returning them '''
+        outstanding = self.outstanding
+        self.outstanding = []
+        self.fast_retransmitted.clear()
+        return outstanding